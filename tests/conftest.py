@@ -0,0 +1,50 @@
+import pathlib
+import sys
+
+import pytest
+
+# manage.py is a script rather than a package.
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / "tools"))
+
+import manage
+
+
+@pytest.fixture
+def compiler_bin(tmp_path):
+    # A compiler installed as cc-11, cc-12 and cc-13, like gcc-N in /usr/bin.
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    for version in ("11", "12", "13"):
+        (bin_dir / f"cc-{version}").touch()
+    return bin_dir
+
+
+@pytest.fixture
+def applications(compiler_bin):
+    # Definitions in the form returned by manage.load_applications.
+    return {
+        "cc": {
+            "versions": None,
+            "modulefile": {
+                "required": True,
+                "whatis": "C compiler",
+                "family": "compiler",
+                "prepend-path": [("PATH", "{symlink_dir}")],
+                "setenv": [("CC", "cc")],
+            },
+            "dependencies": [
+                {"name": "cc", "search_dir": str(compiler_bin), "pattern": r"^cc-([0-9]+)$", "symlink_required": True},
+            ],
+            "symlink_dirs": {},
+        },
+    }
+
+
+@pytest.fixture
+def manager_factory(tmp_path, applications):
+    # Managers of a tree in the temporary directory, which only report to stdout.
+    def factory(**kwargs):
+        kwargs.setdefault("applications", applications)
+        kwargs.setdefault("spider_cache", False)
+        return manage.ModulefileManager(root=tmp_path / "modules", **kwargs)
+    return factory
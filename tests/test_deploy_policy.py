@@ -0,0 +1,73 @@
+import manage
+
+
+def marker(manager, tree):
+    return manage.read_version_marker(tree / "cc" / manage.VERSION_MARKER)
+
+
+def test_select_versions():
+    obj = {"versions": ["10", "11", "12", "13"], "deploy": {"keep": 2, "pin": ["10"], "default": "12"}}
+    assert manage.select_versions(obj) == (["10", "12", "13"], "12")
+    obj["deploy"]["default"] = "11"
+    assert manage.select_versions(obj) == (["10", "12", "13"], "13")
+    assert manage.select_versions({"versions": []}) == ([], None)
+
+
+def test_autodeploy_follows_the_policy(manager_factory, applications):
+    applications["cc"]["deploy"] = {"keep": 2}
+    manager = manager_factory()
+    manager.generate()
+    manager.autodeploy()
+    assert sorted(map(str, manager.deployed)) == ["cc/12", "cc/13"]
+    assert marker(manager, manager.AVAILABLE_MODULES_DIR) == "13"
+
+
+def test_deployed_marker_names_a_deployed_version(manager_factory, compiler_bin):
+    manager = manager_factory()
+    manager.generate()
+    manager.autodeploy()
+    deployed_marker = manager.DEPLOYED_MODULES_DIR / "cc" / manage.VERSION_MARKER
+    assert not deployed_marker.is_symlink()
+    assert marker(manager, manager.DEPLOYED_MODULES_DIR) == "13"
+
+    # The default's dependency is gone, so autodeploy withdraws it, although it is still available.
+    (compiler_bin / "cc-13").unlink()
+    manager = manager_factory()
+    manager.autodeploy()
+    assert sorted(map(str, manager.deployed)) == ["cc/11", "cc/12"]
+    assert marker(manager, manager.AVAILABLE_MODULES_DIR) == "13"
+    assert marker(manager, manager.DEPLOYED_MODULES_DIR) == "12"
+
+    (compiler_bin / "cc-13").touch()
+    manager = manager_factory()
+    manager.autodeploy()
+    assert marker(manager, manager.DEPLOYED_MODULES_DIR) == "13"
+
+    manager.withdraw_all()
+    assert not (manager.DEPLOYED_MODULES_DIR / "cc").exists()
+
+
+def test_symlinked_markers_are_replaced(manager_factory):
+    manager = manager_factory()
+    manager.generate()
+    manager.deploy("cc/12")
+    deployed_marker = manager.DEPLOYED_MODULES_DIR / "cc" / manage.VERSION_MARKER
+    deployed_marker.unlink()
+    deployed_marker.symlink_to(manager.AVAILABLE_MODULES_DIR / "cc" / manage.VERSION_MARKER)
+    manager.deploy("cc/11")
+    assert not deployed_marker.is_symlink()
+    assert marker(manager, manager.DEPLOYED_MODULES_DIR) == "12"
+
+
+def test_autodeploy_keeps_hand_written_modules(manager_factory):
+    manager = manager_factory()
+    manager.generate()
+    local = manager.AVAILABLE_MODULES_DIR / "local" / "1"
+    local.parent.mkdir()
+    local.write_text("#%Module\nset root /nonexistent\nprepend-path PATH $root/bin\nprepend-path LD_LIBRARY_PATH /nonexistent/lib\n")
+    manager.deploy("local/1")
+
+    manager = manager_factory()
+    manager.autodeploy()
+    assert "local/1" in map(str, manager.deployed)
+    assert manage.modulefile_requirements(local) == [[("exists", "/nonexistent/lib")]]
@@ -0,0 +1,118 @@
+import os
+
+import pytest
+
+import manage
+
+
+@pytest.fixture
+def store(tmp_path):
+    deployed = tmp_path / "deployed"
+    deployed.mkdir()
+    (deployed / "gcc").mkdir()
+    (deployed / "gcc" / "12").symlink_to(tmp_path / "available" / "gcc" / "12")
+    return manage.GenerationStore(deployed, tmp_path / ".deployed-generations", keep=2)
+
+
+def entries(directory):
+    return sorted(str(path.relative_to(directory)) for path in directory.rglob("*"))
+
+
+def test_adopt_existing_directory(store):
+    assert store.current() is None
+    store.adopt()
+    assert store.current() == 1
+    assert store.deployed_dir.is_symlink()
+    assert entries(store.deployed_dir) == ["gcc", "gcc/12"]
+    # Relative, so the tree can be moved.
+    assert not os.path.isabs(os.readlink(store.deployed_dir))
+
+
+def test_publish_and_rollback(store):
+    staging = store.stage()
+    (staging / "gcc" / "13").symlink_to("/nonexistent/gcc/13")
+    # Readers see the published generation until the staged one is.
+    assert entries(store.deployed_dir) == ["gcc", "gcc/12"]
+    assert store.publish(staging) == 2
+    assert entries(store.deployed_dir) == ["gcc", "gcc/12", "gcc/13"]
+    assert not staging.exists()
+
+    assert store.rollback() == 1
+    assert entries(store.deployed_dir) == ["gcc", "gcc/12"]
+
+
+def test_discard(store):
+    staging = store.stage()
+    (staging / "gcc" / "13").symlink_to("/nonexistent/gcc/13")
+    store.discard(staging)
+    assert not staging.exists()
+    assert store.current() == 1
+    assert entries(store.deployed_dir) == ["gcc", "gcc/12"]
+
+
+def test_old_generations_are_pruned(store):
+    for i in range(5):
+        store.publish(store.stage())
+    # The current generation and keep previous ones.
+    assert store.generations() == [4, 5, 6]
+    assert store.current() == 6
+
+
+def test_rollback_without_previous_generation(store):
+    store.adopt()
+    with pytest.raises(Exception):
+        store.rollback()
+
+
+def test_manager_publishes_changes_as_generations(manager_factory):
+    manager = manager_factory(generations=3)
+    manager.generate()
+    with manager.generation():
+        manager.deploy("cc/12")
+    store = manager.generation_store()
+    first = store.current()
+    assert first is not None
+    assert sorted(map(str, manage.ModulefileDirectory(manager.DEPLOYED_MODULES_DIR))) == ["cc/12"]
+
+    with manager.generation():
+        manager.deploy("cc/13")
+    assert store.current() == first + 1
+    assert sorted(map(str, manage.ModulefileDirectory(manager.DEPLOYED_MODULES_DIR))) == ["cc/12", "cc/13"]
+
+    # Nothing changed, so nothing is published.
+    with manager.generation():
+        manager.deploy("cc/13")
+    assert store.current() == first + 1
+
+    # A failure discards the staged changes.
+    with pytest.raises(RuntimeError):
+        with manager.generation():
+            manager.withdraw("cc/12")
+            raise RuntimeError()
+    assert store.current() == first + 1
+    assert sorted(map(str, manage.ModulefileDirectory(manager.DEPLOYED_MODULES_DIR))) == ["cc/12", "cc/13"]
+
+    manager.rollback()
+    assert sorted(map(str, manager.deployed)) == ["cc/12"]
+
+
+def test_unchanged_runs_do_not_stage(manager_factory, monkeypatch):
+    manager = manager_factory(generations=3)
+    manager.generate()
+    with manager.generation():
+        manager.deploy("cc/12")
+    staged = []
+    stage = manage.GenerationStore.stage
+    monkeypatch.setattr(manage.GenerationStore, "stage", lambda self: staged.append(True) or stage(self))
+
+    manager = manager_factory(generations=3)
+    with manager.generation():
+        manager.deploy("cc/12")
+        manager.withdraw("cc/13")
+        manager.autodeploy(names=[])
+    assert staged == []
+
+    with manager.generation():
+        manager.deploy("cc/13")
+    assert staged == [True]
+    assert sorted(map(str, manage.ModulefileDirectory(manager.DEPLOYED_MODULES_DIR))) == ["cc/12", "cc/13"]
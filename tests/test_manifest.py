@@ -0,0 +1,158 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import manage
+
+
+def write(root, name, content="#%Module"):
+    path = root / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+    return path
+
+
+def changed(directory):
+    # Make sure the directory's mtime differs from when it was recorded, however coarse the filesystem's timestamps.
+    st = os.stat(directory)
+    os.utime(directory, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+
+
+def origins(manifest, tree):
+    return {module["filename"]: module["origin"] for module in manifest.modules(tree)}
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / "available"
+    for name in ("gcc/12", "gcc/13", "cuda/12.4.lua", "gcc/.version"):
+        write(root, name)
+    return root
+
+
+def test_verify_scans_then_only_rescans_changed_directories(tree, tmp_path):
+    manifest = manage.Manifest(tmp_path / "manifest.sqlite")
+    changes = manifest.verify("available", tree)
+    assert sorted(changes["added"]) == ["cuda/12.4.lua", "gcc/12", "gcc/13"]
+    assert origins(manifest, "available") == {"cuda/12.4.lua": "external", "gcc/12": "external", "gcc/13": "external"}
+
+    changes = manifest.verify("available", tree)
+    assert changes == {"added": [], "removed": [], "rescanned": 0}
+
+    write(tree, "gcc/14")
+    changed(tree / "gcc")
+    (tree / "cuda" / "12.4.lua").unlink()
+    (tree / "cuda").rmdir()
+    changed(tree)
+    changes = manifest.verify("available", tree)
+    assert changes["added"] == ["gcc/14"]
+    assert changes["removed"] == ["cuda/12.4.lua"]
+    assert changes["rescanned"] == 2
+    assert sorted(name + suffix for name, suffix in manifest.names("available")) == ["gcc/12", "gcc/13", "gcc/14"]
+
+
+def test_recorded_origins_are_kept(tree, tmp_path):
+    manifest = manage.Manifest(tmp_path / "manifest.sqlite")
+    manifest.verify("available", tree)
+    with manifest.transaction():
+        write(tree, "clang/17")
+        manifest.record("available", tree, "clang/17", "generated", "abc")
+    assert origins(manifest, "available")["clang/17"] == "generated"
+    # The transaction recorded the new directory, so there is nothing to rescan.
+    assert manifest.verify("available", tree)["rescanned"] == 0
+
+    write(tree, "clang/18")
+    changed(tree / "clang")
+    manifest.verify("available", tree)
+    assert origins(manifest, "available")["clang/17"] == "generated"
+    assert origins(manifest, "available")["clang/18"] == "external"
+
+    with manifest.transaction():
+        (tree / "clang" / "17").unlink()
+        manifest.forget("available", tree, "clang/17")
+    assert "clang/17" not in origins(manifest, "available")
+
+
+def test_persists_between_instances(tree, tmp_path):
+    manifest = manage.Manifest(tmp_path / "manifest.sqlite")
+    manifest.verify("available", tree)
+    manifest.close()
+    manifest = manage.Manifest(tmp_path / "manifest.sqlite")
+    assert manifest.verify("available", tree)["rescanned"] == 0
+    assert len(list(manifest.modules("available"))) == 3
+
+
+def test_manager_reads_match_the_tree(manager_factory):
+    manager = manager_factory()
+    manager.generate()
+    manager.autodeploy()
+    walked = sorted(map(str, manage.ModulefileDirectory(manager.DEPLOYED_MODULES_DIR)))
+    manager = manager_factory()
+    assert sorted(map(str, manager.deployed)) == walked == ["cc/11", "cc/12", "cc/13"]
+    assert manager.MANIFEST_FILE.is_file()
+    assert {module["origin"] for module in manager.manifest.modules("available")} == {"generated"}
+    assert {module["origin"] for module in manager.manifest.modules("deployed")} == {"deployed"}
+
+
+def test_dry_run_does_not_create_the_manifest(manager_factory):
+    manager = manager_factory(dry_run=True)
+    manager.generate()
+    manager.prune()
+    assert len(manager.available) == 0
+    assert not manager.MANIFEST_FILE.exists()
+
+
+def snapshot(directory):
+    return sorted((path.relative_to(directory).as_posix(), os.readlink(path) if path.is_symlink() else path.read_bytes()) for path in directory.rglob("*") if not path.is_dir())
+
+
+def test_dry_run_cannot_deploy(manager_factory, monkeypatch):
+    manager = manager_factory()
+    manager.generate()
+    manager.deploy("cc/13")
+    deployed = snapshot(manager.DEPLOYED_MODULES_DIR)
+    manifest = manager.MANIFEST_FILE.read_bytes()
+
+    monkeypatch.setattr(sys, "argv", ["manage.py", "--deploy", "cc", "--dry-run"])
+    manager = manager_factory(dry_run=True)
+    with pytest.raises(Exception, match="--deploy"):
+        manager.cli(manage.parse_cli())
+    with pytest.raises(Exception, match="dry run"):
+        manager.deploy("cc")
+    with pytest.raises(Exception, match="dry run"):
+        manager.withdraw_all()
+    assert snapshot(manager.DEPLOYED_MODULES_DIR) == deployed
+    assert manager.MANIFEST_FILE.read_bytes() == manifest
+
+
+def lock_held(path):
+    # Whether another process can take the lock.
+    script = "import fcntl, os, sys; fd = os.open(sys.argv[1], os.O_RDWR | os.O_CREAT); fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)"
+    return subprocess.run([sys.executable, "-c", script, str(path)], capture_output=True).returncode != 0
+
+
+def test_manifest_is_accessed_under_the_lock(manager_factory, monkeypatch):
+    manager = manager_factory()
+    manager.generate()
+    held = []
+    verify = manage.Manifest.verify
+
+    def locked_verify(self, tree, root):
+        held.append(lock_held(manager.DEPLOY_LOCK_FILE))
+        return verify(self, tree, root)
+    monkeypatch.setattr(manage.Manifest, "verify", locked_verify)
+    manager = manager_factory()
+    manager.find_available()
+    assert held == [True]
+    assert not lock_held(manager.DEPLOY_LOCK_FILE)
+
+
+def test_nested_locks_are_released_once(manager_factory):
+    manager = manager_factory()
+    with manager.lock():
+        manager.generate()
+        # Transactions within took and released the lock themselves.
+        assert lock_held(manager.DEPLOY_LOCK_FILE)
+    assert not lock_held(manager.DEPLOY_LOCK_FILE)
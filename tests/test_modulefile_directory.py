@@ -0,0 +1,60 @@
+import pathlib
+
+import manage
+
+
+def names(directory, group=None):
+    return sorted(str(name) for name in directory.modulefiles(group))
+
+
+def test_membership_and_groups():
+    directory = manage.ModulefileDirectory(modulefiles=["gcc/12", "gcc/13", "cuda/12.4.lua", "tools/a/1"])
+    assert pathlib.Path("gcc/12") in directory
+    assert pathlib.Path("cuda/12.4") in directory
+    assert pathlib.Path("gcc/14") not in directory
+    assert directory.is_group("gcc")
+    assert directory.is_group("tools/a")
+    assert not directory.is_group("gcc/12")
+    assert directory.is_file("gcc/12")
+    assert not directory.is_file("gcc")
+    assert len(directory) == 4
+    assert names(directory, "gcc") == ["gcc/12", "gcc/13"]
+    assert names(directory, "tools") == ["tools/a/1"]
+
+
+def test_lua_suffix_is_kept_for_filename():
+    directory = manage.ModulefileDirectory(modulefiles=["cuda/12.4.lua", "gcc/12"])
+    assert directory.filename("cuda/12.4") == pathlib.Path("cuda/12.4.lua")
+    assert directory.filename("gcc/12") == pathlib.Path("gcc/12")
+
+
+def test_remove_prunes_empty_groups():
+    directory = manage.ModulefileDirectory(modulefiles=["gcc/12", "tools/a/1"])
+    directory.remove("tools/a/1")
+    assert not directory.exists("tools/a")
+    assert not directory.exists("tools")
+    assert names(directory) == ["gcc/12"]
+
+
+def test_difference():
+    available = manage.ModulefileDirectory(modulefiles=["gcc/12", "gcc/13", "cuda/12.4.lua", "tools/a/1"])
+    deployed = manage.ModulefileDirectory(modulefiles=["gcc/12", "cuda/12.4.lua"])
+    difference = available - deployed
+    assert names(difference) == ["gcc/13", "tools/a/1"]
+    assert not difference.is_group("cuda")
+    # Neither operand is changed.
+    assert len(available) == 4
+    assert len(deployed) == 2
+
+
+def test_load_from_disk(tmp_path):
+    for name in ("gcc/12", "gcc/.version", "cuda/12.4.lua", ".hidden/1"):
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text("#%Module")
+    directory = manage.ModulefileDirectory(tmp_path)
+    assert names(directory) == ["cuda/12.4", "gcc/12"]
+    assert directory.filename("cuda/12.4") == pathlib.Path("cuda/12.4.lua")
+    from_names = manage.ModulefileDirectory.from_names(tmp_path, [("gcc/12", ""), ("cuda/12.4", ".lua")])
+    assert names(from_names) == names(directory)
+    assert not len(directory - from_names)
@@ -0,0 +1,117 @@
+import copy
+import io
+import json
+import os
+import time
+
+import manage
+
+
+def generate(applications, root, **kwargs):
+    definitions = copy.deepcopy(applications)
+    manage.find_applications(definitions)
+    manage.create_symlinks(definitions, root / "symlinks")
+    return manage.create_modulefiles(definitions, modulefiles_root=root / "available", **kwargs)
+
+
+def test_unchanged_modulefiles_are_not_rewritten(applications, tmp_path):
+    report = generate(applications, tmp_path)
+    assert len(report["written"]) == 3
+    modulefile = tmp_path / "available" / "cc" / "12"
+    mtime = modulefile.stat().st_mtime_ns
+    inode = modulefile.stat().st_ino
+
+    report = generate(applications, tmp_path)
+    assert not len(report["written"])
+    assert len(report["unchanged"]) == 3
+    assert modulefile.stat().st_mtime_ns == mtime
+    assert modulefile.stat().st_ino == inode
+
+
+def test_not_incremental_rewrites(applications, tmp_path):
+    generate(applications, tmp_path)
+    report = generate(applications, tmp_path, incremental=False)
+    assert len(report["written"]) == 3
+
+
+def test_changed_modulefiles_keep_their_mode(applications, tmp_path):
+    generate(applications, tmp_path)
+    modulefile = tmp_path / "available" / "cc" / "12"
+    os.chmod(modulefile, 0o664)
+    marker = tmp_path / "available" / "cc" / manage.VERSION_MARKER
+    os.chmod(marker, 0o664)
+
+    applications["cc"]["modulefile"]["whatis"] = "Another C compiler"
+    applications["cc"]["deploy"] = {"default": "12"}
+    report = generate(applications, tmp_path)
+    assert len(report["written"]) == 3
+    assert "Another C compiler" in modulefile.read_text()
+    assert modulefile.stat().st_mode & 0o777 == 0o664
+    assert manage.read_version_marker(marker) == "12"
+    assert marker.stat().st_mode & 0o777 == 0o664
+
+
+def test_new_modulefiles_honour_the_umask(applications, tmp_path):
+    umask = os.umask(0o027)
+    try:
+        generate(applications, tmp_path)
+    finally:
+        os.umask(umask)
+    assert (tmp_path / "available" / "cc" / "12").stat().st_mode & 0o777 == 0o640
+
+
+def test_stale_modulefiles_are_reported(applications, compiler_bin, tmp_path):
+    generate(applications, tmp_path)
+    (compiler_bin / "cc-11").unlink()
+    report = generate(applications, tmp_path)
+    assert report["stale"] == [tmp_path / "available" / "cc" / "11"]
+
+
+def test_write_file_if_changed(tmp_path):
+    path = tmp_path / "file"
+    assert manage.write_file_if_changed(path, "a")
+    assert not manage.write_file_if_changed(path, "a")
+    assert manage.write_file_if_changed(path, "b", dry_run=True)
+    assert path.read_text() == "a"
+    # No temporary files are left behind.
+    assert os.listdir(tmp_path) == ["file"]
+
+
+def test_registry_cache_is_json(tmp_path):
+    cache = tmp_path / "registry.json"
+    loaded = manage.load_applications(manage.APPLICATIONS_DIR, cache)
+    assert json.loads(cache.read_text())["version"] == manage.REGISTRY_CACHE_VERSION
+    assert manage.load_applications(manage.APPLICATIONS_DIR, cache) == loaded
+
+    # Caches which no longer validate are rebuilt from the definitions.
+    cached = json.loads(cache.read_text())
+    for entry in cached["applications"].values():
+        entry["table"]["dependencies"] = []
+    cache.write_text(json.dumps(cached))
+    assert manage.load_applications(manage.APPLICATIONS_DIR, cache) == loaded
+
+
+def test_records_are_streamed_as_applications_complete(applications, tmp_path, monkeypatch):
+    stream = io.StringIO()
+    monkeypatch.setattr(manage, "OUTPUT", manage.OutputStream("ndjson", stream=stream))
+    applications["dd"] = copy.deepcopy(applications["cc"])
+    process = manage.GeneratePipeline.process_application
+    seen = []
+
+    def process_application(self, app, obj, scanned, mode):
+        # dd waits for cc's records, which are only written before the pipeline finishes if streamed.
+        if app == "dd":
+            deadline = time.monotonic() + 5
+            while '"cc/' not in stream.getvalue() and time.monotonic() < deadline:
+                time.sleep(0.01)
+            seen.append('"cc/' in stream.getvalue())
+        return process(self, app, obj, scanned, mode)
+    monkeypatch.setattr(manage.GeneratePipeline, "process_application", process_application)
+
+    manage.generate_modules(jobs=2, applications=applications, symlinks_dir=tmp_path / "symlinks", modulefiles_dir=tmp_path / "available")
+    assert seen == [True]
+    records = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert sorted(record["name"] for record in records if record["type"] == "entry" and record["state"] == "available") == ["cc/11", "cc/12", "cc/13", "dd/11", "dd/12", "dd/13"]
+    # Counts follow the entries.
+    assert [record["section"] for record in records if record["type"] == "count"] == ["symlinks", "modulefiles"]
+    assert all(record["type"] == "count" for record in records[-2:])
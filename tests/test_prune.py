@@ -0,0 +1,81 @@
+import json
+
+import pytest
+
+import manage
+
+
+def tree(directory):
+    return sorted(str(path.relative_to(directory)) for path in directory.rglob("*"))
+
+
+@pytest.fixture
+def generated(manager_factory, applications):
+    # cc 11, 12 and 13 generated and deployed, with 13 the default, and a hand-written module.
+    applications["cc"]["deploy"] = {"default": "13"}
+    manager = manager_factory()
+    manager.generate()
+    manager.autodeploy()
+    hand_written = manager.AVAILABLE_MODULES_DIR / "local" / "1"
+    hand_written.parent.mkdir()
+    hand_written.write_text("#%Module")
+    return manager
+
+
+def test_prune_removes_only_stale_entries(generated, manager_factory, compiler_bin):
+    (compiler_bin / "cc-13").unlink()
+    manager = manager_factory()
+    manager.prune()
+    assert tree(manager.AVAILABLE_MODULES_DIR) == ["cc", "cc/.version", "cc/11", "cc/12", "local", "local/1"]
+    assert tree(manager.DEPLOYED_MODULES_DIR) == ["cc", "cc/.version", "cc/11", "cc/12"]
+    assert tree(manager.SYMLINKS_DIR) == ["cc", "cc/11", "cc/11/cc", "cc/12", "cc/12/cc"]
+    assert not (manager.SYMLINKS_DIR / "cc" / "13").exists()
+
+    # The views, manifest and search index no longer include it.
+    assert sorted(map(str, manager.available)) == ["cc/11", "cc/12", "local/1"]
+    assert manage.Manifest(manager.MANIFEST_FILE).verify("available", manager.AVAILABLE_MODULES_DIR)["rescanned"] == 0
+    assert "cc/13" not in manage.SearchIndex(manager.SEARCH_INDEX_FILE).entries
+
+
+def test_prune_updates_default_versions(generated, manager_factory, compiler_bin):
+    assert manage.read_version_marker(generated.DEPLOYED_MODULES_DIR / "cc" / ".version") == "13"
+    (compiler_bin / "cc-13").unlink()
+    manager = manager_factory()
+    manager.prune()
+    assert manage.read_version_marker(manager.AVAILABLE_MODULES_DIR / "cc" / ".version") == "12"
+    assert manage.read_version_marker(manager.DEPLOYED_MODULES_DIR / "cc" / ".version") == "12"
+    with open(manager.DEPLOY_POLICY_FILE) as fp:
+        assert json.load(fp)["cc"] == {"versions": ["11", "12"], "default": "12"}
+
+
+def test_prune_removes_applications_no_longer_defined(generated, manager_factory):
+    manager = manager_factory(applications={})
+    manager.prune()
+    assert tree(manager.AVAILABLE_MODULES_DIR) == ["local", "local/1"]
+    assert tree(manager.DEPLOYED_MODULES_DIR) == []
+    assert tree(manager.SYMLINKS_DIR) == []
+
+
+def test_dry_run_changes_nothing(generated, manager_factory, compiler_bin, capsys):
+    (compiler_bin / "cc-13").unlink()
+    before = {root: tree(root) for root in (generated.AVAILABLE_MODULES_DIR, generated.DEPLOYED_MODULES_DIR, generated.SYMLINKS_DIR)}
+    capsys.readouterr()
+    manager_factory(dry_run=True).prune()
+    assert "Planned prune: 1 stale modulefiles, 1 stale symlinks" in capsys.readouterr().out
+    assert {root: tree(root) for root in before} == before
+
+
+def test_nothing_to_prune(generated, manager_factory, capsys):
+    before = tree(generated.AVAILABLE_MODULES_DIR)
+    capsys.readouterr()
+    manager_factory().prune()
+    assert "Pruned: 0 stale modulefiles, 0 stale symlinks" in capsys.readouterr().out
+    assert tree(generated.AVAILABLE_MODULES_DIR) == before
+
+
+def test_prune_without_manifest(generated, manager_factory, compiler_bin):
+    (compiler_bin / "cc-11").unlink()
+    manager = manager_factory(manifest=False)
+    manager.prune()
+    assert tree(manager.AVAILABLE_MODULES_DIR) == ["cc", "cc/.version", "cc/12", "cc/13", "local", "local/1"]
+    assert tree(manager.DEPLOYED_MODULES_DIR) == ["cc", "cc/.version", "cc/12", "cc/13"]
@@ -0,0 +1,118 @@
+import os
+
+import pytest
+
+import manage
+
+
+@pytest.fixture
+def search_dir(tmp_path):
+    directory = tmp_path / "bin"
+    directory.mkdir()
+    for name in ("gcc-12", "gcc-13", "g++-12", "gfortran-13", "unrelated"):
+        (directory / name).touch()
+    return directory
+
+
+def versions(scanned, search_dir, pattern):
+    return sorted(scanned[(search_dir, pattern)])
+
+
+def test_combined_patterns_match_individually(search_dir):
+    scanner = manage.DirectoryScanner()
+    patterns = [r"^gcc-([0-9]+)$", r"^g\+\+-([0-9]+)$", r"^gfortran-([0-9]+)$"]
+    for pattern in patterns:
+        scanner.add(str(search_dir), pattern)
+    scanned = scanner.scan()
+    assert versions(scanned, search_dir, patterns[0]) == ["12", "13"]
+    assert versions(scanned, search_dir, patterns[1]) == ["12"]
+    assert versions(scanned, search_dir, patterns[2]) == ["13"]
+    assert scanned[(search_dir, patterns[0])]["12"]["path"] == (search_dir / "gcc-12").resolve()
+
+
+def test_overlapping_patterns_all_see_matches(search_dir):
+    scanner = manage.DirectoryScanner()
+    scanner.add(str(search_dir), r"^gcc-([0-9]+)$")
+    scanner.add(str(search_dir), r"^g[a-z+]*-(1[23])$")
+    scanned = scanner.scan()
+    assert versions(scanned, search_dir, r"^gcc-([0-9]+)$") == ["12", "13"]
+    assert versions(scanned, search_dir, r"^g[a-z+]*-(1[23])$") == ["12", "13"]
+
+
+def test_patterns_which_cannot_be_combined(search_dir):
+    # Duplicate group names can't be combined into one alternation.
+    patterns = [r"^gcc-(?P<v>[0-9]+)$", r"^gfortran-(?P<v>[0-9]+)$"]
+    found = manage.DirectoryScanner.scan_directory(search_dir, patterns)
+    assert sorted(found[patterns[0]]) == ["12", "13"]
+    assert sorted(found[patterns[1]]) == ["13"]
+
+
+def test_missing_directory(tmp_path):
+    scanner = manage.DirectoryScanner()
+    scanner.add(str(tmp_path / "missing"), r"^gcc-([0-9]+)$")
+    assert scanner.scan() == {(tmp_path / "missing", r"^gcc-([0-9]+)$"): {}}
+
+
+def test_scan_cache_hits_until_directory_changes(search_dir, tmp_path, monkeypatch):
+    cache_path = tmp_path / "scan-cache.json"
+    pattern = r"^gcc-([0-9]+)$"
+    cache = manage.ScanCache(cache_path)
+    scanner = manage.DirectoryScanner(cache)
+    scanner.add(str(search_dir), pattern)
+    first = scanner.scan()
+    cache.save()
+
+    # A fresh cache read from disk answers without listing the directory.
+    calls = []
+    scan_directory = manage.DirectoryScanner.scan_directory
+
+    def counted(*args):
+        calls.append(args)
+        return scan_directory(*args)
+    monkeypatch.setattr(manage.DirectoryScanner, "scan_directory", staticmethod(counted))
+    scanner = manage.DirectoryScanner(manage.ScanCache(cache_path))
+    scanner.add(str(search_dir), pattern)
+    assert scanner.scan() == first
+    assert not len(calls)
+
+    # Adding an entry changes the directory's mtime, invalidating the entry.
+    (search_dir / "gcc-14").touch()
+    st = os.stat(search_dir)
+    os.utime(search_dir, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    scanner = manage.DirectoryScanner(manage.ScanCache(cache_path))
+    scanner.add(str(search_dir), pattern)
+    assert versions(scanner.scan(), search_dir, pattern) == ["12", "13", "14"]
+    assert len(calls) == 1
+
+
+def test_scan_cache_misses_for_new_patterns(search_dir, tmp_path):
+    cache = manage.ScanCache(tmp_path / "scan-cache.json")
+    key = manage.ScanCache.directory_key(search_dir)
+    cache.put(search_dir, key, manage.DirectoryScanner.scan_directory(search_dir, [r"^gcc-([0-9]+)$"]))
+    assert cache.get(search_dir, key, [r"^gcc-([0-9]+)$"]) is not None
+    assert cache.get(search_dir, key, [r"^gcc-([0-9]+)$", r"^gfortran-([0-9]+)$"]) is None
+    assert cache.get(search_dir, [0, 0, 0], [r"^gcc-([0-9]+)$"]) is None
+
+
+def test_failed_probes_are_cached_until_the_binary_changes(tmp_path):
+    runs = tmp_path / "runs"
+    binary = tmp_path / "nvcc"
+    binary.write_text(f"#!/bin/sh\necho run >> {runs}\nexit 1\n")
+    binary.chmod(0o755)
+
+    def probe():
+        prober = manage.VersionProber(manage.ProbeCache(tmp_path / "probe-cache.json"))
+        try:
+            return prober.probe([binary, "--version"]).result()
+        finally:
+            prober.close()
+            prober.cache.save()
+
+    assert probe() is None
+    assert probe() is None
+    assert runs.read_text().count("run") == 1
+
+    binary.write_text(f"#!/bin/sh\necho run >> {runs}\necho 'release 12.4'\n")
+    assert probe() == "release 12.4\n"
+    assert probe() == "release 12.4\n"
+    assert runs.read_text().count("run") == 2
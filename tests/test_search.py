@@ -0,0 +1,46 @@
+import manage
+
+
+def module(name, whatis="", family=None):
+    application, version = name.rsplit("/", 1)
+    return manage.search_index_module(name, name, application, version, family, whatis)
+
+
+def results(index, query):
+    return [name for name, entry in index.search(query)]
+
+
+def test_updates_match_a_full_rebuild(tmp_path):
+    modules = [module(f"app{i}/{v}", f"Application {i}", "compiler" if i % 2 else None) for i in range(20) for v in ("1.0", "2.0")]
+    index = manage.SearchIndex(tmp_path / "index.json")
+    index.rebuild(modules[:30])
+
+    index = manage.SearchIndex(tmp_path / "index.json")
+    index.update(modules[30:] + [module("app0/1.0", "Changed whatis")], removed=["app1/1.0", "app2/2.0"])
+    expected = [m for m in modules if m["name"] not in ("app0/1.0", "app1/1.0", "app2/2.0")] + [module("app0/1.0", "Changed whatis")]
+    rebuilt = manage.SearchIndex(tmp_path / "rebuilt.json")
+    rebuilt.rebuild(expected)
+
+    index = manage.SearchIndex(tmp_path / "index.json")
+    assert index.entries == rebuilt.entries
+    for query in ("app1", "application 1", "changed", "compiler 2.0", "aplication", "1.0"):
+        assert results(index, query) == results(rebuilt, query)
+
+
+def test_unchanged_updates_are_not_written(tmp_path, monkeypatch):
+    index = manage.SearchIndex(tmp_path / "index.json")
+    index.rebuild([module("gcc/12"), module("gcc/13")])
+    writes = []
+    monkeypatch.setattr(index, "write", lambda: writes.append(True))
+    index.update([module("gcc/12")], removed=["gcc/11"])
+    assert writes == []
+    index.update([module("gcc/14")])
+    assert writes == [True]
+
+
+def test_holes_are_compacted(tmp_path):
+    index = manage.SearchIndex(tmp_path / "index.json")
+    index.rebuild([module(f"gcc/{v}") for v in range(10)])
+    index.update(removed=[f"gcc/{v}" for v in range(8)])
+    assert index.names == ["gcc/8", "gcc/9"]
+    assert results(index, "gcc") == ["gcc/8", "gcc/9"]
@@ -0,0 +1,63 @@
+import copy
+import os
+
+import manage
+
+
+def found(applications):
+    definitions = copy.deepcopy(applications)
+    manage.find_applications(definitions)
+    return definitions
+
+
+def links(directory):
+    return sorted(str(path.relative_to(directory)) for path in directory.rglob("*") if path.is_symlink())
+
+
+def test_dry_run_plans_without_changing(applications, compiler_bin, tmp_path):
+    symlinks = tmp_path / "symlinks"
+    plan, messages = manage.create_application_symlinks("cc", found(applications)["cc"], symlinks, dry_run=True)
+    assert sorted(str(link.relative_to(symlinks)) for link, source in plan.create) == ["cc/11/cc", "cc/12/cc", "cc/13/cc"]
+    assert dict(plan.create)[symlinks / "cc" / "12" / "cc"] == (compiler_bin / "cc-12").resolve()
+    assert [str(d.relative_to(symlinks)) for d in plan.directories] == ["cc", "cc/11", "cc/12", "cc/13"]
+    assert not symlinks.exists()
+
+
+def test_reconcile(applications, compiler_bin, tmp_path):
+    symlinks = tmp_path / "symlinks"
+    # As create_symlinks does.
+    symlinks.mkdir()
+    manage.create_application_symlinks("cc", found(applications)["cc"], symlinks)
+    assert links(symlinks) == ["cc/11/cc", "cc/12/cc", "cc/13/cc"]
+
+    # A removed install, and a link pointing at the wrong source.
+    (compiler_bin / "cc-11").unlink()
+    os.unlink(symlinks / "cc" / "12" / "cc")
+    os.symlink(compiler_bin / "cc-13", symlinks / "cc" / "12" / "cc")
+    plan, messages = manage.create_application_symlinks("cc", found(applications)["cc"], symlinks, dry_run=True)
+    assert plan.remove == [symlinks / "cc" / "11" / "cc"]
+    assert [(link, current) for link, current, source in plan.retarget] == [(symlinks / "cc" / "12" / "cc", str(compiler_bin / "cc-13"))]
+    assert plan.unchanged == 1
+    assert not len(plan.create)
+    # Nothing changed for the dry run.
+    assert links(symlinks) == ["cc/11/cc", "cc/12/cc", "cc/13/cc"]
+    assert os.readlink(symlinks / "cc" / "12" / "cc") == str(compiler_bin / "cc-13")
+
+    manage.create_application_symlinks("cc", found(applications)["cc"], symlinks)
+    assert links(symlinks) == ["cc/12/cc", "cc/13/cc"]
+    assert os.readlink(symlinks / "cc" / "12" / "cc") == str((compiler_bin / "cc-12").resolve())
+    # The directory emptied by the removal is pruned.
+    assert not (symlinks / "cc" / "11").exists()
+
+    plan, messages = manage.create_application_symlinks("cc", found(applications)["cc"], symlinks)
+    assert not len(plan)
+    assert plan.unchanged == 2
+
+
+def test_files_in_the_way_are_left_alone(applications, tmp_path):
+    symlinks = tmp_path / "symlinks"
+    (symlinks / "cc" / "12").mkdir(parents=True)
+    (symlinks / "cc" / "12" / "cc").write_text("not a link")
+    plan, messages = manage.create_application_symlinks("cc", found(applications)["cc"], symlinks)
+    assert (symlinks / "cc" / "12" / "cc").read_text() == "not a link"
+    assert any("is not a symlink" in message for message in messages)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark manage.py against synthetic application and modulefile trees.
+
+Builds, in a temporary directory:
++ N applications x M versions x K binaries, in a shared bin directory (like /usr/bin) and per-version install directories (like /usr/local/cuda-X)
++ A deep hierarchy of groups holding a large number of modulefiles
+
+and points a ModulefileManager at them, reporting the wall time and filesystem operation counts of each operation so regressions show up.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import pathlib
+import sys
+import tempfile
+import time
+
+import manage
+
+
+class Benchmark:
+
+    def __init__(self, root, verbose=False):
+        self.root = pathlib.Path(root)
+        self.verbose = verbose
+        self.results = []
+
+    @contextlib.contextmanager
+    def measure(self, operation):
+        # Time the operation and count its filesystem calls, discarding anything it prints.
+        counter = manage.FilesystemCounter()
+        output = io.StringIO() if not self.verbose else sys.stdout
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(output), counter:
+            yield
+        elapsed = time.perf_counter() - start
+        self.results.append({"operation": operation, "seconds": elapsed, "counts": counter.counts})
+
+    def build_installs(self, apps, versions, binaries):
+        # Returns applications definitions in the same form as manage.default_applications()
+        bin_dir = pathlib.Path(self.root, "installs", "bin")
+        opt_dir = pathlib.Path(self.root, "installs", "opt")
+        bin_dir.mkdir(parents=True)
+        opt_dir.mkdir(parents=True)
+
+        applications = {}
+        for a in range(apps):
+            appname = f"app{a}"
+            dependencies = [
+                {
+                    "name": appname,
+                    "search_dir": str(opt_dir),
+                    "pattern": rf"^{appname}-([0-9]+\.[0-9]+)$",
+                    "symlink_required": False,
+                }
+            ]
+            for k in range(binaries):
+                dependencies.append({
+                    "name": f"tool{k}",
+                    "search_dir": str(bin_dir),
+                    "pattern": rf"^{appname}-tool{k}-([0-9]+\.[0-9]+)$",
+                    "symlink_required": True,
+                    "optional": k > 0,
+                })
+            for v in range(versions):
+                version = f"{v}.0"
+                pathlib.Path(opt_dir, f"{appname}-{version}", "lib").mkdir(parents=True)
+                for k in range(binaries):
+                    pathlib.Path(bin_dir, f"{appname}-tool{k}-{version}").touch()
+
+            applications[appname] = {
+                "versions": None,
+                "modulefile": {
+                    "required": True,
+                    "whatis": f"Synthetic application {a}",
+                    "family": appname,
+                    "prepend-path": [
+                        ("PATH", "{symlink_dir}"),
+                        ("LD_LIBRARY_PATH", str(opt_dir) + f"/{appname}-{{version}}/lib"),
+                    ],
+                    "setenv": [
+                        (f"APP{a}_ROOT", str(opt_dir) + f"/{appname}-{{version}}"),
+                    ]
+                },
+                "dependencies": dependencies,
+                "symlink_dirs": {}
+            }
+        return applications
+
+    def build_registry(self, registry_root, applications):
+        # One JSON definition file per application, as in the applications directory.
+        registry_root.mkdir(parents=True)
+        for appname, obj in applications.items():
+            definition = {key: obj[key] for key in ("modulefile", "dependencies")}
+            with open(pathlib.Path(registry_root, f"{appname}.json"), "w") as fp:
+                json.dump({appname: definition}, fp)
+
+    def build_modulefiles(self, available_root, count, depth, fanout):
+        # Spread count modulefiles over fanout^(depth - 1) leaf groups, i.e. g3/g1/g4/12
+        groups = fanout ** max(depth - 1, 0)
+        per_group = max(1, -(-count // groups))
+        for i in range(count):
+            group = i // per_group
+            components = []
+            for level in range(depth - 1):
+                components.append(f"g{group % fanout}")
+                group //= fanout
+            directory = pathlib.Path(available_root, *reversed(components))
+            if i % per_group == 0:
+                directory.mkdir(parents=True, exist_ok=True)
+            with open(pathlib.Path(directory, str(i % per_group)), "w") as fp:
+                fp.write(manage.generate_modulefile_string(str(directory.name), None, str(i % per_group), "Synthetic module"))
+
+    def run(self, apps, versions, binaries, modulefiles, depth, fanout, jobs):
+        # Applications: scanning, symlinks and modulefiles individually, then the full generate pipeline cold and warm.
+        applications = self.build_installs(apps, versions, binaries)
+        app_root = pathlib.Path(self.root, "apps")
+        app_root.mkdir()
+
+        registry_root = pathlib.Path(self.root, "registry")
+        registry_cache = pathlib.Path(self.root, "registry.json")
+        self.build_registry(registry_root, applications)
+        with self.measure("load_applications (cold)"):
+            manage.load_applications(registry_root, registry_cache)
+        with self.measure("load_applications (warm)"):
+            manage.load_applications(registry_root, registry_cache)
+
+        definitions = manage.copy.deepcopy(applications)
+        with self.measure("find_applications"):
+            manage.find_applications(definitions)
+        with self.measure("create_symlinks"):
+            manage.create_symlinks(definitions, pathlib.Path(app_root, "symlinks"))
+        with self.measure("create_modulefiles"):
+            manage.create_modulefiles(definitions, modulefiles_root=pathlib.Path(app_root, "available"))
+        with self.measure("clean_symlinks"):
+            manage.clean_symlinks(pathlib.Path(app_root, "symlinks"))
+
+        generate_root = pathlib.Path(self.root, "generate")
+        manager = manage.ModulefileManager(root=generate_root, applications=applications, spider_cache=False, jobs=jobs)
+        with self.measure("generate (cold)"):
+            manager.generate()
+        with self.measure("generate (warm)"):
+            manager.generate()
+        with self.measure("search"):
+            manager.search("synthetic application 1")
+        with self.measure("search (fuzzy)"):
+            manager.search("synthtic")
+        # Uninstall the oldest version of each application, leaving its modulefiles and symlinks stale.
+        installs = pathlib.Path(self.root, "installs")
+        for a in range(apps):
+            manage.shutil.rmtree(pathlib.Path(installs, "opt", f"app{a}-0.0"))
+            for k in range(binaries):
+                pathlib.Path(installs, "bin", f"app{a}-tool{k}-0.0").unlink()
+        with self.measure("prune"):
+            manager.prune()
+
+        # Modulefile trees: loading and querying, then deploying and withdrawing groups.
+        tree_root = pathlib.Path(self.root, "tree")
+        available_root = pathlib.Path(tree_root, "available")
+        self.build_modulefiles(available_root, modulefiles, depth, fanout)
+
+        with self.measure("ModulefileDirectory load"):
+            available = manage.ModulefileDirectory(available_root)
+        names = available.modulefiles()
+        sample = names[::max(1, len(names) // 1000)]
+        with self.measure(f"ModulefileDirectory contains x{len(sample)}"):
+            for name in sample:
+                name in available
+        with self.measure(f"ModulefileDirectory is_group x{len(sample)}"):
+            for name in sample:
+                available.is_group(name.parent)
+        with self.measure("ModulefileDirectory modulefiles(group)"):
+            available.modulefiles("g0")
+        half = manage.ModulefileDirectory(available_root, modulefiles=names[::2])
+        with self.measure("ModulefileDirectory difference"):
+            available - half
+
+        manager = manage.ModulefileManager(root=tree_root, spider_cache=False)
+        with self.measure("manifest load (cold)"):
+            manager.find_available()
+        with self.measure("manifest load (warm)"):
+            manager.find_available()
+        with self.measure("deploy group g0"):
+            manager.deploy("g0")
+        with self.measure("withdraw group g0"):
+            manager.withdraw("g0")
+        manager.deploy("g1")
+        with self.measure("withdraw_all"):
+            manager.withdraw_all()
+
+        return self.results
+
+
+def print_results(results, parameters):
+    print(", ".join(f"{k}={v}" for k, v in parameters.items()))
+    names = sorted({name for result in results for name in result["counts"]})
+    op_width = max(len(result["operation"]) for result in results)
+    header = f"{'operation': <{op_width}}  {'seconds': >9}" + "".join(f"  {name: >8}" for name in names)
+    print(header)
+    for result in results:
+        counts = "".join(f"  {result['counts'].get(name, 0): >8}" for name in names)
+        print(f"{result['operation']: <{op_width}}  {result['seconds']: >9.4f}{counts}")
+
+
+def parse_cli():
+    parser = argparse.ArgumentParser(
+        description="Benchmark module generation and management against synthetic trees"
+        )
+    parser.add_argument("--apps", type=int, default=20, help="Number of synthetic applications")
+    parser.add_argument("--versions", type=int, default=10, help="Versions of each application")
+    parser.add_argument("--binaries", type=int, default=5, help="Binaries per application version")
+    parser.add_argument("--modulefiles", type=int, default=100000, help="Modulefiles in the synthetic modulefile tree")
+    parser.add_argument("--depth", type=int, default=4, help="Depth of the synthetic modulefile tree")
+    parser.add_argument("--fanout", type=int, default=10, help="Groups per level of the synthetic modulefile tree")
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="Concurrent tasks when generating")
+    parser.add_argument("--json", action="store_true", help="Output results as JSON")
+    parser.add_argument("--keep", action="store_true", help="Keep the synthetic trees rather than deleting them")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show output from the benchmarked operations")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_cli()
+    parameters = {
+        "apps": args.apps,
+        "versions": args.versions,
+        "binaries": args.binaries,
+        "modulefiles": args.modulefiles,
+        "depth": args.depth,
+        "fanout": args.fanout,
+        "jobs": args.jobs,
+    }
+
+    tmpdir = tempfile.mkdtemp(prefix="lmod-modules-benchmark-")
+    try:
+        results = Benchmark(tmpdir, args.verbose).run(**parameters)
+    finally:
+        if args.keep:
+            print(f"Synthetic trees kept in {tmpdir}", file=sys.stderr)
+        else:
+            manage.shutil.rmtree(tmpdir)
+
+    if args.json:
+        print(json.dumps({"parameters": parameters, "results": results}, indent=2))
+    else:
+        print_results(results, parameters)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,21 +4,542 @@
 Python script to generate module files and symlinks and manage which module files are available or in use. 
 
 @todo - support deploying / withdrawing module trees - i.e dev/gcc to deploy all gcc moduels
-@todo - add module deployment dependency support. I.e. dev/gcc-7 can only be deployed if the relevant binary files exist. This will require reading into the module files to be automatic, otherwise explicit rules might need adding, which duplicate some of the modulefile contents. --auto would also remove broken modules.
 # @todo - better use of classes
 # @todo - pytest
-# @todo - split out applications data structure into a config file or directory of config files
 """
 
 import argparse
+import bisect
+import builtins
+import concurrent.futures
+import copy
+import functools
+import heapq
+import cProfile
+import contextlib
+import ctypes
+import ctypes.util
+import fcntl
+import hashlib
+import json
+import operator
 import pathlib
+import pstats
+import io
 import os
+import posixpath
 import re
+import select
 import shutil
+import socket
+import sqlite3
+import stat
+import string
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import urllib.parse
+
+try:
+    import tomllib
+except ImportError:
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
 
 PYMODULE_DIR = pathlib.Path(__file__).parent
 SYMLINKS_DIR = pathlib.Path(PYMODULE_DIR, "..", "symlinks").resolve()
 MODULEFILES_DIR = pathlib.Path(PYMODULE_DIR, "..", "available").resolve()
+CACHE_DIR = pathlib.Path(PYMODULE_DIR, "..", ".cache").resolve()
+SCAN_CACHE_FILE = pathlib.Path(CACHE_DIR, "scan-cache.json")
+PROBE_CACHE_FILE = pathlib.Path(CACHE_DIR, "probe-cache.json")
+SEARCH_INDEX_FILE = pathlib.Path(CACHE_DIR, "search-index.json")
+MANIFEST_FILE = pathlib.Path(CACHE_DIR, "manifest.sqlite")
+# Application definitions, and the cache of their validated form
+APPLICATIONS_DIR = pathlib.Path(PYMODULE_DIR, "..", "applications").resolve()
+REGISTRY_CACHE_FILE = pathlib.Path(CACHE_DIR, "registry.json")
+# Bumped whenever the cached records change shape
+REGISTRY_CACHE_VERSION = 5
+# Seconds a version probe may run before it is abandoned.
+PROBE_TIMEOUT = 10.0
+# Modules built with a compiler live in per-compiler subtrees of this directory, i.e. .Compiler/gcc/12/openmpi/4.1, which a compiler's module adds to MODULEPATH. It is hidden so Lmod doesn't list them with the core modules.
+COMPILER_HIERARCHY_DIR = ".Compiler"
+# Names the default version within a modulefile directory
+VERSION_MARKER = ".version"
+# Paths checked per task when checking modulefile dependencies
+DEPENDENCY_CHECK_BATCH = 32
+
+class FilesystemCounter:
+    """
+    Count filesystem calls made through the os module (and builtins.open for writes) while active, passing the name of each operation to a callback.
+
+    pathlib, os.walk and shutil all go through these functions, so this sees every call the tools make.
+    """
+
+    # Counter name for each wrapped os function.
+    OS_FUNCTIONS = {
+        "listdir": "readdir",
+        "scandir": "readdir",
+        "stat": "stat",
+        "lstat": "lstat",
+        "mkdir": "mkdir",
+        "symlink": "symlink",
+        "readlink": "readlink",
+        "unlink": "unlink",
+        "remove": "unlink",
+        "rmdir": "rmdir",
+        "rename": "rename",
+        "replace": "rename",
+    }
+
+    def __init__(self, callback=None):
+        self.counts = {}
+        self.callback = callback if callback is not None else self.count
+        self._originals = {}
+
+    def count(self, name):
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def _wrap(self, name, function):
+        def wrapper(*args, **kwargs):
+            # stat(follow_symlinks=False) is an lstat, as used by pathlib.Path.is_symlink
+            if name == "stat" and kwargs.get("follow_symlinks") is False:
+                self.callback("lstat")
+            else:
+                self.callback(name)
+            return function(*args, **kwargs)
+        return wrapper
+
+    def _wrap_os_open(self, function):
+        def wrapper(path, flags, *args, **kwargs):
+            if flags & (os.O_WRONLY | os.O_RDWR):
+                self.callback("write")
+            return function(path, flags, *args, **kwargs)
+        return wrapper
+
+    def _wrap_open(self, function):
+        def wrapper(file, mode="r", *args, **kwargs):
+            if any(c in mode for c in "wax+"):
+                self.callback("write")
+            return function(file, mode, *args, **kwargs)
+        return wrapper
+
+    def __enter__(self):
+        for function, name in self.OS_FUNCTIONS.items():
+            self._originals[(os, function)] = getattr(os, function)
+            setattr(os, function, self._wrap(name, getattr(os, function)))
+        self._originals[(os, "open")] = os.open
+        os.open = self._wrap_os_open(os.open)
+        self._originals[(builtins, "open")] = builtins.open
+        builtins.open = self._wrap_open(builtins.open)
+        return self
+
+    def __exit__(self, *exc):
+        for (module, function), original in self._originals.items():
+            setattr(module, function, original)
+        self._originals = {}
+        return False
+
+
+class Profiler:
+    """
+    Wall time per phase and filesystem operation counters, broken down by application.
+
+    Phases may nest (i.e. withdraw cleanup within withdraw), so phase times are inclusive. Phases running concurrently on the generate thread pool each count their own wall time. Counters are attributed to the application of the innermost active phase on the calling thread.
+    """
+
+    class Phase:
+        __slots__ = ("profiler", "name", "app", "previous", "start")
+
+        def __init__(self, profiler, name, app):
+            self.profiler = profiler
+            self.name = name
+            self.app = app
+
+        def __enter__(self):
+            local = self.profiler._local
+            self.previous = getattr(local, "app", None)
+            if self.app is not None:
+                local.app = self.app
+            self.start = time.perf_counter()
+            return self
+
+        def __exit__(self, *exc):
+            elapsed = time.perf_counter() - self.start
+            self.profiler._local.app = self.previous
+            app = self.app if self.app is not None else self.previous
+            self.profiler.add_time(self.name, app, elapsed)
+            return False
+
+    class NullPhase:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+    NULL_PHASE = NullPhase()
+
+    def __init__(self):
+        self.enabled = False
+        self.wall = 0.0
+        self.phases = {}
+        self.counts = {}
+        self.cprofile = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._counter = None
+        self._start = None
+
+    def phase(self, name, app=None):
+        if not self.enabled:
+            return self.NULL_PHASE
+        return self.Phase(self, name, None if app is None else str(app))
+
+    def add_time(self, name, app, elapsed):
+        with self._lock:
+            phase = self.phases.setdefault(name, {"seconds": 0.0, "calls": 0, "applications": {}})
+            phase["seconds"] += elapsed
+            phase["calls"] += 1
+            if app is not None:
+                phase["applications"][app] = phase["applications"].get(app, 0.0) + elapsed
+
+    def count(self, operation):
+        app = getattr(self._local, "app", None)
+        with self._lock:
+            counts = self.counts.setdefault(app, {})
+            counts[operation] = counts.get(operation, 0) + 1
+
+    def start(self, cprofile=False):
+        self.enabled = True
+        self._counter = FilesystemCounter(self.count).__enter__()
+        if cprofile:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        self._start = time.perf_counter()
+
+    def stop(self):
+        if not self.enabled:
+            return
+        self.wall = time.perf_counter() - self._start
+        if self.cprofile is not None:
+            self.cprofile.disable()
+        self._counter.__exit__(None, None, None)
+        self.enabled = False
+
+    def totals(self):
+        totals = {}
+        for counts in self.counts.values():
+            for operation, n in counts.items():
+                totals[operation] = totals.get(operation, 0) + n
+        return totals
+
+    def report(self, report_format="text", cprofile_path=None, top=20):
+        if self.cprofile is not None and cprofile_path is not None:
+            self.cprofile.dump_stats(cprofile_path)
+
+        if report_format == "json":
+            report = {
+                "wall_seconds": self.wall,
+                "phases": self.phases,
+                "operations": self.totals(),
+                "applications": {("" if app is None else app): counts for app, counts in self.counts.items()},
+            }
+            return json.dumps(report, indent=2, sort_keys=True)
+
+        lines = [f"Profile: {self.wall:.4f}s wall"]
+        lines.append("Phases (inclusive seconds, calls):")
+        for name, phase in sorted(self.phases.items(), key=lambda item: -item[1]["seconds"]):
+            lines.append(f"  {name: <20} {phase['seconds']: >10.4f} {phase['calls']: >8}")
+        operations = sorted(self.totals())
+        if len(operations):
+            width = max([len("application")] + [len(str(app)) for app in self.counts if app is not None] + [len("(other)")])
+            lines.append("Filesystem operations:")
+            lines.append(f"  {'application': <{width}}" + "".join(f" {op: >8}" for op in operations))
+            rows = sorted(self.counts.items(), key=lambda item: (item[0] is None, item[0] or ""))
+            for app, counts in rows + [("total", self.totals())]:
+                label = "(other)" if app is None else app
+                lines.append(f"  {label: <{width}}" + "".join(f" {counts.get(op, 0): >8}" for op in operations))
+        if self.cprofile is not None:
+            lines.append("Hottest functions (cumulative, main thread only):")
+            stream = io.StringIO()
+            pstats.Stats(self.cprofile, stream=stream).sort_stats("cumulative").print_stats(top)
+            lines.append(stream.getvalue().rstrip())
+        return "\n".join(lines)
+
+
+# Profiling for the current invocation, which is a no-op unless started.
+PROFILER = Profiler()
+
+def profile_phase(name, by_module=False):
+    # Decorator timing a method as a profiler phase. If by_module, the first argument is a module path whose first component names the application.
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(self, *args, **kwargs):
+            app = None
+            if by_module and len(args) and len(pathlib.PurePath(args[0]).parts):
+                app = pathlib.PurePath(args[0]).parts[0]
+            with PROFILER.phase(name, app):
+                return function(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+class OutputStream:
+    """
+    Listings and reports, either as lines of text or as records for other tools to consume.
+
+    Records are written as they are produced rather than collected first: one JSON object per line for ndjson, or a single JSON array for json. Entry records describe one module, modulefile or symlink, with its state (available, deployed, symlink or stale) and path. Count records summarise a section. If quiet, only counts are written.
+    """
+
+    FORMATS = ("text", "json", "ndjson")
+
+    def __init__(self, output_format="text", quiet=False, stream=None):
+        self.configure(output_format, quiet, stream)
+
+    def configure(self, output_format="text", quiet=False, stream=None):
+        if output_format not in self.FORMATS:
+            raise Exception(f"Unknown output format {output_format}")
+        self.format = output_format
+        self.quiet = quiet
+        # If not given, whatever stdout currently is.
+        self._stream = stream
+        self.records = 0
+
+    @property
+    def stream(self):
+        return self._stream if self._stream is not None else sys.stdout
+
+    @property
+    def streaming(self):
+        # Whether entries are records, which are written as they are produced, rather than text grouped under its counts.
+        return self.format != "text" and not self.quiet
+
+    def record(self, record, text=None):
+        # The line of text, if any, or the record.
+        if self.format == "text":
+            if text is not None:
+                print(text, file=self.stream)
+            return
+        line = json.dumps(record, default=str)
+        if self.format == "ndjson":
+            self.stream.write(line + "\n")
+        else:
+            self.stream.write(("[\n" if self.records == 0 else ",\n") + line)
+        self.records += 1
+
+    def entry(self, state, name=None, path=None, text=None, **fields):
+        if self.quiet:
+            return
+        record = {"type": "entry", "state": state}
+        if name is not None:
+            record["name"] = pathlib.PurePath(name).as_posix()
+        if path is not None:
+            record["path"] = str(path)
+        record.update(fields)
+        self.record(record, text)
+
+    def count(self, section, text=None, **counts):
+        record = {"type": "count", "section": section}
+        record.update(counts)
+        self.record(record, text)
+
+    def close(self):
+        # Terminate the json array, which is empty if nothing was written.
+        if self.format == "json":
+            self.stream.write("[]\n" if self.records == 0 else "\n]\n")
+            self.records = 0
+        self.stream.flush()
+
+
+# Listing and report output for the current invocation, as text unless configured otherwise.
+OUTPUT = OutputStream()
+
+# Supported modulefile formats, and the filename suffix Lmod uses to tell them apart.
+MODULEFILE_FORMATS = {
+    "tcl": "",
+    "lua": ".lua",
+}
+
+def modulefile_name(path):
+    # The module name for a modulefile path, i.e. without any .lua suffix.
+    path = pathlib.PurePath(path)
+    if path.suffix == ".lua":
+        return path.with_suffix("")
+    return path
+
+VERSION_CONSTRAINT = re.compile(r"^(>=|<=|==|!=|>|<)?\s*([^\s<>=!]+)$")
+VERSION_OPERATORS = {">=": operator.ge, "<=": operator.le, "==": operator.eq, "!=": operator.ne, ">": operator.gt, "<": operator.lt}
+
+def parse_version_constraint(constraint):
+    # i.e. ">=12.0,<13" as (comparison, parsed version) pairs which must all hold. A bare version must match exactly.
+    comparisons = []
+    for term in constraint.split(","):
+        result = VERSION_CONSTRAINT.match(term.strip())
+        if result is None:
+            raise Exception(f"Invalid version constraint {constraint}")
+        comparisons.append((VERSION_OPERATORS[result.group(1) if result.group(1) else "=="], lmod_parse_version(result.group(2))))
+    return comparisons
+
+
+def normalise_path(value):
+    # As str(pathlib.Path(value).expanduser()), without constructing a path for the usual values it wouldn't change.
+    if value and value[0] != "~" and "//" not in value and value[-1] != "/" and "/./" not in value and not value.startswith("./") and not value.endswith("/.") and value != ".":
+        return value
+    return str(pathlib.Path(value).expanduser())
+
+
+def lua_path_string(value):
+    return lua_string(normalise_path(value))
+
+
+def tcl_quote(value):
+    # Escape a value for a double quoted Tcl string.
+    return re.sub(r'([\\"$\[\]])', r"\\\1", value)
+
+
+def escape_format(value):
+    return str(value).replace("{", "{{").replace("}", "}}")
+
+
+class ModulefileTemplate:
+    """
+    An application's modulefile spec, compiled once and then rendered for each of its versions.
+
+    Each value is split into its literal text and the format fields it uses, so rendering joins pieces rather than parsing a format string, and paths only go through pathlib if they need normalising. Lines without fields, ~ expansion included, are rendered when compiled. Conditional blocks (when) add lines to versions matching a version constraint and/or variable values.
+    """
+
+    def __init__(self, appname, options, modulefile_format="tcl", normalise_paths=True):
+        if modulefile_format not in MODULEFILE_FORMATS:
+            raise Exception(f"Unknown modulefile format {modulefile_format} for {appname}")
+        self.appname = appname
+        self.lua = modulefile_format == "lua"
+        self.normalise_paths = normalise_paths
+        # Variables used anywhere in the template, which every version must provide.
+        self.fields = set()
+        self.lines = self.compile_header(options) + self.compile_directives(options)
+        self.blocks = []
+        for block in (options["when"] if "when" in options else []):
+            comparisons = parse_version_constraint(block["version"]) if "version" in block and block["version"] is not None else []
+            conditions = block["variables"] if "variables" in block else {}
+            self.blocks.append((comparisons, conditions, self.compile_directives(block)))
+
+    def compile_value(self, value):
+        # (literals, fields), with a field between each pair of literals. Fields with format specs, conversions or indexing fall back to str.format, as (None, value).
+        literals = []
+        fields = []
+        literal = ""
+        simple = True
+        for text, field, spec, conversion in string.Formatter().parse(value):
+            literal += text
+            if field is None:
+                continue
+            if spec or conversion or not field.isidentifier():
+                simple = False
+                field = re.split(r"[.\[]", field)[0]
+            literals.append(literal)
+            fields.append(field)
+            literal = ""
+        literals.append(literal)
+        self.fields.update(fields)
+        if not simple:
+            return None, value
+        return literals, fields
+
+    def line(self, prefix, value, suffix="", transform=None):
+        # A line which uses no fields is rendered now, otherwise its parts are kept for rendering each version.
+        literals, fields = self.compile_value(value)
+        if literals is not None and not fields:
+            return prefix + (transform(literals[0]) if transform is not None else literals[0]) + suffix
+        return (prefix, literals, fields, suffix, transform)
+
+    def compile_header(self, options):
+        whatis = options["whatis"] if "whatis" in options else None
+        family = options["family"] if "family" in options else None
+        help_text = options["help"] if "help" in options else None
+        lines = []
+        if self.lua:
+            # Comment at the top, then declare the app name and version
+            lines.append(self.line(f"-- {self.appname} ", "{version}", " module"))
+            lines.append(f"local app = {lua_string(self.appname)}")
+            lines.append(self.line("local version = ", "{version}", transform=lua_string))
+            if whatis is not None:
+                lines.append(f"whatis({lua_string(whatis)})")
+            # Set the family name for conflicts.
+            if family is not None:
+                lines.append(f"family({lua_string(family)})")
+            if help_text is not None:
+                lines.append(self.line("help(", help_text, ")", lua_string))
+        else:
+            lines.append(self.line(f"# {self.appname} ", "{version}", " module"))
+            lines.append(f"set app {self.appname}")
+            lines.append(self.line("set version ", "{version}"))
+            if whatis is not None:
+                lines.append(f"module-whatis \"{whatis}\"")
+            if family is not None:
+                lines.append(f"family {family}")
+            if help_text is not None:
+                lines.append("proc ModulesHelp { } {")
+                for help_line in help_text.splitlines():
+                    lines.append(self.line("    puts stderr \"", help_line, "\"", tcl_quote))
+                lines.append("}")
+        return lines
+
+    def compile_directives(self, options):
+        # Conflicts, prerequisites, paths to prepend and environment variables to set, of the modulefile or a conditional block.
+        lines = []
+        for name in (options["conflict"] if "conflict" in options else []):
+            lines.append(self.line("conflict(", name, ")", lua_string) if self.lua else self.line("conflict ", name))
+        for name in (options["prereq"] if "prereq" in options else []):
+            lines.append(self.line("prereq(", name, ")", lua_string) if self.lua else self.line("prereq ", name))
+        for vname, vfmt in (options["prepend-path"] if "prepend-path" in options else []):
+            if self.lua:
+                lines.append(self.line(f"prepend_path({lua_string(vname)}, ", vfmt, ")", lua_path_string if self.normalise_paths else lua_string))
+            else:
+                lines.append(self.line(f"prepend-path {vname} ", vfmt, transform=normalise_path if self.normalise_paths else None))
+        for vname, vfmt in (options["setenv"] if "setenv" in options else []):
+            if self.lua:
+                lines.append(self.line(f"setenv({lua_string(vname)}, ", vfmt, ")", lua_string))
+            else:
+                lines.append(self.line(f"setenv {vname} ", vfmt))
+        return lines
+
+    @staticmethod
+    def render_line(line, variables):
+        if isinstance(line, str):
+            return line
+        prefix, literals, fields, suffix, transform = line
+        if literals is None:
+            value = fields.format(**variables)
+        else:
+            parts = [literals[0]]
+            for i, field in enumerate(fields):
+                parts.append(str(variables[field]))
+                parts.append(literals[i + 1])
+            value = "".join(parts)
+        return prefix + (transform(value) if transform is not None else value) + suffix
+
+    def render(self, variables):
+        lines = [self.render_line(line, variables) for line in self.lines]
+        if len(self.blocks):
+            parsed_version = lmod_parse_version(variables["version"])
+            for comparisons, conditions, block_lines in self.blocks:
+                if all(compare(parsed_version, bound) for compare, bound in comparisons) and all(name in variables and str(variables[name]) == value for name, value in conditions.items()):
+                    lines.extend(self.render_line(line, variables) for line in block_lines)
+        return "\n".join(lines)
+
+    def render_all(self, versions_variables):
+        # Render a batch of versions, given the variables of each.
+        for variables in versions_variables:
+            missing = self.fields.difference(variables)
+            if len(missing):
+                raise Exception(f"Unknown variables {', '.join(sorted(missing))} in the modulefile of {self.appname}")
+        return [self.render(variables) for variables in versions_variables]
+
 
 def generate_modulefile_string(
     appname,
@@ -26,452 +547,2163 @@ def generate_modulefile_string(
     version, 
     whatis, 
     prepend_vars = [], 
-    set_vars = []):
-
-
-    lines = []
-    # Comment at the top
-    lines.append(f"# {appname} {version} module")
-    # Declare the app name 
-    lines.append(f"set app {appname}")
-    # Declare the version
-    lines.append(f"set version {version}")
-    # Add the whatis string
-    if whatis is not None:
-        lines.append(f"module-whatis \"{whatis}\"")
-    # Set the family name for conflicts.
-    if family is not None:
-        lines.append(f"family {family}")
-
-    # For each passed in path, add it.
-    for vname, vval in prepend_vars:
-        lines.append(f"prepend-path {vname} {vval}")
-
-    # Set each environment variable
-    for vname, vval in set_vars:
-        lines.append(f"setenv {vname} {vval}")
-    
-    s = "\n".join(lines)
-    return s
+    set_vars = [],
+    modulefile_format = "tcl"):
+    # A single modulefile from concrete values, written as given, laid out as by the compiled templates.
+    options = {
+        "whatis": whatis,
+        "family": family,
+        "prepend-path": [(vname, escape_format(vval)) for vname, vval in prepend_vars],
+        "setenv": [(vname, escape_format(vval)) for vname, vval in set_vars],
+    }
+    return ModulefileTemplate(appname, options, modulefile_format, normalise_paths=False).render({"version": version})
 
 
 
-def find_versions(search_dir, pattern, optional=False):
-    search_path = pathlib.Path(search_dir).expanduser()
-    regex = re.compile(pattern)
+class ScanCache:
+    """
+    On-disk cache of directory scan results.
 
-    versions = {}
-    if search_path.is_dir():
-        for path in search_path.iterdir():
-            result = regex.match(path.name)
-            if result:
-                # print(path, pattern, result)
-                version = result.group(1)
-                # print(version)
-                path = path.resolve()
+    Entries are keyed by the search directory's (st_dev, st_ino, st_mtime_ns), so any entry being added, removed or renamed within the directory invalidates its results.
+    """
+
+    def __init__(self, path=SCAN_CACHE_FILE, refresh=False):
+        self.path = pathlib.Path(path)
+        self.entries = {} if refresh else self.load()
+        self.dirty = False
+        self._lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as fp:
+                entries = json.load(fp)
+            return entries if isinstance(entries, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        with self._lock:
+            if not self.dirty:
+                return
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_name(f".{self.path.name}.{os.getpid()}")
+            with open(tmp_path, "w") as fp:
+                json.dump(self.entries, fp)
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+
+    @staticmethod
+    def directory_key(search_path):
+        try:
+            st = os.stat(search_path)
+        except OSError:
+            return None
+        return [st.st_dev, st.st_ino, st.st_mtime_ns]
+
+    def get(self, search_path, key, patterns):
+        # Only a hit if the directory is unchanged and every requested pattern was recorded.
+        entry = self.entries.get(str(search_path))
+        if key is None or entry is None or entry["key"] != key:
+            return None
+        if any(pattern not in entry["patterns"] for pattern in patterns):
+            return None
+        found = {}
+        for pattern in patterns:
+            found[pattern] = {version: {"path": pathlib.Path(path), "version": version} for version, path in entry["patterns"][pattern].items()}
+        return found
+
+    def put(self, search_path, key, found):
+        if key is None:
+            return
+        entry = {
+            "key": key,
+            "patterns": {pattern: {version: str(v["path"]) for version, v in versions.items()} for pattern, versions in found.items()}
+        }
+        with self._lock:
+            self.entries[str(search_path)] = entry
+            self.dirty = True
+
+
+class DirectoryScanner:
+    """
+    Scan search directories for dependency versions, listing each directory only once.
+
+    Every pattern registered against a directory is combined into a single alternation, so each entry is tested with one regex match. Entries which hit the combined pattern are then checked against any later patterns, so overlapping patterns still all see every match.
+    """
+
+    def __init__(self, cache=None):
+        self._patterns = {}
+        self.cache = cache
+
+    @staticmethod
+    def key(search_dir, pattern):
+        return (pathlib.Path(search_dir).expanduser(), pattern)
+
+    def add(self, search_dir, pattern):
+        search_path, pattern = self.key(search_dir, pattern)
+        patterns = self._patterns.setdefault(search_path, [])
+        if pattern not in patterns:
+            patterns.append(pattern)
+        return (search_path, pattern)
+
+    def search_paths(self):
+        return list(self._patterns)
+
+    def scan(self):
+        # Returns a dictionary of versions for each (search_path, pattern) key.
+        results = {}
+        for search_path in self._patterns:
+            results.update(self.scan_path(search_path))
+        return results
+
+    def scan_path(self, search_path):
+        # Scan a single registered directory, returning versions for each of its (search_path, pattern) keys.
+        with PROFILER.phase("scan"):
+            return self._scan_path(search_path)
+
+    def _scan_path(self, search_path):
+        patterns = self._patterns[search_path]
+        found = None
+        if self.cache is not None:
+            # Take the key before listing, so changes made during the scan invalidate it.
+            key = ScanCache.directory_key(search_path)
+            found = self.cache.get(search_path, key, patterns)
+        if found is None:
+            found = self.scan_directory(search_path, patterns)
+            if self.cache is not None:
+                self.cache.put(search_path, key, found)
+        return {(search_path, pattern): versions for pattern, versions in found.items()}
+
+    @staticmethod
+    def scan_directory(search_path, patterns):
+        regexes = [re.compile(pattern) for pattern in patterns]
+        # Combine the patterns, noting which group holds the version for each. If they cannot be combined (i.e. inline flags, duplicate group names) fall back to matching each individually.
+        try:
+            combined = re.compile("|".join(f"(?P<_p{i}>{pattern})" for i, pattern in enumerate(patterns)))
+            wrappers = [combined.groupindex[f"_p{i}"] for i in range(len(patterns))]
+        except re.error:
+            combined = None
+
+        found = {pattern: {} for pattern in patterns}
+        if not search_path.is_dir():
+            return found
+
+        with os.scandir(search_path) as entries:
+            for entry in entries:
+                name = entry.name
+                first = 0
+                if combined is not None:
+                    result = combined.match(name)
+                    if result is None:
+                        continue
+                    first = next(i for i, group in enumerate(wrappers) if result.group(group) is not None)
+                    matches = [(first, result.group(wrappers[first] + 1))]
+                    first += 1
+                else:
+                    matches = []
+                for i in range(first, len(regexes)):
+                    result = regexes[i].match(name)
+                    if result:
+                        matches.append((i, result.group(1)))
+
+                if matches:
+                    path = pathlib.Path(entry.path).resolve()
+                    for i, version in matches:
+                        found[patterns[i]][version] = {"path": path, "version": version}
+        return found
+
+
+class ProbeCache(ScanCache):
+    """
+    On-disk cache of version probe output.
+
+    Entries are keyed by the probed binary's (st_dev, st_ino, st_size, st_mtime_ns, st_mode), so a probe is only run again once the binary is replaced, modified or its permissions change. Failed probes are cached as None, so a broken binary isn't run on every generate either.
+    """
+
+    def __init__(self, path=PROBE_CACHE_FILE, refresh=False):
+        super().__init__(path, refresh)
+
+    @staticmethod
+    def binary_key(binary):
+        try:
+            st = os.stat(binary)
+        except OSError:
+            return None
+        return [st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_mode]
+
+    def lookup(self, binary, key, command):
+        # Whether the command's output is cached, and the output, which is None if the probe failed.
+        entry = self.entries.get(str(binary))
+        if key is None or entry is None or entry["key"] != key or json.dumps(command) not in entry["outputs"]:
+            return False, None
+        return True, entry["outputs"][json.dumps(command)]
+
+    def store(self, binary, key, command, output):
+        if key is None:
+            return
+        with self._lock:
+            entry = self.entries.get(str(binary))
+            if entry is None or entry["key"] != key:
+                entry = {"key": key, "outputs": {}}
+                self.entries[str(binary)] = entry
+            entry["outputs"][json.dumps(command)] = output
+            self.dirty = True
+
+
+class VersionProber:
+    """
+    Run version probe commands (i.e. nvcc --version) concurrently, each with a timeout.
+
+    Each probe is its own subprocess, so a thread pool is enough to run them in parallel. Identical probes requested by several applications are only run once, and output, or failure, is cached by the binary's inode, size and mtime so unchanged toolchains are never executed again.
+    """
+
+    def __init__(self, cache=None, jobs=1):
+        self.cache = cache
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs))
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def close(self):
+        self._pool.shutdown()
+
+    def probe(self, command, timeout=PROBE_TIMEOUT):
+        # Returns a future of the command's output, or None if it could not be run.
+        command = [str(c) for c in command]
+        with self._lock:
+            future = self._futures.get(tuple(command))
+            if future is None:
+                future = self._pool.submit(self._probe, command, timeout)
+                self._futures[tuple(command)] = future
+        return future
+
+    def _probe(self, command, timeout):
+        binary = shutil.which(command[0])
+        if binary is None:
+            return None
+        key = None
+        if self.cache is not None:
+            key = ProbeCache.binary_key(binary)
+            found, output = self.cache.lookup(binary, key, command)
+            if found:
+                return output
+        with PROFILER.phase("probe"):
+            try:
+                result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, timeout=timeout, text=True)
+                output = result.stdout if result.returncode == 0 else None
+            except (OSError, subprocess.TimeoutExpired):
+                output = None
+        # Failures are cached too, so are only retried once the binary changes.
+        if self.cache is not None:
+            self.cache.store(binary, key, command, output)
+        return output
+
+
+def probe_application_versions(app, obj, prober):
+    """
+    Run the application's version probes for each of its versions, storing the results in obj["probed"][version] for use in modulefile templates.
 
-                versions[version] = {"path": path, "version": version}
+    A probe names a dependency, a command to run against it and a pattern whose first group is the value. The command may use {path}, the path found for the dependency, and {version}. If the probe fails, the value falls back to the version.
+    """
+    messages = []
+    obj["probed"] = {version: {} for version in obj["versions"]}
+    if "probes" not in obj:
+        return messages
+    pending = []
+    for probe in obj["probes"]:
+        dependency = next((d for d in obj["dependencies"] if d["name"] == probe["dependency"]), None)
+        if dependency is None:
+            raise Exception(f"Unknown dependency {probe['dependency']} for probe {probe['name']} of {app}")
+        for version in obj["versions"]:
+            if prober is None or version not in dependency["versions"]:
+                obj["probed"][version][probe["name"]] = version
+                continue
+            variables = {"path": dependency["versions"][version]["path"], "version": version}
+            command = [c.format(**variables) for c in probe["command"]]
+            command[0] = str(pathlib.Path(command[0]).expanduser())
+            timeout = probe["timeout"] if "timeout" in probe else PROBE_TIMEOUT
+            pending.append((probe, version, prober.probe(command, timeout)))
+    for probe, version, future in pending:
+        output = future.result()
+        result = re.search(probe["pattern"], output) if output is not None else None
+        if result is None:
+            messages.append(f"{app}: Probe {probe['name']} failed for {version}, using {version}")
+            obj["probed"][version][probe["name"]] = version
+        else:
+            obj["probed"][version][probe["name"]] = result.group(1)
+    return messages
+
+
+def find_versions(search_dir, pattern, optional=False, cache=None):
+    scanner = DirectoryScanner(cache)
+    key = scanner.add(search_dir, pattern)
+    return scanner.scan()[key]
 
-    return versions
 
+def unique_dependencies(dependencies):
+    # Collapse repeated dependency entries, keeping the first occurrence.
+    seen = set()
+    unique = []
+    for dependency in dependencies:
+        key = (dependency["name"], str(pathlib.Path(dependency["search_dir"]).expanduser()), dependency["pattern"])
+        if key not in seen:
+            seen.add(key)
+            unique.append(dependency)
+    return unique
 
 
-def find_applications(applications):
+def register_dependencies(scanner, applications):
+    # Register every dependency with the scanner, so each search directory is only listed once.
+    # Returns the search paths each application depends upon.
+    search_paths = {}
     for app, obj in applications.items():
-        common_versions = None
-        common_versions_optional = None
+        obj["dependencies"] = unique_dependencies(obj["dependencies"])
+        search_paths[app] = set()
         for dependency in obj["dependencies"]:
-            optional = dependency["optional"] if "optional" in dependency else False
-            versions = find_versions(
-                dependency["search_dir"],
-                dependency["pattern"],
-                optional
-            )
-            dependency["versions"] = versions
-            versions_set = set(versions.keys())
-            if not optional:
-                common_versions = common_versions.intersection(versions_set) if common_versions is not None else versions_set
-            else:
-                common_versions_optional = common_versions_optional.intersection(versions_set) if common_versions_optional is not None else versions_set
+            search_path, pattern = scanner.add(dependency["search_dir"], dependency["pattern"])
+            search_paths[app].add(search_path)
+    return search_paths
+
+
+def find_application_versions(app, obj, scanned):
+    common_versions = None
+    common_versions_optional = None
+    for dependency in obj["dependencies"]:
+        optional = dependency["optional"] if "optional" in dependency else False
+        versions = scanned[DirectoryScanner.key(dependency["search_dir"], dependency["pattern"])]
+        dependency["versions"] = versions
+        versions_set = set(versions.keys())
+        if not optional:
+            common_versions = common_versions.intersection(versions_set) if common_versions is not None else versions_set
+        else:
+            common_versions_optional = common_versions_optional.intersection(versions_set) if common_versions_optional is not None else versions_set
+
+    if common_versions is None:
+        common_versions = set()
+    if common_versions_optional is None:
+        common_versions_optional = set()
+
+    # Sorted oldest first by Lmod's version ordering, computed once here so later stages (and Lmod, via .version markers) never need to sort.
+    obj["versions"] = sorted(common_versions.union(common_versions_optional), key=lmod_parse_version)
+    # print(sorted(list(common_versions)))
+    # print(sorted(list(common_versions_optional)))
+    return obj
 
-        if common_versions is None:
-            common_versions = set()
-        if common_versions_optional is None:
-            common_versions_optional = set()
 
-        obj["versions"] =  common_versions.union( common_versions_optional)
-        # print(sorted(list(common_versions)))
-        # print(sorted(list(common_versions_optional)))
+def select_versions(obj):
+    """
+    The versions of an application to deploy under its deploy policy, and its default version.
+
+    A policy may keep only the newest keep versions, always keep the pinned versions, and name the default. Otherwise every version is deployed, and the newest is the default.
+    """
+    versions = list(obj["versions"])
+    policy = obj["deploy"] if "deploy" in obj else {}
+    selected = set(versions)
+    if "keep" in policy:
+        selected = set(versions[-policy["keep"]:])
+    if "pin" in policy:
+        selected |= set(policy["pin"]) & set(versions)
+    selected = [version for version in versions if version in selected]
+    default = policy["default"] if "default" in policy else None
+    if default not in selected:
+        default = selected[-1] if len(selected) else None
+    return selected, default
+
+
+def version_marker_string(default):
+    # Understood by both Lmod and Environment Modules, regardless of the modulefile format.
+    return f"#%Module\nset ModulesVersion \"{default}\"\n"
+
+
+def read_version_marker(path):
+    # The default version named by a .version marker, or None if there isn't one.
+    try:
+        with open(path, "r") as fp:
+            result = re.search(r'ModulesVersion\s+"([^"]*)"', fp.read())
+    except (OSError, UnicodeDecodeError):
+        return None
+    return result.group(1) if result is not None else None
+
+
+def find_applications(applications, cache=None):
+    scanner = DirectoryScanner(cache)
+    register_dependencies(scanner, applications)
+    scanned = scanner.scan()
+
+    for app, obj in applications.items():
+        find_application_versions(app, obj, scanned)
     return applications
 
 
-# @todo move this/rename
-def generate_modules():
+def resolve_applications(applications, cache=None):
+    # Find the versions of applications as generate would, without probing, linking or rendering anything. As when generating, applications built with compilers are replaced by their instances.
+    dependent = {app: obj for app, obj in applications.items() if "compilers" in obj and len(obj["compilers"])}
+    core = find_applications({app: obj for app, obj in applications.items() if app not in dependent}, cache)
+    if len(dependent):
+        applications.update(find_applications(expand_compiler_applications(dependent, core), cache))
+        for app in dependent:
+            del applications[app]
+    return applications
 
-    # Define the apps and files they depend on. Versions of dependencies must match!
-    # @todo version command to extract full version for modulefiles?
-    applications = {
-        "CUDA": {
-            "versions": None,
-            "modulefile": {
-                "required": True,
-                "whatis": "Adds CUDA compiler and library paths",
-                "family": "CUDA",
-                "prepend-path": [
-                    ("PATH", "/usr/local/cuda-{version}/bin"),
-                    ("LD_LIBRARY_PATH", "/usr/local/cuda-{version}/lib:"),
-                    ("LD_LIBRARY_PATH", "/usr/local/cuda-{version}/lib64:"),
-                ],
-                "setenv": [
-                    ("CUDA_PATH", "/usr/local/cuda-{version}")
-                ]
-            },
-            "dependencies": [
-                {
-                    "name": "cuda",
-                    "search_dir": "/usr/local",
-                    "pattern": r"^cuda-([0-9]+\.[0-9]+)$",
-                    "symlink_required": False,
-                }
-            ],
-            "symlink_dirs": {}
-        },
-        "nsight-systems": {
-            "versions": None,
-            "modulefile": {
-                "required": True,
-                "whatis": "Nsight Systems",
-                "family": "nsys",
-                "prepend-path": [
-                    ("PATH", "/opt/nvidia/nsight-systems/{version}/bin"),
-                ],
-                "setenv": [
-                ]
-            },
-            "dependencies": [
-                {
-                    "name": "nsys",
-                    "search_dir": "/opt/nvidia/nsight-systems/",
-                    "pattern": r"^([0-9]{4}\.[0-9]+\.[0-9]+)$",
-                    "symlink_required": False,
-                }
-            ],
-            "symlink_dirs": {}
-        },
-        "nsight-compute": {
-            "versions": None,
-            "modulefile": {
-                "required": True,
-                "whatis": "Nsight Compute",
-                "family": "ncu",
-                "prepend-path": [
-                    ("PATH", "/opt/nvidia/nsight-compute/{version}"),
-                ],
-                "setenv": [
-                ]
-            },
-            "dependencies": [
-                {
-                    "name": "ncu",
-                    "search_dir": "/opt/nvidia/nsight-compute/",
-                    "pattern": r"^([0-9]{4}\.[0-9]+\.[0-9]+)$",
-                    "symlink_required": False,
-                }
-            ],
-            "symlink_dirs": {}
-        },
-        "gcc": {
-            "versions": None,
-            "modulefile": {
-                "required": True,
-                "whatis": "Adds GCC toolchain to the path",
-                "family": "GCC",
-                "prepend-path": [
-                    ("PATH", "{symlink_dir}"),
-                ],
-                "setenv" : [
-                    ("CC", "gcc"),
-                    ("CXX", "g++"),
-                    ("CUDAHOSTCXX", "g++")
-                ]
-            },
-            "dependencies": [
-                {
-                    "name": "gcc",
-                    "search_dir": "/usr/bin",
-                    "pattern": r"^gcc-([0-9]+)$",
-                    "symlink_required": True,
-                },
-                {
-                    "name": "g++",
-                    "search_dir": "/usr/bin",
-                    "pattern": r"^g\+\+-([0-9]+)$",
-                    "symlink_required": True,
-                },
-		{
-		    "name": "gfortran",
-		    "search_dir": "/usr/bin",
-		    "pattern": r"^gfortran-([0-9]+)$",
-                    "symlink_required": True,
-                }
-            ],
-            "symlink_dirs": {}
-        },
-        "cmake": {
-            "versions": None,
-            "modulefile": {
-                "required": True,
-                "whatis": "Adds cmake to the path",
-                "family": "cmake",
-                "prepend-path": [
-                    ("PATH", "~/bin/cmake/{version}-Linux-x86_64/bin"),
-                    ("MANPATH", "~/bin/cmake/{version}-Linux-x86_64/man")
-                ],
-                "setenv" : []
-            },
-            "dependencies": [
-                {
-                    "name": "cmake",
-                    "search_dir": "~/bin/cmake/",
-                    "pattern" : r"^cmake-([0-9]+\.[0-9]+\.[0-9]+)-Linux-x86_64$",
-                    "symlink_required": False
-                }
-            ],
-            "symlink_dirs": {}
-        }, 
-        "clang": {
+
+# Marks registry fields which have no default.
+REQUIRED = object()
+
+class DependencyDefinition:
+    __slots__ = ("name", "search_dir", "pattern", "symlink_required", "optional")
+
+    FIELDS = {
+        "name": (str, REQUIRED),
+        "search_dir": (str, REQUIRED),
+        "pattern": (str, REQUIRED),
+        "symlink_required": (bool, REQUIRED),
+        "optional": (bool, False),
+    }
+
+    def definition(self):
+        return {
+            "name": self.name,
+            "search_dir": self.search_dir,
+            "pattern": self.pattern,
+            "symlink_required": self.symlink_required,
+            "optional": self.optional,
+        }
+
+
+class ProbeDefinition:
+    __slots__ = ("name", "dependency", "command", "pattern", "timeout")
+
+    FIELDS = {
+        "name": (str, REQUIRED),
+        "dependency": (str, REQUIRED),
+        "command": (list, REQUIRED),
+        "pattern": (str, REQUIRED),
+        "timeout": (float, PROBE_TIMEOUT),
+    }
+
+    def definition(self):
+        return {
+            "name": self.name,
+            "dependency": self.dependency,
+            "command": list(self.command),
+            "pattern": self.pattern,
+            "timeout": self.timeout,
+        }
+
+
+class ModulefileConditionDefinition:
+    # Lines added to the modulefiles of versions matching the constraint and variable values, i.e. [[gcc.modulefile.when]]
+    __slots__ = ("version", "variables", "prepend_path", "setenv", "conflict", "prereq")
+
+    FIELDS = {
+        "version": (str, None),
+        "variables": (dict, {}),
+        "prepend-path": (list, []),
+        "setenv": (list, []),
+        "conflict": (list, []),
+        "prereq": (list, []),
+    }
+
+    def definition(self):
+        definition = {
+            "variables": dict(self.variables),
+            "prepend-path": list(self.prepend_path),
+            "setenv": list(self.setenv),
+            "conflict": list(self.conflict),
+            "prereq": list(self.prereq),
+        }
+        if self.version is not None:
+            definition["version"] = self.version
+        return definition
+
+
+class ModulefileDefinition:
+    __slots__ = ("required", "whatis", "family", "format", "help", "prepend_path", "setenv", "conflict", "prereq", "when")
+
+    FIELDS = {
+        "required": (bool, True),
+        "whatis": (str, None),
+        "family": (str, None),
+        "format": (str, None),
+        "help": (str, None),
+        "prepend-path": (list, []),
+        "setenv": (list, []),
+        "conflict": (list, []),
+        "prereq": (list, []),
+        "when": (list, []),
+    }
+
+    def definition(self):
+        definition = {
+            "required": self.required,
+            "prepend-path": list(self.prepend_path),
+            "setenv": list(self.setenv),
+            "conflict": list(self.conflict),
+            "prereq": list(self.prereq),
+            "when": [block.definition() for block in self.when],
+        }
+        for key in ("whatis", "family", "format", "help"):
+            if getattr(self, key) is not None:
+                definition[key] = getattr(self, key)
+        return definition
+
+
+class DeployPolicyDefinition:
+    __slots__ = ("keep", "pin", "default")
+
+    FIELDS = {
+        "keep": (int, None),
+        "pin": (list, []),
+        "default": (str, None),
+    }
+
+    def definition(self):
+        definition = {"pin": list(self.pin)}
+        for key in ("keep", "default"):
+            if getattr(self, key) is not None:
+                definition[key] = getattr(self, key)
+        return definition
+
+
+class ApplicationDefinition:
+    """
+    A validated application definition from the registry, convertible to the dictionary form used during generation.
+    """
+    __slots__ = ("name", "source", "modulefile", "dependencies", "probes", "deploy", "compiler", "compilers")
+
+    FIELDS = {
+        "modulefile": (dict, REQUIRED),
+        "dependencies": (list, REQUIRED),
+        "probes": (list, []),
+        "deploy": (dict, None),
+        # A compiler, whose module adds the modules built with it to MODULEPATH
+        "compiler": (bool, False),
+        # Compilers this application is built with, once per compiler version
+        "compilers": (list, []),
+    }
+
+    def definition(self):
+        definition = {
             "versions": None,
-            "modulefile": {
-                "required": True,
-                "whatis": "Adds installed components of the Clang toolchain to the path",
-                "family": "clang",
-                "prepend-path": [
-                    ("PATH", "{symlink_dir}"),
-                ],
-                "setenv" : [
-                    ("CC", "clang"),
-                    ("CXX", "clang"),
-                    ("CUDAHOSTCXX", "clang"),
-                ]
-            },
-            "dependencies": [
-                {
-                    "name": "clang",
-                    "search_dir": "/usr/bin",
-                    "pattern": r"^clang-([0-9]+)$",
-                    "symlink_required": True,
-                },
-                {
-                    "name": "clang++",
-                    "search_dir": "/usr/bin",
-                    "pattern": r"^clang\+\+-([0-9]+)$",
-                    "symlink_required": True,
-                },
-                {
-                    "name": "clang-tidy",
-                    "search_dir": "/usr/bin",
-                    "pattern": r"^clang-tidy-([0-9]+)$",
-                    "symlink_required": True,
-                    "optional": True,
-                },
-                {
-                    "name": "clang-tidy",
-                    "search_dir": "/usr/bin",
-                    "pattern": r"^clang-tidy-([0-9]+)$",
-                    "symlink_required": True,
-                    "optional": True,
-                },
-                {
-                    "name": "clang-check",
-                    "search_dir": "/usr/bin",
-                    "pattern": r"^clang-check-([0-9]+)$",
-                    "symlink_required": True,
-                    "optional": True,
-                },
-                {
-                    "name": "clang-format",
-                    "search_dir": "/usr/bin",
-                    "pattern": r"^clang-format-([0-9]+)$",
-                    "symlink_required": True,
-                    "optional": True,
-                },
-                {
-                    "name": "run-clang-tidy",
-                    "search_dir": "/usr/bin",
-                    "pattern": r"^run-clang-tidy-([0-9]+)$",
-                    "symlink_required": True,
-                    "optional": True,
-                }
-            ],
+            "modulefile": self.modulefile.definition(),
+            "dependencies": [dependency.definition() for dependency in self.dependencies],
             "symlink_dirs": {}
         }
-    }
+        if len(self.probes):
+            definition["probes"] = [probe.definition() for probe in self.probes]
+        if self.deploy is not None:
+            definition["deploy"] = self.deploy.definition()
+        if self.compiler:
+            definition["compiler"] = True
+        if len(self.compilers):
+            definition["compilers"] = list(self.compilers)
+        return definition
+
+
+def validate_fields(record, table, context):
+    # Populate a slotted record from a table, checking for unknown, missing and mistyped fields. Optional fields take their defaults.
+    if not isinstance(table, dict):
+        raise Exception(f"{context}: Expected a table")
+    unknown = set(table) - set(record.FIELDS)
+    if len(unknown):
+        raise Exception(f"{context}: Unknown fields {', '.join(sorted(unknown))}")
+    for key, (kind, default) in record.FIELDS.items():
+        if key in table:
+            value = table[key]
+            # Integers are acceptable where floats are expected, i.e. timeout = 5
+            if kind is float and isinstance(value, int) and not isinstance(value, bool):
+                value = float(value)
+            if not isinstance(value, kind):
+                raise Exception(f"{context}: {key} must be a {kind.__name__}")
+        elif default is REQUIRED:
+            raise Exception(f"{context}: Missing required field {key}")
+        else:
+            value = copy.copy(default)
+        setattr(record, key.replace("-", "_"), value)
+    return record
+
+
+def validate_pattern(pattern, context):
+    try:
+        regex = re.compile(pattern)
+    except re.error as e:
+        raise Exception(f"{context}: Invalid pattern {pattern}: {e}")
+    if regex.groups < 1:
+        raise Exception(f"{context}: Pattern {pattern} must capture the version")
+
+
+def validate_directives(record, context):
+    # Paths and variables as [variable, value] pairs, conflicts and prerequisites as lists of module names.
+    for key in ("prepend_path", "setenv"):
+        pairs = getattr(record, key)
+        if any(not isinstance(pair, (list, tuple)) or len(pair) != 2 or not all(isinstance(x, str) for x in pair) for pair in pairs):
+            raise Exception(f"{context}: {key.replace('_', '-')} must be a list of [variable, value] pairs")
+        setattr(record, key, [tuple(pair) for pair in pairs])
+    for key in ("conflict", "prereq"):
+        if not all(isinstance(name, str) for name in getattr(record, key)):
+            raise Exception(f"{context}: {key} must be a list of module names")
+
+
+def validate_application(name, table, source):
+    context = f"{source}: {name}"
+    app = validate_fields(ApplicationDefinition(), table, context)
+    app.name = name
+    app.source = str(source)
+
+    app.modulefile = validate_fields(ModulefileDefinition(), app.modulefile, f"{context}.modulefile")
+    if app.modulefile.format is not None and app.modulefile.format not in MODULEFILE_FORMATS:
+        raise Exception(f"{context}.modulefile: Unknown format {app.modulefile.format}")
+    validate_directives(app.modulefile, f"{context}.modulefile")
+    blocks = []
+    for i, table in enumerate(app.modulefile.when):
+        block = validate_fields(ModulefileConditionDefinition(), table, f"{context}.modulefile.when[{i}]")
+        validate_directives(block, f"{context}.modulefile.when[{i}]")
+        if block.version is not None:
+            try:
+                parse_version_constraint(block.version)
+            except Exception as e:
+                raise Exception(f"{context}.modulefile.when[{i}]: {e}")
+        if not all(isinstance(value, str) for value in block.variables.values()):
+            raise Exception(f"{context}.modulefile.when[{i}]: variables must map names to strings")
+        blocks.append(block)
+    app.modulefile.when = blocks
+
+    dependencies = []
+    for i, table in enumerate(app.dependencies):
+        dependency = validate_fields(DependencyDefinition(), table, f"{context}.dependencies[{i}]")
+        validate_pattern(dependency.pattern, f"{context}.dependencies[{i}]")
+        dependencies.append(dependency)
+    if not len(dependencies):
+        raise Exception(f"{context}: At least one dependency is required")
+    app.dependencies = dependencies
+
+    probes = []
+    dependency_names = {dependency.name for dependency in dependencies}
+    for i, table in enumerate(app.probes):
+        probe = validate_fields(ProbeDefinition(), table, f"{context}.probes[{i}]")
+        validate_pattern(probe.pattern, f"{context}.probes[{i}]")
+        if probe.dependency not in dependency_names:
+            raise Exception(f"{context}.probes[{i}]: Unknown dependency {probe.dependency}")
+        if not len(probe.command) or not all(isinstance(c, str) for c in probe.command):
+            raise Exception(f"{context}.probes[{i}]: command must be a non-empty list of strings")
+        probes.append(probe)
+    app.probes = probes
+
+    if app.deploy is not None:
+        app.deploy = validate_fields(DeployPolicyDefinition(), app.deploy, f"{context}.deploy")
+        if app.deploy.keep is not None and app.deploy.keep < 1:
+            raise Exception(f"{context}.deploy: keep must be at least 1")
+        if not all(isinstance(version, str) for version in app.deploy.pin):
+            raise Exception(f"{context}.deploy: pin must be a list of version strings")
+    if app.compiler and len(app.compilers):
+        raise Exception(f"{context}: A compiler cannot itself be built with compilers")
+    return app
+
+
+def registry_table(record):
+    # The fields of a validated record as a table it validates from again, for caching as JSON. Fields left as None take their defaults.
+    table = {}
+    for key in record.FIELDS:
+        value = getattr(record, key.replace("-", "_"))
+        if value is None:
+            continue
+        if hasattr(value, "FIELDS"):
+            value = registry_table(value)
+        elif isinstance(value, list):
+            value = [registry_table(item) if hasattr(item, "FIELDS") else item for item in value]
+        table[key] = value
+    return table
+
+
+def registry_sources(directory):
+    # The definition files within the registry directory, with the (st_mtime_ns, st_size) of each.
+    sources = {}
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.endswith((".toml", ".json")) and not entry.name.startswith("."):
+                    st = entry.stat()
+                    sources[entry.name] = [st.st_mtime_ns, st.st_size]
+    except FileNotFoundError:
+        raise Exception(f"Application registry {directory} does not exist")
+    return dict(sorted(sources.items()))
+
+
+def parse_registry_file(path):
+    if path.suffix == ".toml":
+        if tomllib is None:
+            raise Exception(f"{path}: Reading TOML requires Python 3.11 or the tomli package")
+        with open(path, "rb") as fp:
+            try:
+                return tomllib.load(fp)
+            except tomllib.TOMLDecodeError as e:
+                raise Exception(f"{path}: {e}")
+    with open(path, "r") as fp:
+        try:
+            return json.load(fp)
+        except ValueError as e:
+            raise Exception(f"{path}: {e}")
+
+
+def load_application_registry(directory=APPLICATIONS_DIR, cache_path=REGISTRY_CACHE_FILE, use_cache=True):
+    """
+    Load and validate the application definitions in a directory of TOML/JSON files, each holding one or more applications keyed by name.
 
-    # Find applications and versions
-    applications = find_applications(applications)
+    The validated records are cached as JSON in cache_path, along with the mtime and size of every source file, so subsequent loads only need to list the directory while it is unchanged, rather than parse every definition file. The cache lives in the shared tree, so holds plain tables which are validated again when loaded, rather than pickled objects.
+    """
+    directory = pathlib.Path(directory)
+    sources = registry_sources(directory)
+    if use_cache:
+        try:
+            with open(cache_path, "r") as fp:
+                cached = json.load(fp)
+            if cached["version"] == REGISTRY_CACHE_VERSION and cached["directory"] == str(directory) and cached["sources"] == sources:
+                return {name: validate_application(name, entry["table"], entry["source"]) for name, entry in cached["applications"].items()}
+        except Exception:
+            # Unreadable, or no longer valid, so is rebuilt from the definition files.
+            pass
 
-    # Create symlinks
-    create_symlinks(applications)
+    applications = {}
+    for filename in sources:
+        path = pathlib.Path(directory, filename)
+        for name, table in parse_registry_file(path).items():
+            if name in applications:
+                raise Exception(f"{path}: {name} is already defined in {applications[name].source}")
+            applications[name] = validate_application(name, table, path)
+    for name, app in applications.items():
+        for compiler in app.compilers:
+            if compiler not in applications or not applications[compiler].compiler:
+                raise Exception(f"{app.source}: {name}: {compiler} is not a compiler application")
+
+    if use_cache:
+        cache_path = pathlib.Path(cache_path)
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, prefix=f".{cache_path.name}.")
+        cached = {name: {"source": app.source, "table": registry_table(app)} for name, app in applications.items()}
+        with os.fdopen(fd, "w") as fp:
+            json.dump({"version": REGISTRY_CACHE_VERSION, "directory": str(directory), "sources": sources, "applications": cached}, fp)
+        os.replace(tmp_path, cache_path)
+    return applications
 
-    # Create module files
-    create_modulefiles(applications)
 
-# @todo - some refactoring?
-def create_symlinks(applications):
-    symlink_root = pathlib.Path(SYMLINKS_DIR)
-    symlink_root.mkdir(exist_ok=True)
+def load_applications(directory=APPLICATIONS_DIR, cache_path=REGISTRY_CACHE_FILE, use_cache=True):
+    # Applications definitions from the registry, in the dictionary form used during generation.
+    registry = load_application_registry(directory, cache_path, use_cache)
+    return {name: app.definition() for name, app in registry.items()}
+
+
+def default_applications():
+    # Define the apps and files they depend on, in the applications directory. Versions of dependencies must match!
+    # Probes extract full versions from the binaries, i.e. 12.4.131 rather than 12.4, for use in templates.
+    return load_applications()
+
+
+class GeneratePipeline:
+    """
+    Generate symlinks and modulefiles for each application on a bounded thread pool.
+
+    Each search directory is scanned once, as its own task. Each application then flows through version resolution, symlink creation, rendering and writing as soon as the directories it depends on have been scanned, independently of other applications. Results are reported in application order, so output is deterministic regardless of scheduling, unless streaming records, when each application's entries are written as soon as it completes.
+    """
+
+    def __init__(self, applications, scan_cache=None, incremental=True, modulefile_format="tcl", jobs=1, symlinks_dir=None, modulefiles_dir=None, dry_run=False, probe_cache=None, stream=False):
+        self.applications = applications
+        self.dry_run = dry_run
+        # Whether to output each application's messages and report entries as soon as it is generated, rather than in application order once all are.
+        self.stream = stream
+        self.probe_cache = probe_cache
+        self.prober = None
+        self.symlinks_dir = pathlib.Path(symlinks_dir if symlinks_dir is not None else SYMLINKS_DIR)
+        self.modulefiles_dir = pathlib.Path(modulefiles_dir if modulefiles_dir is not None else MODULEFILES_DIR)
+        self.scan_cache = scan_cache
+        self.incremental = incremental
+        self.modulefile_format = modulefile_format
+        self.jobs = max(1, jobs)
+
+    def output(self, plan, messages, report):
+        for message in messages:
+            print(message)
+        print_symlink_entries([plan])
+        print_modulefile_entries(report["written"], report["stale"], self.modulefiles_dir)
+
+    def process_application(self, app, obj, scanned, mode):
+        with PROFILER.phase("versions", app):
+            find_application_versions(app, obj, scanned)
+        with PROFILER.phase("probes", app):
+            messages = probe_application_versions(app, obj, self.prober)
+        with PROFILER.phase("symlinks", app):
+            plan, symlink_messages = create_application_symlinks(app, obj, self.symlinks_dir, self.dry_run)
+            messages.extend(symlink_messages)
+        with PROFILER.phase("modulefiles", app):
+            report = create_application_modulefiles(app, obj, self.modulefiles_dir, self.incremental, self.modulefile_format, mode, self.dry_run)
+        return plan, messages, report
+
+    def run(self):
+        scanner = DirectoryScanner(self.scan_cache)
+        search_paths = register_dependencies(scanner, self.applications)
+
+        if not self.dry_run:
+            self.symlinks_dir.mkdir(parents=True, exist_ok=True)
+            self.modulefiles_dir.mkdir(parents=True, exist_ok=True)
+        # Mode of new files, found once as the umask is process wide. Existing files keep their mode.
+        mode = default_file_mode()
+
+        scanned = {}
+        app_futures = {}
+        # Probes run on their own pool, as application tasks wait on their results.
+        self.prober = VersionProber(self.probe_cache, self.jobs)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            scan_futures = {pool.submit(scanner.scan_path, search_path): search_path for search_path in scanner.search_paths()}
+            waiting = {app: set(paths) for app, paths in search_paths.items()}
+
+            # Applications are only submitted once their directories are scanned, so tasks never block on each other.
+            def submit_ready(done_path=None):
+                submitted = set()
+                for app in list(waiting):
+                    waiting[app].discard(done_path)
+                    if not waiting[app]:
+                        del waiting[app]
+                        app_futures[app] = pool.submit(self.process_application, app, self.applications[app], scanned, mode)
+                        submitted.add(app_futures[app])
+                return submitted
+
+            try:
+                pending = set(scan_futures) | submit_ready()
+                while pending:
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        if future in scan_futures:
+                            scanned.update(future.result())
+                            pending |= submit_ready(scan_futures[future])
+                        elif self.stream:
+                            self.output(*future.result())
+                results = [(app, app_futures[app].result()) for app in self.applications]
+            finally:
+                self.prober.close()
+
+        plans = []
+        report = {"written": [], "unchanged": [], "stale": [], "modules": []}
+        for app, (plan, messages, app_report) in results:
+            if not self.stream:
+                for message in messages:
+                    print(message)
+            plans.append(plan)
+            for key in report:
+                report[key].extend(app_report[key])
+        report["symlinks"] = plans
+        return report
+
+
+def add_compiler_modulepaths(applications, modulepath_root):
+    # Each compiler's module adds the subtree of modules built with that compiler version to MODULEPATH.
+    for app, obj in applications.items():
+        if "compiler" in obj and obj["compiler"]:
+            path = pathlib.Path(modulepath_root, COMPILER_HIERARCHY_DIR, app).as_posix() + "/{version}"
+            obj["modulefile"]["prepend-path"].append(("MODULEPATH", path))
+
+
+def expand_compiler_applications(applications, compilers):
+    """
+    Instantiate applications built with compilers once per version of each compiler, named for where they live in the hierarchy, i.e. .Compiler/gcc/12/openmpi.
+
+    Search directories may use {compiler} and {compiler_version}, as may modulefile paths and variables.
+    """
+    expanded = {}
+    for app, obj in applications.items():
+        for compiler in obj["compilers"]:
+            if compiler not in compilers:
+                continue
+            for compiler_version in compilers[compiler]["versions"]:
+                variables = {"compiler": compiler, "compiler_version": compiler_version}
+                instance = copy.deepcopy(obj)
+                instance["name"] = app
+                instance["variables"] = variables
+                for dependency in instance["dependencies"]:
+                    # Substituted rather than formatted, as other braces are left for later.
+                    for key, value in variables.items():
+                        dependency["search_dir"] = dependency["search_dir"].replace(f"{{{key}}}", value)
+                expanded[pathlib.PurePath(COMPILER_HIERARCHY_DIR, compiler, compiler_version, app).as_posix()] = instance
+    return expanded
+
+
+def split_hierarchy(modulename):
+    # The subtree of the compiler hierarchy a module is in, and its name within that subtree, i.e. (.Compiler/gcc/12, openmpi/4.1). Core modules are in no subtree.
+    parts = pathlib.PurePath(modulename).parts
+    if len(parts) > 3 and parts[0] == COMPILER_HIERARCHY_DIR:
+        return pathlib.PurePath(*parts[:3]).as_posix(), pathlib.PurePath(*parts[3:]).as_posix()
+    return None, pathlib.PurePath(modulename).as_posix()
+
+
+def module_application(modulename):
+    # The application a generated module belongs to, i.e. gcc for gcc/12 and openmpi for .Compiler/gcc/12/openmpi/4.1
+    parts = pathlib.PurePath(modulename).parts
+    return parts[-2] if len(parts) > 1 else parts[0]
+
+
+def print_generate_report(report, dry_run=False, modulefiles_root=None, entries=True):
+    # Without entries, only the counts, i.e. when the entries were streamed as each application was generated.
+    print_symlink_plans(report["symlinks"], dry_run, entries)
+    print_created_modulefiles(report["written"], report["unchanged"], report["stale"], dry_run, modulefiles_root, entries)
+
+
+# @todo move this/rename
+def generate_modules(scan_cache=None, incremental=True, modulefile_format="tcl", jobs=1, applications=None, symlinks_dir=None, modulefiles_dir=None, dry_run=False, probe_cache=None, modulepath_root=None, print_report=True):
+    if applications is None:
+        applications = default_applications()
+    # The directory on MODULEPATH which compilers' subtrees are deployed to, by default alongside the available modules.
+    if modulepath_root is None:
+        modulepath_root = pathlib.Path(modulefiles_dir if modulefiles_dir is not None else MODULEFILES_DIR).parent / "deployed"
+
+    # Applications built with compilers can only be expanded once the compiler versions are known, so are generated afterwards.
+    dependent = {app: obj for app, obj in applications.items() if "compilers" in obj and len(obj["compilers"])}
+    core = {app: obj for app, obj in applications.items() if app not in dependent}
+    add_compiler_modulepaths(core, modulepath_root)
+
+    # Records are streamed as each application is generated, followed by the counts once all are.
+    stream = print_report and OUTPUT.streaming
+
+    # Find applications and versions, create symlinks and module files.
+    pipeline = GeneratePipeline(core, scan_cache, incremental, modulefile_format, jobs, symlinks_dir, modulefiles_dir, dry_run, probe_cache, stream)
+    report = pipeline.run()
+    if len(dependent):
+        expanded = expand_compiler_applications(dependent, core)
+        pipeline = GeneratePipeline(expanded, scan_cache, incremental, modulefile_format, jobs, symlinks_dir, modulefiles_dir, dry_run, probe_cache, stream)
+        for key, value in pipeline.run().items():
+            report[key].extend(value)
+        # Record the instances, i.e. for deploy policies.
+        applications.update(expanded)
+        for app in dependent:
+            del applications[app]
+
+    if print_report:
+        print_generate_report(report, dry_run, modulefiles_dir if modulefiles_dir is not None else MODULEFILES_DIR, entries=not stream)
+    return report
+
+def create_symlinks(applications, symlink_root=None, dry_run=False):
+    symlink_root = pathlib.Path(symlink_root if symlink_root is not None else SYMLINKS_DIR)
+    if not dry_run:
+        symlink_root.mkdir(exist_ok=True)
     
-    created_links = []
+    plans = []
     # Iterate found apps
     for app, obj in applications.items():
-        app_dir = pathlib.Path(symlink_root, app)
-        versions = obj["versions"]
-        dependencies = obj["dependencies"]
-        for version in versions:
-            for dependency in dependencies:
-                is_optional = dependency["optional"] if "optional" in dependency else False
-                if dependency["symlink_required"]:
-                    # If the dependency is non optional / was found for this verison
+        plan, messages = create_application_symlinks(app, obj, symlink_root, dry_run)
+        for message in messages:
+            print(message)
+        plans.append(plan)
 
-                    # Ensure the app directory exists
-                    app_dir.mkdir(exist_ok=True)
-                    # Ensure the application version directory exists
-                    app_versions_dir = pathlib.Path(app_dir, version)
-                    app_versions_dir.mkdir(exist_ok=True)
+    print_symlink_plans(plans, dry_run)
+    return plans
 
-                    # Construct paths for symlink source and target
-                    versions = dependency["versions"]
-                    if version in versions:
-                        link_source = versions[version]["path"]
-                        link_target = pathlib.Path(app_versions_dir, dependency["name"])
-                        obj["symlink_dirs"][version] = link_target.parent
+class SymlinkPlan:
+    """
+    The changes required to reconcile an application's directory in the symlink farm with the links it should contain.
+    """
 
-                        # If the target does not exist, create it.
-                        if not link_target.exists() and link_source.exists():
-                            link_target.symlink_to(link_source)
-                            created_links.append(link_target)
+    def __init__(self, app_dir):
+        self.app_dir = app_dir
+        # Directories to create, parents first.
+        self.directories = []
+        # (link, source) pairs to create
+        self.create = []
+        # (link, current source, new source) for links pointing at the wrong source
+        self.retarget = []
+        # links no longer wanted
+        self.remove = []
+        self.unchanged = 0
 
-                    elif is_optional:
-                        print(f"{app}: Optional {dependency['name']} {version} not found, continuing. ")
-                    else:
-                        raise Exception(f"Missing version {version} of non-optional dependency {dependency['name']} for {app}")
+    def __len__(self):
+        return len(self.directories) + len(self.create) + len(self.retarget) + len(self.remove)
+
+def desired_application_symlinks(app, obj, symlink_root):
+    # The links an application should have, mapped to their sources. Also records the symlink directory of each version.
+    desired = {}
+    messages = []
+    app_dir = pathlib.Path(symlink_root, app)
+    versions = obj["versions"]
+    dependencies = obj["dependencies"]
+    for version in versions:
+        for dependency in dependencies:
+            is_optional = dependency["optional"] if "optional" in dependency else False
+            if dependency["symlink_required"]:
+                # If the dependency is non optional / was found for this verison
+                app_versions_dir = pathlib.Path(app_dir, version)
+
+                # Construct paths for symlink source and target
+                dependency_versions = dependency["versions"]
+                if version in dependency_versions:
+                    link_source = dependency_versions[version]["path"]
+                    link_target = pathlib.Path(app_versions_dir, dependency["name"])
+                    obj["symlink_dirs"][version] = link_target.parent
+
+                    if link_source.exists():
+                        desired[link_target] = link_source
+
+                elif is_optional:
+                    messages.append(f"{app}: Optional {dependency['name']} {version} not found, continuing. ")
+                else:
+                    raise Exception(f"Missing version {version} of non-optional dependency {dependency['name']} for {app}")
+    return desired, messages
+
+def scan_symlinks(directory):
+    # A single walk of a directory, returning its symlinks (and their targets) and subdirectories.
+    links = {}
+    directories = set()
+    pending = [pathlib.Path(directory)]
+    while len(pending):
+        current = pending.pop()
+        try:
+            with os.scandir(current) as entries:
+                directories.add(current)
+                for entry in entries:
+                    if entry.is_symlink():
+                        links[pathlib.Path(entry.path)] = os.readlink(entry.path)
+                    elif entry.is_dir(follow_symlinks=False):
+                        pending.append(pathlib.Path(entry.path))
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+    return links, directories
+
+def plan_application_symlinks(app_dir, desired):
+    plan = SymlinkPlan(app_dir)
+    existing, directories = scan_symlinks(app_dir)
+    planned_directories = set(directories)
+    for link, source in sorted(desired.items()):
+        current = existing.get(link)
+        if current is None:
+            # Create any missing parent directories, outermost first.
+            missing = []
+            parent = link.parent
+            while parent not in planned_directories and (parent == app_dir or app_dir in parent.parents):
+                missing.append(parent)
+                planned_directories.add(parent)
+                parent = parent.parent
+            plan.directories.extend(reversed(missing))
+            plan.create.append((link, source))
+        elif current != str(source):
+            plan.retarget.append((link, current, source))
+        else:
+            plan.unchanged += 1
+    for link in sorted(existing):
+        if link not in desired:
+            plan.remove.append(link)
+    return plan
+
+def apply_symlink_plan(plan):
+    messages = []
+    for directory in plan.directories:
+        directory.mkdir(exist_ok=True)
+    for link, source in plan.create:
+        try:
+            os.symlink(source, link)
+        except FileExistsError:
+            # Something other than a symlink is in the way, which is left alone.
+            messages.append(f"{link} exists and is not a symlink, skipping")
+    for link, current, source in plan.retarget:
+        # Replace the link atomically, so it never disappears.
+        tmp_link = link.with_name(f".{link.name}.{os.getpid()}.tmp")
+        os.symlink(source, tmp_link)
+        os.replace(tmp_link, link)
+    for link in plan.remove:
+        try:
+            os.unlink(link)
+        except FileNotFoundError:
+            pass
+    # Prune directories emptied by removals, bottom up, stopping at the first which is not empty.
+    candidates = set()
+    for link in plan.remove:
+        parent = link.parent
+        while parent == plan.app_dir or plan.app_dir in parent.parents:
+            candidates.add(parent)
+            parent = parent.parent
+    for directory in sorted(candidates, key=lambda d: len(d.parts), reverse=True):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            pass
+    return messages
+
+def create_application_symlinks(app, obj, symlink_root, dry_run=False):
+    # Reconcile the application's symlinks, returning the plan and any messages to report, rather than printing so applications may be processed concurrently.
+    app_dir = pathlib.Path(symlink_root, app)
+    desired, messages = desired_application_symlinks(app, obj, symlink_root)
+    plan = plan_application_symlinks(app_dir, desired)
+    if not dry_run:
+        messages.extend(apply_symlink_plan(plan))
+    return plan, messages
+
+def default_file_mode():
+    # Mode for newly created files, honouring the umask as open() would.
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_hash(path):
+    try:
+        with open(path, "rb") as fp:
+            return content_hash(fp.read())
+    except (FileNotFoundError, IsADirectoryError):
+        return None
+
+
+def write_file_atomic(path, content, new_mode=None):
+    # Write to a temporary file in the same directory, then rename over the destination so readers never see a partial file. An existing file keeps its mode, a new file gets new_mode, by default honouring the umask.
+    path = pathlib.Path(path)
+    try:
+        mode = path.stat().st_mode & 0o7777
+    except FileNotFoundError:
+        mode = new_mode if new_mode is not None else default_file_mode()
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, "w") as fp:
+            fp.write(content)
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def write_file_if_changed(path, content, incremental=True, new_mode=None, dry_run=False):
+    # Returns True if the file was (or for a dry run, would be) written, False if the content on disk was already identical.
+    if incremental and file_hash(path) == content_hash(content.encode()):
+        return False
+    if not dry_run:
+        write_file_atomic(path, content, new_mode)
+    return True
 
-                        
 
+def find_stale_modulefiles(modulefile_app_path, current):
+    # Files in an application's modulefile directory which were not produced by this generation.
+    stale = []
+    if modulefile_app_path.is_dir():
+        for root, dirs, files in os.walk(modulefile_app_path):
+            for file in files:
+                path = pathlib.Path(root, file)
+                if not file.startswith(".") and path not in current:
+                    stale.append(path)
+    return stale
 
-    print_created_symlinks(created_links)
-    return created_links
 
-# @todo - don't overwrite files without a flag.
-def create_modulefiles(applications):
-    modulefiles_root = pathlib.Path(MODULEFILES_DIR)
-    modulefiles_root.mkdir(exist_ok=True)
+def create_modulefiles(applications, incremental=True, modulefile_format="tcl", modulefiles_root=None, dry_run=False):
+    modulefiles_root = pathlib.Path(modulefiles_root if modulefiles_root is not None else MODULEFILES_DIR)
+    if not dry_run:
+        modulefiles_root.mkdir(exist_ok=True)
 
-    created_modulefiles = []
+    report = {"written": [], "unchanged": [], "stale": [], "modules": []}
+    # Mode of new files, existing files keep theirs.
+    mode = default_file_mode()
 
     # Iterate applications, if they need a modulefile creating, do so. 
     # modulefiles should be created on a per-template bassis, and may need to know about symlink destinations and so on. 
     # 
 
     for app, obj in applications.items():
-        modulefile_options = obj["modulefile"]
-        if modulefile_options["required"]:
-            modulefile_app_path = pathlib.Path(modulefiles_root, app)
-            # Module file will be required for each version.
-            versions = obj["versions"]
-            for version in versions:
-                modulefile_app_version_path = pathlib.Path(modulefile_app_path, version)
-
-                # Compute the correct values of prepend_vars and set_vars.
-                concrete_prepend_paths = []
-                for vname, vfmt in modulefile_options["prepend-path"]:
-                    format_variables = {
-                        "version": version,
-                        "symlink_dir": obj["symlink_dirs"][version] if "symlink_dirs" in obj and version in obj["symlink_dirs"] else ""
-                    }
-                    path = pathlib.Path(vfmt.format(**format_variables)).expanduser()
-                    concrete_prepend_paths.append((vname, str(path)))
-                concrete_setenvs = []
-                for vname, vfmt in modulefile_options["setenv"]:
-                    format_variables = {
-                        "version": version,
-                        "symlink_dir": obj["symlink_dirs"][version] if "symlink_dirs" in obj and version in obj["symlink_dirs"] else ""
-                    }
-                    concrete_setenvs.append((vname, vfmt.format(**format_variables)))
-                whatis = modulefile_options["whatis"] if "whatis" in modulefile_options else None
-                family = modulefile_options["family"] if "family" in modulefile_options else None
-                # Get the module string 
-                modulestring = generate_modulefile_string(
-                    appname = app,
-                    family = family,
-                    version = version,
-                    whatis = whatis, 
-                    prepend_vars = concrete_prepend_paths,
-                    set_vars = concrete_setenvs
-                )
-                modulefile_app_path.mkdir(exist_ok=True)
-                with open(modulefile_app_version_path, "w") as fp:
-                    fp.write(modulestring)
-                    created_modulefiles.append(modulefile_app_version_path)
-
-    print_created_modulefiles(created_modulefiles)
-    return created_modulefiles
+        app_report = create_application_modulefiles(app, obj, modulefiles_root, incremental, modulefile_format, mode, dry_run)
+        for key in report:
+            report[key].extend(app_report[key])
+
+    print_created_modulefiles(report["written"], report["unchanged"], report["stale"], dry_run)
+    return report
+
+def search_index_module(modulename, filename, application, version, family, whatis, digest=None):
+    # A module's entry in the search index, and if known the hash of its content for the manifest.
+    return {
+        "name": pathlib.PurePath(modulename).as_posix(),
+        "filename": pathlib.PurePath(filename).as_posix(),
+        "application": application,
+        "version": version,
+        "family": family,
+        "whatis": whatis,
+        "hash": digest,
+    }
+
+def write_version_marker(modulefile_app_path, obj, incremental=True, mode=None, dry_run=False):
+    # Name the default version explicitly, so it doesn't have to be found by sorting versions.
+    marker_path = pathlib.Path(modulefile_app_path, VERSION_MARKER)
+    selected, default = select_versions(obj)
+    if default is not None:
+        write_file_if_changed(marker_path, version_marker_string(default), incremental, mode, dry_run)
+    elif not dry_run and marker_path.is_file():
+        marker_path.unlink()
+
+def create_application_modulefiles(app, obj, modulefiles_root, incremental=True, modulefile_format="tcl", mode=None, dry_run=False):
+    written_modulefiles = []
+    unchanged_modulefiles = []
+    stale_modulefiles = []
+    # Metadata of each modulefile, for the search index.
+    modules = []
+
+    modulefile_options = obj["modulefile"]
+    if modulefile_options["required"]:
+        modulefile_app_path = pathlib.Path(modulefiles_root, app)
+        current_modulefiles = set()
+        # The application may request a format, otherwise use the default.
+        app_format = modulefile_options["format"] if "format" in modulefile_options else modulefile_format
+        if app_format not in MODULEFILE_FORMATS:
+            raise Exception(f"Unknown modulefile format {app_format} for {app}")
+        appname = obj["name"] if "name" in obj else app
+        # The spec is compiled once, then every version rendered from it.
+        template = ModulefileTemplate(appname, modulefile_options, app_format)
+        whatis = modulefile_options["whatis"] if "whatis" in modulefile_options else None
+        family = modulefile_options["family"] if "family" in modulefile_options else None
+        # Module file will be required for each version.
+        versions = obj["versions"]
+        versions_variables = []
+        for version in versions:
+            format_variables = {
+                "version": version,
+                "symlink_dir": obj["symlink_dirs"][version] if "symlink_dirs" in obj and version in obj["symlink_dirs"] else ""
+            }
+            # Probed versions, i.e. {cuda_full_version}
+            if "probed" in obj and version in obj["probed"]:
+                format_variables.update(obj["probed"][version])
+            # The compiler of applications built with one, i.e. {compiler} {compiler_version}
+            if "variables" in obj:
+                format_variables.update(obj["variables"])
+            versions_variables.append(format_variables)
+        modulestrings = template.render_all(versions_variables)
+
+        for version, modulestring in zip(versions, modulestrings):
+            modulefile_app_version_path = pathlib.Path(modulefile_app_path, version + MODULEFILE_FORMATS[app_format])
+            current_modulefiles.add(modulefile_app_version_path)
+            filename = modulefile_app_version_path.relative_to(modulefiles_root)
+            modules.append(search_index_module(pathlib.PurePath(app, version), filename, appname, version, family, whatis, content_hash(modulestring.encode())))
+            if not dry_run:
+                modulefile_app_path.mkdir(parents=True, exist_ok=True)
+                # Remove the same version in any other format, which this file replaces.
+                for suffix in MODULEFILE_FORMATS.values():
+                    other_path = pathlib.Path(modulefile_app_path, version + suffix)
+                    if other_path != modulefile_app_version_path and other_path.is_file():
+                        other_path.unlink()
+            # Only touch files whose content has changed, to preserve mtimes and avoid invalidating caches.
+            if write_file_if_changed(modulefile_app_version_path, modulestring, incremental, mode, dry_run):
+                written_modulefiles.append(modulefile_app_version_path)
+            else:
+                unchanged_modulefiles.append(modulefile_app_version_path)
+
+        stale_modulefiles.extend(find_stale_modulefiles(modulefile_app_path, current_modulefiles))
+
+        write_version_marker(modulefile_app_path, obj, incremental, mode, dry_run)
+
+    return {
+        "written": written_modulefiles,
+        "unchanged": unchanged_modulefiles,
+        "stale": stale_modulefiles,
+        "modules": modules,
+    }
 
 # @todo - method to clean only dynamically created module files
 
-def clean_symlinks():
-    symlink_root = pathlib.Path(SYMLINKS_DIR)
+def clean_symlinks(symlink_root=None):
+    symlink_root = pathlib.Path(symlink_root if symlink_root is not None else SYMLINKS_DIR)
     if symlink_root.exists():
         shutil.rmtree(symlink_root)
 
-def print_created_symlinks(symlinks):
-    print(f"Created {len(symlinks)} symlinks")
-    for x in sorted(symlinks):
-        print(f"\t{x}")
+def report_order(entries):
+    # Text is sorted for reading. Records are streamed in the order they were produced, without sorting a copy first.
+    return sorted(entries) if OUTPUT.format == "text" else entries
+
+def print_symlink_plans(plans, dry_run=False, entries=True):
+    created = [x for plan in plans for x in plan.create]
+    retargeted = [x for plan in plans for x in plan.retarget]
+    removed = [x for plan in plans for x in plan.remove]
+    unchanged = sum(plan.unchanged for plan in plans)
+    prefix = "Planned symlinks" if dry_run else "Symlinks"
+    OUTPUT.count("symlinks", f"{prefix}: {len(created)} created, {len(retargeted)} retargeted, {len(removed)} removed, {unchanged} unchanged", created=len(created), retargeted=len(retargeted), removed=len(removed), unchanged=unchanged, dry_run=dry_run)
+    if entries:
+        print_symlink_entries(plans)
+
+def print_symlink_entries(plans):
+    if OUTPUT.quiet:
+        return
+    created = [x for plan in plans for x in plan.create]
+    retargeted = [x for plan in plans for x in plan.retarget]
+    removed = [x for plan in plans for x in plan.remove]
+    for link, source in report_order(created):
+        OUTPUT.entry("symlink", path=link, text=f"\tcreate   {link} -> {source}", action="create", source=source)
+    for link, current, source in report_order(retargeted):
+        OUTPUT.entry("symlink", path=link, text=f"\tretarget {link} -> {source} (was {current})", action="retarget", source=source, previous=current)
+    for link in report_order(removed):
+        OUTPUT.entry("symlink", path=link, text=f"\tremove   {link}", action="remove")
+
+def print_pruned(modulefiles, links, dry_run=False, modulefiles_root=None):
+    prefix = "Planned prune" if dry_run else "Pruned"
+    OUTPUT.count("prune", f"{prefix}: {len(modulefiles)} stale modulefiles, {len(links)} stale symlinks", modulefiles=len(modulefiles), symlinks=len(links), dry_run=dry_run)
+    if OUTPUT.quiet:
+        return
+    for x in report_order(modulefiles):
+        OUTPUT.entry("stale", report_modulename(x, modulefiles_root), x, f"\tremove   {x}", action="remove")
+    for link in report_order(links):
+        OUTPUT.entry("symlink", path=link, text=f"\tremove   {link}", action="remove")
+
+def report_modulename(path, modulefiles_root):
+    # The module name of a generated modulefile, if it is within the modulefiles directory.
+    if modulefiles_root is not None:
+        try:
+            return modulefile_name(pathlib.Path(path).relative_to(modulefiles_root))
+        except ValueError:
+            pass
+    return None
+
+def print_created_modulefiles(written, unchanged=[], stale=[], dry_run=False, modulefiles_root=None, entries=True):
+    prefix = "Planned modulefiles" if dry_run else "Modulefiles"
+    OUTPUT.count("modulefiles", f"{prefix}: {len(written)} written, {len(unchanged)} unchanged, {len(stale)} stale", written=len(written), unchanged=len(unchanged), stale=len(stale), dry_run=dry_run)
+    if entries:
+        print_modulefile_entries(written, stale, modulefiles_root)
+
+def print_modulefile_entries(written, stale=[], modulefiles_root=None):
+    if OUTPUT.quiet:
+        return
+    for x in report_order(written):
+        OUTPUT.entry("available", report_modulename(x, modulefiles_root), x, f"\twritten {x}", action="write")
+    for x in report_order(stale):
+        OUTPUT.entry("stale", report_modulename(x, modulefiles_root), x, f"\tstale   {x}", action="remove")
+
+
+
+
+def tcl_unquote(value):
+    value = value.strip()
+    if len(value) >= 2 and ((value[0] == '"' and value[-1] == '"') or (value[0] == "{" and value[-1] == "}")):
+        return value[1:-1]
+    return value
+
+
+LUA_MODULEFILE_CALL = re.compile(r"""^\s*(whatis|family|prepend_path|setenv)\s*\((.*)\)\s*$""")
+LUA_STRING_ARGUMENT = re.compile(r""""((?:[^"\\]|\\.)*)"|'((?:[^'\\]|\\.)*)'""")
+LUA_VERSION_LOCAL = re.compile(r"""^\s*local\s+version\s*=\s*["'](.*)["']\s*$""")
+
+def lua_unquote(value):
+    return re.sub(r"\\(.)", lambda m: "\n" if m.group(1) == "n" else m.group(1), value)
 
-def print_created_modulefiles(modulefiles):
-    print(f"Created {len(modulefiles)} modulefiles")
-    for x in sorted(modulefiles):
-        print(f"\t{x}")
+def parse_modulefile(path):
+    """
+    Extract the metadata Lmod records in its spider cache (whatis, family and modified paths) from a Tcl or Lua modulefile.
+    """
+    if pathlib.PurePath(path).suffix == ".lua":
+        return parse_lua_modulefile(path)
+    info = {"version": None, "whatis": [], "family": None, "prepend-path": [], "setenv": []}
+    with open(path, "r") as fp:
+        for line in fp:
+            line = line.strip()
+            words = line.split(None, 2)
+            if not words or words[0].startswith("#"):
+                continue
+            command = words[0]
+            if command == "module-whatis" and len(words) > 1:
+                info["whatis"].append(tcl_unquote(line[len(command):]))
+            elif command == "family" and len(words) > 1:
+                info["family"] = tcl_unquote(words[1])
+            elif command == "set" and len(words) > 2 and words[1] == "version":
+                info["version"] = tcl_unquote(words[2])
+            elif command in ("prepend-path", "setenv") and len(words) > 2:
+                info[command].append((words[1], tcl_unquote(words[2])))
+    return info
+
+
+def parse_lua_modulefile(path):
+    info = {"version": None, "whatis": [], "family": None, "prepend-path": [], "setenv": []}
+    with open(path, "r") as fp:
+        for line in fp:
+            result = LUA_VERSION_LOCAL.match(line)
+            if result:
+                info["version"] = result.group(1)
+                continue
+            result = LUA_MODULEFILE_CALL.match(line)
+            if not result:
+                continue
+            command = result.group(1)
+            arguments = [lua_unquote(a if a else b) for a, b in LUA_STRING_ARGUMENT.findall(result.group(2))]
+            if command == "whatis" and len(arguments) > 0:
+                info["whatis"].append(arguments[0])
+            elif command == "family" and len(arguments) > 0:
+                info["family"] = arguments[0]
+            elif command in ("prepend_path", "setenv") and len(arguments) > 1:
+                info[command.replace("_", "-")].append((arguments[0], arguments[1]))
+    return info
+
+
+def modulefile_requirements(path, symlinks_root=SYMLINKS_DIR):
+    """
+    The paths a modulefile depends upon, as a list of requirements, each met if any one of its checks passes.
 
+    Every PATH entry must exist, as must every binary symlinked into a PATH entry within the symlink farm. Other variables, i.e. LD_LIBRARY_PATH, only need one of their entries to exist, as not every install has every library directory.
+    Checks are (kind, path) pairs for check_path.
+    """
+    symlinks_root = pathlib.Path(symlinks_root)
+    requirements = []
+    others = {}
+    for name, value in parse_modulefile(path)["prepend-path"]:
+        # Module trees are not dependencies, and may be empty until modules are deployed into them.
+        if name == "MODULEPATH":
+            continue
+        for entry in value.split(os.pathsep):
+            # Entries using Tcl or Lua substitution, i.e. $root/bin, are only known to the module command, so are not checked.
+            if not entry or any(c in entry for c in "$[{"):
+                continue
+            if name == "PATH":
+                entry_path = pathlib.Path(entry)
+                kind = "links" if symlinks_root in entry_path.parents else "exists"
+                requirements.append([(kind, entry)])
+            else:
+                others.setdefault(name, []).append(("exists", entry))
+    requirements.extend(others.values())
+    return requirements
+
+
+def check_path(kind, path):
+    # "exists": the path exists. "links": the directory exists and every symlink within it resolves.
+    if kind == "links":
+        try:
+            with os.scandir(path) as entries:
+                return all(os.path.exists(entry.path) for entry in entries if entry.is_symlink())
+        except OSError:
+            return False
+    return os.path.exists(path)
 
 
+def check_paths(checks, jobs=4, batch_size=DEPENDENCY_CHECK_BATCH):
+    """
+    Run (kind, path) checks, returning a dictionary of results.
+
+    Checks are deduplicated and sorted, so neighbouring paths share a batch, then run as batches on a bounded pool, as they are mostly stats of slow shared mounts.
+    """
+    checks = sorted(set(checks))
+    batches = [checks[i:i + batch_size] for i in range(0, len(checks), batch_size)]
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        for batch, passed in zip(batches, pool.map(lambda batch: [check_path(*check) for check in batch], batches)):
+            results.update(zip(batch, passed))
+    return results
+
+
+def lmod_parse_version(version):
+    # Approximates Lmod's parseVersion: numeric pieces zero padded to 9 digits, text pieces prefixed with *, terminated with *zfinal.
+    pieces = []
+    for piece in re.findall(r"[0-9]+|[A-Za-z]+", version):
+        pieces.append(piece.zfill(9) if piece.isdigit() else f"*{piece.lower()}")
+    pieces.append("*zfinal")
+    return ".".join(pieces)
+
+
+def lua_string(value):
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+
+
+def lua_value(value, indent=0):
+    # Serialise dicts, lists and scalars as a Lua table constructor, with keys sorted for stable output.
+    pad = "  " * (indent + 1)
+    if isinstance(value, dict):
+        lines = ["{"]
+        for key in sorted(value):
+            lua_key = key if re.match(r"^[A-Za-z_][A-Za-z0-9_]*$", key) else f"[{lua_string(key)}]"
+            lines.append(f"{pad}{lua_key} = {lua_value(value[key], indent + 1)},")
+        lines.append("  " * indent + "}")
+        return "\n".join(lines)
+    elif isinstance(value, (list, tuple)):
+        lines = ["{"]
+        for item in value:
+            lines.append(f"{pad}{lua_value(item, indent + 1)},")
+        lines.append("  " * indent + "}")
+        return "\n".join(lines)
+    elif isinstance(value, bool):
+        return "true" if value else "false"
+    elif isinstance(value, (int, float)):
+        return str(value)
+    else:
+        return lua_string(value)
+
+
+class SpiderCache:
+    """
+    Lmod spider cache (spiderT.lua and its timestamp) for the deployed modulefile tree.
+
+    The per-module entries are also kept in a JSON state file, so deploying or withdrawing only needs to parse the modulefiles which changed before the Lua tables are re-emitted.
+    """
+
+    def __init__(self, cache_dir, modulepath):
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.modulepath = pathlib.Path(modulepath)
+        self.spider_file = pathlib.Path(self.cache_dir, "spiderT.lua")
+        self.timestamp_file = pathlib.Path(self.cache_dir, "timestamp")
+        self.lmodrc_file = pathlib.Path(self.cache_dir, "lmodrc.lua")
+        self.state_file = pathlib.Path(self.cache_dir, "spider-state.json")
+        self.entries = self.load()
+
+    def load(self):
+        # None if there is no usable state, in which case the cache must be rebuilt in full.
+        try:
+            with open(self.state_file, "r") as fp:
+                state = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        if not self.spider_file.exists() or state.get("modulepath") != str(self.modulepath):
+            return None
+        return state.get("entries", {})
+
+    def entry(self, filename):
+        path = pathlib.Path(self.modulepath, filename)
+        info = parse_modulefile(path)
+        version = modulefile_name(filename).name
+        parsed_version = lmod_parse_version(version)
+        entry = {
+            "Version": version,
+            "canonical": version,
+            "fn": str(path),
+            "pV": parsed_version,
+            "wV": parsed_version,
+            "whatis": info["whatis"],
+        }
+        if info["family"] is not None:
+            entry["family"] = info["family"]
+        # Lmod records directories added to PATH, LD_LIBRARY_PATH and MODULEPATH.
+        for vname, key in (("PATH", "pathA"), ("LD_LIBRARY_PATH", "lpathA"), ("MODULEPATH", "mpathA")):
+            paths = [vval.rstrip(":") for name, vval in info["prepend-path"] if name == vname]
+            if paths:
+                entry[key] = paths
+        return entry
+
+    def update(self, changed=(), removed=()):
+        if self.entries is None:
+            self.entries = {}
+        for modulename in removed:
+            self.entries.pop(pathlib.PurePath(modulename).as_posix(), None)
+        # Changed modules are given by filename, as Lua modulefiles carry a suffix.
+        for filename in changed:
+            modulename = modulefile_name(filename).as_posix()
+            try:
+                self.entries[modulename] = self.entry(filename)
+            except FileNotFoundError:
+                self.entries.pop(modulename, None)
+        self.write()
+
+    def rebuild(self, filenames):
+        self.entries = {}
+        self.update(changed=filenames)
+
+    def spider_tables(self):
+        spiderT = {}
+        mpathMapT = {}
+        modulepath = str(self.modulepath)
+        for modulename, entry in self.entries.items():
+            # Modules in the compiler hierarchy belong to their subtree's modulepath, as added by the compiler's module.
+            subtree, name = split_hierarchy(modulename)
+            entry_modulepath = str(pathlib.Path(self.modulepath, subtree)) if subtree is not None else modulepath
+            lua_entry = dict(entry)
+            for key in ("pathA", "lpathA"):
+                if key in lua_entry:
+                    lua_entry[key] = {p: 1 for p in lua_entry[key]}
+            if "mpathA" in lua_entry:
+                for mpath in lua_entry["mpathA"]:
+                    mpathMapT.setdefault(mpath, {})[name] = entry_modulepath
+            # The short name is everything before the version component.
+            sn = str(pathlib.PurePath(name).parent) if "/" in name else name
+            spiderT.setdefault(entry_modulepath, {}).setdefault(sn, {"fileT": {}})["fileT"][name] = lua_entry
+        return spiderT, mpathMapT
+
+    def write(self):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        spiderT, mpathMapT = self.spider_tables()
+        lines = [
+            f"timestampFn = {lua_value([str(self.timestamp_file)])}",
+            "mrcT = {}",
+            "mrcMpathT = {}",
+            f"mpathMapT = {lua_value(mpathMapT)}",
+            f"spiderT = {lua_value(spiderT)}",
+            "",
+        ]
+        # The timestamp is written first, so the cache is never older than it.
+        write_file_atomic(self.timestamp_file, f"{time.time()}\n")
+        write_file_atomic(self.spider_file, "\n".join(lines))
+        write_file_if_changed(self.lmodrc_file, self.lmodrc_string())
+        write_file_atomic(self.state_file, json.dumps({"modulepath": str(self.modulepath), "entries": self.entries}))
+
+    def lmodrc_string(self):
+        scDescriptT = [{"dir": str(self.cache_dir), "timestamp": str(self.timestamp_file)}]
+        return f"scDescriptT = {lua_value(scDescriptT)}\n"
+
+
+class SearchIndex:
+    """
+    Index of module names, versions, families and whatis strings, built when generating so modules can be found without walking or parsing the available tree.
+
+    The text of each module is broken into trigrams, each with a list of the modules containing it. A query term's candidates are the intersection of its trigrams' lists, which are then checked for the term itself. If no module contains every term, those sharing most of the query's trigrams are returned instead, to allow for typos.
+    Updates only change the posting lists of the trigrams of modules added, changed or removed. Modules keep their position, new ones are appended so posting lists stay sorted, and removed ones leave a hole in the names until the index is next built in full.
+    """
+
+    VERSION = 2
+    FIELDS = ("filename", "application", "version", "family", "whatis")
+    # Fraction of the query's trigrams a fuzzy match must share.
+    FUZZY_THRESHOLD = 0.5
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.entries = None
+        self.names = []
+        self.trigrams = {}
+        # Position of each module in names
+        self.ids = {}
+        self._texts = None
+        self.load()
+
+    def load(self):
+        # If there is no usable index, entries is None and it must be rebuilt in full.
+        try:
+            with open(self.path, "r") as fp:
+                index = json.load(fp)
+        except (OSError, ValueError):
+            return
+        if index.get("version") != self.VERSION:
+            return
+        self.entries = index["entries"]
+        self.names = index["names"]
+        self.trigrams = index["trigrams"]
+        self.ids = {name: i for i, name in enumerate(self.names) if name is not None}
+
+    @staticmethod
+    def text(name, entry):
+        return " ".join(x for x in (name, entry["family"], entry["whatis"]) if x).lower()
+
+    @staticmethod
+    def ngrams(text, n=3):
+        return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+    def update(self, modules=(), removed=()):
+        # Apply the modules added or changed and those removed to the stored index, only writing it if anything changed.
+        if self.entries is None:
+            self.rebuild(modules)
+            return
+        changed = False
+        for modulename in removed:
+            changed |= self.remove(pathlib.PurePath(modulename).as_posix())
+        for module in modules:
+            entry = {key: module[key] for key in self.FIELDS}
+            if self.entries.get(module["name"]) != entry:
+                self.remove(module["name"])
+                self.add(module["name"], entry)
+                changed = True
+        if not changed:
+            return
+        # Holes left by removed modules are compacted once they are most of the names.
+        if len(self.names) > 2 * len(self.entries):
+            self.build()
+        self._texts = None
+        self.write()
+
+    def rebuild(self, modules):
+        self.entries = {module["name"]: {key: module[key] for key in self.FIELDS} for module in modules}
+        self.build()
+        self.write()
+
+    def add(self, name, entry):
+        i = len(self.names)
+        self.names.append(name)
+        self.ids[name] = i
+        self.entries[name] = entry
+        for gram in self.ngrams(self.text(name, entry)):
+            self.trigrams.setdefault(gram, []).append(i)
+
+    def remove(self, name):
+        if name not in self.entries:
+            return False
+        i = self.ids.pop(name)
+        for gram in self.ngrams(self.text(name, self.entries.pop(name))):
+            posting = self.trigrams[gram]
+            del posting[bisect.bisect_left(posting, i)]
+            if not len(posting):
+                del self.trigrams[gram]
+        self.names[i] = None
+        return True
+
+    def build(self):
+        # Posting lists refer to modules by their position in the names, to keep the index small.
+        self.names = []
+        self.ids = {}
+        self.trigrams = {}
+        self._texts = None
+        entries, self.entries = self.entries, {}
+        for name in sorted(entries):
+            self.add(name, entries[name])
+
+    def write(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        write_file_atomic(self.path, json.dumps({"version": self.VERSION, "entries": self.entries, "names": self.names, "trigrams": self.trigrams}))
+
+    def texts(self):
+        # Only computed for queries, as most invocations never search.
+        if self._texts is None:
+            self._texts = [self.text(name, self.entries[name]) if name is not None else "" for name in self.names]
+        return self._texts
+
+    def match(self, term):
+        # Modules containing the term, starting from the shortest posting list. Terms shorter than a trigram are checked against every module.
+        texts = self.texts()
+        postings = sorted((self.trigrams.get(gram, []) for gram in self.ngrams(term)), key=len)
+        if not postings:
+            candidates = range(len(self.names))
+        else:
+            candidates = set(postings[0])
+            for posting in postings[1:]:
+                candidates.intersection_update(posting)
+        return {i for i in candidates if term in texts[i]}
+
+    def fuzzy(self, query):
+        # Modules sharing enough of the query's trigrams, with the fraction shared.
+        grams = self.ngrams(query)
+        shared = {}
+        for gram in grams:
+            for i in self.trigrams.get(gram, []):
+                shared[i] = shared.get(i, 0) + 1
+        return {i: count / len(grams) for i, count in shared.items() if count / len(grams) >= self.FUZZY_THRESHOLD}
+
+    def search(self, query):
+        # Pairs of module name and entry, best matches first: the application itself, then matches in names, then in families and whatis.
+        if self.entries is None:
+            return []
+        terms = query.lower().split()
+        if not terms:
+            return []
+        matched = None
+        for term in terms:
+            ids = self.match(term)
+            matched = ids if matched is None else matched & ids
+        if matched:
+            def rank(i):
+                name = self.names[i].lower()
+                application = self.entries[self.names[i]]["application"].lower()
+                return 0 if application in terms else 1 if all(term in name for term in terms) else 2
+            scored = {i: rank(i) for i in matched}
+        else:
+            scored = {i: 1.0 - score for i, score in self.fuzzy(" ".join(terms)).items()}
+        order = sorted(scored, key=lambda i: (scored[i], self.entries[self.names[i]]["application"], lmod_parse_version(self.entries[self.names[i]]["version"])))
+        return [(self.names[i], self.entries[self.names[i]]) for i in order]
+
+
+class PollingWatcher:
+    """
+    Watch directories for changes by polling their (st_dev, st_ino, st_mtime_ns), which also notices directories being created or removed.
+    """
+
+    def __init__(self, paths, interval=5.0):
+        self.interval = interval
+        self._keys = {pathlib.Path(path): ScanCache.directory_key(path) for path in paths}
+
+    def close(self):
+        pass
+
+    def poll(self):
+        changed = set()
+        for path, key in self._keys.items():
+            current = ScanCache.directory_key(path)
+            if current != key:
+                self._keys[path] = current
+                changed.add(path)
+        return changed
+
+    def wait(self, timeout=None):
+        # Block until at least one directory changes, or the timeout expires, returning the changed directories.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            changed = self.poll()
+            if len(changed) or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+            delay = self.interval if deadline is None else min(self.interval, max(0.0, deadline - time.monotonic()))
+            time.sleep(delay)
+
+
+class InotifyWatcher(PollingWatcher):
+    """
+    Watch directories using Linux inotify via ctypes. Directories which cannot be watched (i.e. do not exist yet) are polled instead.
+    """
+
+    IN_ATTRIB = 0x00000004
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_IGNORED = 0x00008000
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = os.O_CLOEXEC
+    WATCH_MASK = IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, paths, interval=5.0):
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError("libc not found")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+        self._fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._watches = {}
+        self.interval = interval
+        self._keys = {}
+        for path in paths:
+            path = pathlib.Path(path)
+            if not self._add_watch(path):
+                self._keys[path] = ScanCache.directory_key(path)
+
+    def _add_watch(self, path):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), self.WATCH_MASK)
+        if wd < 0:
+            return False
+        self._watches[wd] = path
+        return True
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def read_events(self):
+        changed = set()
+        try:
+            data = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset + self.EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size + length
+            path = self._watches.get(wd)
+            if path is None:
+                continue
+            changed.add(path)
+            # The watched directory itself went away, so fall back to polling for its return.
+            if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF | self.IN_IGNORED):
+                del self._watches[wd]
+                self._keys[path] = None
+        return changed
+
+    def poll(self):
+        changed = super().poll()
+        # Directories which have (re)appeared can now be watched directly.
+        for path in changed:
+            if self._keys[path] is not None and self._add_watch(path):
+                del self._keys[path]
+        return changed
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            changed = self.poll()
+            if len(changed):
+                return changed
+            delay = self.interval if len(self._keys) else None
+            if deadline is not None:
+                remaining = max(0.0, deadline - time.monotonic())
+                delay = remaining if delay is None else min(delay, remaining)
+            readable, _, _ = select.select([self._fd], [], [], delay)
+            if readable:
+                changed = self.read_events()
+                if len(changed):
+                    return changed
+            if deadline is not None and time.monotonic() >= deadline:
+                return set()
+
+
+def create_watcher(paths, interval=5.0, polling=False):
+    # Prefer inotify, falling back to polling where it is unavailable.
+    if not polling:
+        try:
+            return InotifyWatcher(paths, interval)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(paths, interval)
+
+
+class DeploymentLock:
+    """
+    Advisory lock held while modifying the deployed tree, so overlapping invocations serialise rather than interleave.
+
+    Uses fcntl.lockf, which unlike flock is forwarded to the server over NFS, so it also serialises invocations on other hosts sharing the tree. The holder's host and pid are written to the lock file for diagnostics.
+    """
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self._fd = None
+
+    def __enter__(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            holder = os.pread(self._fd, 256, 0).decode(errors="replace").strip()
+            print(f"Waiting for {self.path}, held by {holder if holder else 'another invocation'}", file=sys.stderr)
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        os.ftruncate(self._fd, 0)
+        os.pwrite(self._fd, f"{socket.gethostname()} {os.getpid()}\n".encode(), 0)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        os.ftruncate(self._fd, 0)
+        fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+
+class GenerationStore:
+    """
+    Generations of the deployed tree, published by atomically swapping a symlink.
+
+    deployed is a relative symlink to a numbered directory in the generations directory. A new generation is staged as a copy of the current one, modified, then renamed into place and published by replacing the symlink, so readers only ever see a complete tree. The current generation and up to keep previous generations are retained for rollback.
+    """
+
+    def __init__(self, deployed_dir, generations_dir, keep=3):
+        self.deployed_dir = pathlib.Path(deployed_dir)
+        self.generations_dir = pathlib.Path(generations_dir)
+        self.keep = keep
+
+    def generations(self):
+        try:
+            return sorted(int(name) for name in os.listdir(self.generations_dir) if name.isdigit())
+        except FileNotFoundError:
+            return []
+
+    def path(self, generation):
+        return pathlib.Path(self.generations_dir, f"{generation:06d}")
+
+    def current(self):
+        # The published generation, or None if deployed is not a generation.
+        try:
+            target = pathlib.Path(os.readlink(self.deployed_dir))
+        except OSError:
+            return None
+        if target.parent.name != self.generations_dir.name or not target.name.isdigit():
+            return None
+        return int(target.name)
+
+    def adopt(self):
+        # Convert a plain deployed directory into the first generation. Readers may briefly see no deployed directory while this happens, once.
+        if self.current() is not None:
+            return
+        self.generations_dir.mkdir(parents=True, exist_ok=True)
+        generation = max(self.generations(), default=0) + 1
+        if self.deployed_dir.is_dir() and not self.deployed_dir.is_symlink():
+            os.rename(self.deployed_dir, self.path(generation))
+        else:
+            self.path(generation).mkdir()
+        self.swap(generation)
+
+    def stage(self):
+        # A private copy of the current generation to modify. Deployed modulefiles are symlinks, so this is cheap.
+        self.adopt()
+        staging = pathlib.Path(self.generations_dir, f".staging-{socket.gethostname()}-{os.getpid()}")
+        if staging.exists():
+            shutil.rmtree(staging)
+        shutil.copytree(self.path(self.current()), staging, symlinks=True)
+        return staging
+
+    def discard(self, staging):
+        shutil.rmtree(staging, ignore_errors=True)
+
+    def publish(self, staging):
+        generation = max(self.generations(), default=0) + 1
+        os.rename(staging, self.path(generation))
+        self.swap(generation)
+        self.prune()
+        return generation
+
+    def swap(self, generation):
+        link = self.deployed_dir.with_name(f".{self.deployed_dir.name}.{os.getpid()}.tmp")
+        os.symlink(pathlib.Path(self.generations_dir.name, self.path(generation).name), link)
+        os.replace(link, self.deployed_dir)
+
+    def prune(self):
+        current = self.current()
+        generations = self.generations()
+        retained = set(generations[-(self.keep + 1):]) | {current}
+        for generation in generations:
+            if generation not in retained:
+                shutil.rmtree(self.path(generation), ignore_errors=True)
+
+    def rollback(self):
+        # Publish the newest generation older than the current one.
+        current = self.current()
+        previous = [g for g in self.generations() if current is not None and g < current]
+        if not len(previous):
+            raise Exception(f"No previous generation of {self.deployed_dir} to roll back to")
+        self.swap(previous[-1])
+        return previous[-1]
+
+
+def hidden_entry(entry, top_level):
+    # Hidden files are markers, i.e. .version, not modulefiles, as for Lmod. The compiler hierarchy is the only hidden directory.
+    return entry.name.startswith(".") and not (entry.name == COMPILER_HIERARCHY_DIR and top_level and entry.is_dir())
+
+
+def scan_modulefiles(root, prefix=()):
+    """
+    Stream the modulefiles below root as (components, suffix) pairs, where components excludes any .lua suffix.
+
+    Uses os.scandir, which avoids a stat per entry on most filesystems, and interns components so names repeated across the tree (versions, groups) are stored once.
+    """
+    try:
+        entries = os.scandir(root)
+    except (FileNotFoundError, NotADirectoryError):
+        return
+    with entries:
+        directories = []
+        for entry in entries:
+            name = entry.name
+            if hidden_entry(entry, prefix == ()):
+                continue
+            if entry.is_dir():
+                # As os.walk, symlinks to directories are neither modulefiles nor followed.
+                if not entry.is_symlink():
+                    directories.append((entry.path, sys.intern(name)))
+            elif name.endswith(".lua") and len(name) > 4:
+                yield prefix + (sys.intern(name[:-4]),), ".lua"
+            else:
+                yield prefix + (sys.intern(name),), ""
+    # Descend after closing the handle, so only one directory is open at a time.
+    for path, name in directories:
+        yield from scan_modulefiles(path, prefix + (name,))
+
+
+# Shared by leaf nodes, which are most of the trie, so they don't each hold an empty dict.
+EMPTY_CHILDREN = types.MappingProxyType({})
+
+class ModulefileTrie:
+    """
+    Prefix index of modulefile paths, keyed on path components.
+
+    Each node records whether it is itself a modulefile and how many modulefiles exist at or below it, so membership and group queries cost O(depth) and listing a group costs O(depth + result size).
+    """
+    __slots__ = ("children", "is_file", "count", "suffix")
+
+    def __init__(self):
+        self.children = EMPTY_CHILDREN
+        self.is_file = False
+        self.count = 0
+        # Filename suffix of the modulefile, i.e. .lua
+        self.suffix = ""
+
+    def find(self, parts):
+        node = self
+        for part in parts:
+            node = node.children.get(part)
+            if node is None:
+                return None
+        return node
+
+    def insert(self, parts, suffix=""):
+        # Walk down, creating nodes as required, then update counts along the path if this is a new file.
+        path = [self]
+        node = self
+        for part in parts:
+            child = node.children.get(part)
+            if child is None:
+                child = ModulefileTrie()
+                if node.children is EMPTY_CHILDREN:
+                    node.children = {}
+                node.children[part] = child
+            node = child
+            path.append(node)
+        if node.is_file:
+            node.suffix = suffix
+            return False
+        node.is_file = True
+        node.suffix = suffix
+        for n in path:
+            n.count += 1
+        return True
+
+    def remove(self, parts):
+        path = [self]
+        node = self
+        for part in parts:
+            node = node.children.get(part)
+            if node is None:
+                return False
+            path.append(node)
+        if not node.is_file:
+            return False
+        node.is_file = False
+        for n in path:
+            n.count -= 1
+        # Prune nodes which no longer lead to any files.
+        for parent, part, child in zip(reversed(path[:-1]), reversed(parts), reversed(path[1:])):
+            if child.count == 0:
+                del parent.children[part]
+                if not parent.children:
+                    parent.children = EMPTY_CHILDREN
+            else:
+                break
+        return True
+
+    def iter_files(self, prefix=()):
+        # Depth first, with children visited in sorted order so output matches sorted(pathlib.Path)
+        if self.is_file:
+            yield prefix
+        for name in sorted(self.children):
+            yield from self.children[name].iter_files(prefix + (name,))
+
+    def copy(self):
+        result = ModulefileTrie()
+        result.is_file = self.is_file
+        result.count = self.count
+        result.suffix = self.suffix
+        if self.children:
+            result.children = {name: child.copy() for name, child in self.children.items()}
+        return result
+
+    def difference(self, other):
+        # Parallel walk of both tries. Subtrees absent from other are copied wholesale.
+        result = ModulefileTrie()
+        if self.is_file and not other.is_file:
+            result.is_file = True
+            result.count = 1
+            result.suffix = self.suffix
+        for name, child in self.children.items():
+            other_child = other.children.get(name)
+            sub = child.copy() if other_child is None else child.difference(other_child)
+            if sub.count:
+                if result.children is EMPTY_CHILDREN:
+                    result.children = {}
+                result.children[name] = sub
+                result.count += sub.count
+        return result
+
 
 class ModulefileDirectory:
+    """
+    The modulefiles within a directory, indexed by module name. Lua modulefiles are named without their .lua suffix, which is recorded so the file can be found again.
+    """
 
     def __init__(self, root=None, modulefiles=None):
         self._root = root
-        self._modulefiles = modulefiles if modulefiles is not None else self.load_modulefiles()
-        self._itern = 0
+        self._index = ModulefileTrie()
+        if modulefiles is None:
+            # Insert components straight from the scan, without building a list of paths first.
+            for parts, suffix in scan_modulefiles(self._root):
+                self._index.insert(parts, suffix)
+        else:
+            for modulefile in modulefiles:
+                self.append(modulefile)
 
     """
     Determine if the provided path is to an explcicit modulefile, or the parent of one or more modulepaths.
     """
     def __contains__(self, modulepath):
-        path = pathlib.Path(modulepath)
-        # Iterate the list of files, checking if in the parents of
-        for f in self._modulefiles:
-            if path == f:
-                return True
-            elif path in f.parents:
-                return True
-        # Flase if not found buy now
-        return False
+        node = self._index.find(modulefile_name(modulepath).parts)
+        return node is not None and node.count > 0
 
     def __len__(self):
-        return len(self._modulefiles)
+        return self._index.count
 
     def __iter__(self):
-        self._itern = 0
-        return self
-
-    def __next__(self):
-        if self._itern < len(self):
-            item = self._modulefiles[self._itern]
-            self._itern += 1
-            return item
-        else:
-            raise StopIteration
+        for parts in self._index.iter_files():
+            yield pathlib.Path(*parts)
 
     def __sub__(self, other):
         return self.difference(other)
@@ -487,91 +2719,525 @@ class ModulefileDirectory:
         result = cls.__new__(cls)
         memo[id(self)] = result
         for k, v in self.__dict__.items():
-            setattr(result, k, deepcopy(v, memo))
+            setattr(result, k, copy.deepcopy(v, memo))
         return result
 
+    @classmethod
+    def _from_index(cls, root, index):
+        result = cls(root=root, modulefiles=[])
+        result._index = index
+        return result
+
+    @classmethod
+    def from_names(cls, root, names):
+        # From (module name, suffix) pairs, i.e. as recorded in a manifest, without a pathlib.Path per modulefile.
+        result = cls(root=root, modulefiles=[])
+        for name, suffix in names:
+            result._index.insert(tuple(sys.intern(part) for part in name.split("/")), suffix)
+        return result
 
     def is_file(self, modulepath):
-        modulepath = pathlib.Path(modulepath)
-        return modulepath in self._modulefiles
+        node = self._index.find(modulefile_name(modulepath).parts)
+        return node is not None and node.is_file
 
     def is_group(self, modulepath):
-        modulepath = pathlib.Path(modulepath)
-        for f in self.modulefiles:
-            if modulepath in f.parents:
-                return True
-        return False
+        node = self._index.find(pathlib.Path(modulepath).parts)
+        return node is not None and len(node.children) > 0
 
     def exists(self, modulepath):
         modulepath = pathlib.Path(modulepath)
         return self.is_file(modulepath) or self.is_group(modulepath)
 
     def append(self, modulefile):
-        if modulefile not in self._modulefiles:
-            self._modulefiles.append(modulefile)
+        modulefile = pathlib.Path(modulefile)
+        self._index.insert(modulefile_name(modulefile).parts, ".lua" if modulefile.suffix == ".lua" else "")
 
     def remove(self, modulefile):
-        if modulefile in self._modulefiles:
-            self._modulefiles.remove(modulefile)
+        self._index.remove(modulefile_name(modulefile).parts)
+
+    def filename(self, modulepath):
+        # The path of the modulefile relative to the root, including any suffix.
+        modulepath = modulefile_name(modulepath)
+        node = self._index.find(modulepath.parts)
+        if node is None or not node.is_file:
+            return pathlib.Path(modulepath)
+        return pathlib.Path(str(modulepath) + node.suffix)
 
     def modulefiles(self, modulepath=None):
-        if modulepath is None:
-            return sorted(self._modulefiles)
-        else:
-            modulepath = pathlib.Path(modulepath)
-            modulefiles = []
-            for f in self._modulefiles:
-                if modulepath == f or modulepath in f.parents:
-                    modulefiles.append(f)
-            return sorted(modulefiles)
+        return list(self.iter_modulefiles(modulepath))
+
+    def iter_modulefiles(self, modulepath=None):
+        # As modulefiles(), but yielding names one at a time.
+        parts = modulefile_name(modulepath).parts if modulepath is not None else ()
+        node = self._index.find(parts)
+        if node is None:
+            return
+        for f in node.iter_files(parts):
+            yield pathlib.Path(*f)
 
     """
     Get a list of modules included not included in other.
     """
     def difference(self, other):
         assert(isinstance(other, ModulefileDirectory))
+        return ModulefileDirectory._from_index(self._root, self._index.difference(other._index))
 
-        a = set(self._modulefiles)
-        b = set(other._modulefiles)
 
-        modulefiles = list(a - b)
-        return ModulefileDirectory(root=self._root, modulefiles=modulefiles)
+    def load_modulefiles(self):
+        # Stream the modulefiles on disk relative to the root, including any suffix, without holding them in memory.
+        for parts, suffix in scan_modulefiles(self._root):
+            yield pathlib.Path(*parts[:-1], parts[-1] + suffix)
 
 
-    def load_modulefiles(self):
-        modulefiles = []
-        for root, dirs, files in os.walk(self._root):
-            for file in files:
-                absmodulepath = pathlib.Path(root, file)
-                modulepath = absmodulepath.relative_to(self._root)
-                modulefiles.append(modulepath)        
-        return modulefiles
+class Manifest:
+    """
+    SQLite record of the modulefiles in the available and deployed trees: each module's origin, content hash and symlink target, and the identity and mtime of each directory.
+
+    Origins are generated (written by generate), deployed (linked by deploy) or external (found on disk, i.e. hand-written), for which the hash is not known. Adding, removing or renaming an entry changes its directory's mtime, so a tree is read by stating each recorded directory and rescanning only those which changed. Changes made by this script are recorded in a transaction, and the directories they touched rescanned before it commits.
+    """
+
+    SCHEMA_VERSION = 1
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS modules (tree TEXT NOT NULL, name TEXT NOT NULL, suffix TEXT NOT NULL, directory TEXT NOT NULL, origin TEXT NOT NULL, hash TEXT, target TEXT, PRIMARY KEY (tree, name))",
+        "CREATE INDEX IF NOT EXISTS modules_directory ON modules (tree, directory)",
+        "CREATE TABLE IF NOT EXISTS directories (tree TEXT NOT NULL, path TEXT NOT NULL, parent TEXT, key TEXT NOT NULL, PRIMARY KEY (tree, path))",
+        "CREATE INDEX IF NOT EXISTS directories_parent ON directories (tree, parent)",
+    )
+
+    def __init__(self, path, readonly=False):
+        self.path = pathlib.Path(path)
+        self._depth = 0
+        # Directories changed within the current transaction, and the root of their tree.
+        self._touched = {}
+        if readonly:
+            # i.e. for dry runs, which must not create or change it.
+            self.connection = sqlite3.connect(f"file:{urllib.parse.quote(str(self.path))}?mode=ro", uri=True, timeout=60)
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(self.path), timeout=60)
+        with self.connection:
+            if self.connection.execute("PRAGMA user_version").fetchone()[0] != self.SCHEMA_VERSION:
+                self.connection.execute("DROP TABLE IF EXISTS modules")
+                self.connection.execute("DROP TABLE IF EXISTS directories")
+            for statement in self.SCHEMA:
+                self.connection.execute(statement)
+            self.connection.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+
+    @classmethod
+    def open_readonly(cls, path):
+        # The manifest if it exists with the current schema, otherwise None.
+        try:
+            manifest = cls(path, readonly=True)
+            if manifest.connection.execute("PRAGMA user_version").fetchone()[0] == cls.SCHEMA_VERSION:
+                return manifest
+            manifest.close()
+        except sqlite3.Error:
+            pass
+        return None
+
+    def close(self):
+        self.connection.close()
+
+    @staticmethod
+    def directory_key(path):
+        key = ScanCache.directory_key(path)
+        return json.dumps(key) if key is not None else None
+
+    @staticmethod
+    def split_filename(filename):
+        # The module name and suffix of a modulefile, i.e. (gcc/12, "") or (cuda/12.4, ".lua")
+        filename = pathlib.PurePath(filename)
+        name = modulefile_name(filename).as_posix()
+        return name, filename.suffix if filename.suffix == ".lua" else ""
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # Nested transactions join the outermost, which rescans the directories touched within it before committing.
+        self._depth += 1
+        try:
+            if self._depth == 1:
+                with self.connection:
+                    yield
+                    self.rescan_touched()
+            else:
+                yield
+        finally:
+            self._depth -= 1
+            if self._depth == 0:
+                self._touched = {}
+
+    def touch(self, tree, root, directory):
+        self._touched[(tree, directory)] = root
+
+    def record(self, tree, root, filename, origin, digest=None, target=None):
+        name, suffix = self.split_filename(filename)
+        directory = posixpath.dirname(name)
+        self.connection.execute("INSERT OR REPLACE INTO modules VALUES (?, ?, ?, ?, ?, ?, ?)", (tree, name, suffix, directory, origin, digest, target))
+        self.touch(tree, root, directory)
+
+    def forget(self, tree, root, modulename):
+        name = pathlib.PurePath(modulename).as_posix()
+        self.connection.execute("DELETE FROM modules WHERE tree = ? AND name = ?", (tree, name))
+        self.touch(tree, root, posixpath.dirname(name))
+
+    def names(self, tree):
+        return self.connection.execute("SELECT name, suffix FROM modules WHERE tree = ?", (tree,))
+
+    def modules(self, tree):
+        # Every recorded modulefile of the tree, as dictionaries of its columns.
+        cursor = self.connection.execute("SELECT name, suffix, origin, hash, target FROM modules WHERE tree = ? ORDER BY name", (tree,))
+        for name, suffix, origin, digest, target in cursor:
+            yield {"name": name, "filename": name + suffix, "origin": origin, "hash": digest, "target": target}
+
+    def verify(self, tree, root):
+        # Rescan directories whose identity or mtime differ from those recorded, returning the modulefiles added and removed. With nothing recorded, the whole tree is scanned.
+        changes = {"added": [], "removed": [], "rescanned": 0}
+        rows = self.connection.execute("SELECT path, key FROM directories WHERE tree = ?", (tree,)).fetchall()
+        if not len(rows):
+            rows = [("", None)]
+        changed = [path for path, key in rows if self.directory_key(pathlib.Path(root, path)) != key]
+        with self.transaction():
+            for path in sorted(changed):
+                self.rescan(tree, root, path, changes)
+        return changes
+
+    def rescan_touched(self):
+        # Removing or creating a directory changes its parent too, which may itself have been removed or created.
+        touched = {}
+        for (tree, directory), root in self._touched.items():
+            touched[(tree, directory)] = root
+            while directory and (not pathlib.Path(root, directory).is_dir() or not self.connection.execute("SELECT 1 FROM directories WHERE tree = ? AND path = ?", (tree, directory)).fetchone()):
+                directory = posixpath.dirname(directory)
+                touched[(tree, directory)] = root
+        self._touched = {}
+        changes = {"added": [], "removed": [], "rescanned": 0}
+        # Deepest first, so new subdirectories are already recorded when their parent is rescanned.
+        for tree, directory in sorted(touched, key=lambda key: key[1].count("/") + (1 if key[1] else 0), reverse=True):
+            self.rescan(tree, touched[(tree, directory)], directory, changes)
+
+    def rescan(self, tree, root, directory, changes):
+        # Reconcile the recorded entries of a directory with those on disk, scanning any new subdirectories in full. Entries already recorded keep their origin.
+        path = pathlib.Path(root, directory)
+        # The key is taken before scanning, so a change during the scan is picked up next time.
+        key = self.directory_key(path)
+        try:
+            with os.scandir(path) as it:
+                entries = list(it)
+        except (FileNotFoundError, NotADirectoryError):
+            self.forget_directory(tree, directory, changes)
+            return
+        changes["rescanned"] += 1
+        prefix = directory + "/" if directory else ""
+        known = dict(self.connection.execute("SELECT name, suffix FROM modules WHERE tree = ? AND directory = ?", (tree, directory)))
+        known_directories = {row[0] for row in self.connection.execute("SELECT path FROM directories WHERE tree = ? AND parent = ?", (tree, directory))}
+        found = set()
+        found_directories = set()
+        for entry in entries:
+            if hidden_entry(entry, directory == ""):
+                continue
+            if entry.is_dir():
+                # As when walking, symlinks to directories are neither modulefiles nor followed.
+                if not entry.is_symlink():
+                    child = prefix + entry.name
+                    found_directories.add(child)
+                    if child not in known_directories:
+                        self.rescan(tree, root, child, changes)
+                continue
+            name, suffix = self.split_filename(prefix + entry.name)
+            found.add(name)
+            if known.get(name) != suffix:
+                target = os.readlink(entry.path) if entry.is_symlink() else None
+                self.connection.execute("INSERT OR REPLACE INTO modules VALUES (?, ?, ?, ?, ?, ?, ?)", (tree, name, suffix, directory, "external", None, target))
+                changes["added"].append(name + suffix)
+        for name, suffix in known.items():
+            if name not in found:
+                self.connection.execute("DELETE FROM modules WHERE tree = ? AND name = ?", (tree, name))
+                changes["removed"].append(name + suffix)
+        for child in known_directories - found_directories:
+            self.forget_directory(tree, child, changes)
+        if key is not None:
+            parent = posixpath.dirname(directory) if directory else None
+            self.connection.execute("INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?)", (tree, directory, parent, key))
+
+    def forget_directory(self, tree, directory, changes):
+        # Forget a directory which no longer exists, along with everything below it.
+        if directory:
+            prefix = directory + "/"
+            match = "(directory = ? OR substr(directory, 1, ?) = ?)"
+            arguments = (tree, directory, len(prefix), prefix)
+        else:
+            match = "1"
+            arguments = (tree,)
+        for name, suffix in self.connection.execute(f"SELECT name, suffix FROM modules WHERE tree = ? AND {match}", arguments):
+            changes["removed"].append(name + suffix)
+        self.connection.execute(f"DELETE FROM modules WHERE tree = ? AND {match}", arguments)
+        self.connection.execute(f"DELETE FROM directories WHERE tree = ? AND {match.replace('directory', 'path')}", arguments)
+
+
+class LinkExecutor:
+    """
+    Batched creation and removal of deployed symlinks, for groups of modulefiles on network filesystems where every operation is a round trip.
+
+    The directories links need are created once each, shallowest first, with those at the same depth created concurrently. Links are then created or removed on a bounded thread pool. After removal, directories left empty are pruned in one bottom-up pass. Failures are collected per module rather than stopping the batch.
+    """
+
+    def __init__(self, jobs=4):
+        self.jobs = max(1, jobs)
+
+    def map(self, function, items):
+        # Pairs of each item and the exception it raised, if any. Small batches aren't worth a pool.
+        def attempt(item):
+            try:
+                function(item)
+                return None
+            except Exception as e:
+                return e
+        if self.jobs == 1 or len(items) <= 1:
+            return [(item, attempt(item)) for item in items]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.jobs, len(items))) as pool:
+            return list(zip(items, pool.map(attempt, items)))
+
+    def make_directories(self, directories, root):
+        # Create the directories and any missing parents below root, returning those which could not be.
+        root = pathlib.Path(root)
+        root.mkdir(parents=True, exist_ok=True)
+        needed = set()
+        for directory in directories:
+            directory = pathlib.Path(directory)
+            while directory not in needed and root in directory.parents:
+                needed.add(directory)
+                directory = directory.parent
+        levels = {}
+        for directory in needed:
+            levels.setdefault(len(directory.parts), []).append(directory)
+        failed = {}
+        for depth in sorted(levels):
+            for directory, error in self.map(lambda d: d.mkdir(exist_ok=True), levels[depth]):
+                if error is not None:
+                    failed[directory] = error
+        return failed
+
+    def link(self, links, directories, root):
+        # Create (modulename, link, source) symlinks, after the given directories. Returns the links created, and errors by module name.
+        failed = self.make_directories(directories, root)
+        errors = {}
+        pending = []
+        for item in links:
+            if item[1].parent in failed:
+                errors[item[0]] = failed[item[1].parent]
+            else:
+                pending.append(item)
+        linked = []
+        for item, error in self.map(lambda item: item[1].symlink_to(item[2]), pending):
+            if error is None:
+                linked.append(item)
+            else:
+                errors[item[0]] = error
+        return linked, errors
+
+    @staticmethod
+    def remove_link(path):
+        if not stat.S_ISLNK(os.lstat(path).st_mode):
+            raise Exception("Cannot withdraw non-symlink modulefile.")
+        os.unlink(path)
+
+    def unlink(self, paths):
+        # Remove (modulename, path) symlinks, refusing anything else. Returns those removed, and errors by module name.
+        unlinked = []
+        errors = {}
+        for item, error in self.map(lambda item: self.remove_link(item[1]), paths):
+            if error is None:
+                unlinked.append(item)
+            else:
+                errors[item[0]] = error
+        return unlinked, errors
+
+    def prune(self, directories, root):
+        # Remove directories below root left empty, other than hidden markers (i.e. .version), deepest first. Each directory is checked once, after any of its subdirectories which were removed.
+        root = pathlib.Path(root)
+        pending = [(-len(d.parts), str(d), d) for d in {pathlib.Path(d) for d in directories} if root in d.parents]
+        heapq.heapify(pending)
+        queued = {item[2] for item in pending}
+        removed = []
+        while pending:
+            depth, key, directory = heapq.heappop(pending)
+            try:
+                with os.scandir(directory) as it:
+                    entries = list(it)
+                if not all(entry.name.startswith(".") and not entry.is_dir() for entry in entries):
+                    continue
+                for entry in entries:
+                    os.unlink(entry.path)
+                directory.rmdir()
+            except FileNotFoundError:
+                continue
+            except OSError:
+                # i.e. an entry was added meanwhile
+                continue
+            removed.append(directory)
+            parent = directory.parent
+            if root in parent.parents and parent not in queued:
+                queued.add(parent)
+                heapq.heappush(pending, (-len(parent.parts), str(parent), parent))
+        return removed
+
+
+def in_manifest_transaction(function):
+    # Decorator recording a manager method's changes to the manifest as one transaction.
+    @functools.wraps(function)
+    def wrapper(self, *args, **kwargs):
+        with self.manifest_transaction():
+            return function(self, *args, **kwargs)
+    return wrapper
 
 
 class ModulefileManager:
     # Paths relative to the script/modules
     SYMLINKS_DIR = pathlib.Path(PYMODULE_DIR, "..", "symlinks").resolve()
     AVAILABLE_MODULES_DIR = pathlib.Path(PYMODULE_DIR, "..", "available").resolve()
-    DEPLOYED_MODULES_DIR = pathlib.Path(PYMODULE_DIR, "..", "deployed").resolve()
-
-    def __init__(self, verbose=False):
-        self.available = self.find_available()
-        self.deployed = self.find_deployed()
+    # Not resolved, as deployed may be a symlink to a generation
+    DEPLOYED_MODULES_DIR = pathlib.Path(pathlib.Path(PYMODULE_DIR, "..").resolve(), "deployed")
+    DEPLOYED_GENERATIONS_DIR = pathlib.Path(pathlib.Path(PYMODULE_DIR, "..").resolve(), ".deployed-generations")
+    DEPLOY_LOCK_FILE = pathlib.Path(pathlib.Path(PYMODULE_DIR, "..").resolve(), ".deploy.lock")
+
+    SCAN_CACHE_FILE = pathlib.Path(CACHE_DIR, "scan-cache.json")
+    PROBE_CACHE_FILE = pathlib.Path(CACHE_DIR, "probe-cache.json")
+    REGISTRY_CACHE_FILE = pathlib.Path(CACHE_DIR, "registry.json")
+    DEPLOY_POLICY_FILE = pathlib.Path(CACHE_DIR, "deploy-policy.json")
+    SEARCH_INDEX_FILE = SEARCH_INDEX_FILE
+    MANIFEST_FILE = MANIFEST_FILE
+    APPLICATIONS_DIR = APPLICATIONS_DIR
+    SPIDER_CACHE_DIR = pathlib.Path(CACHE_DIR, "lmod")
+
+    def __init__(self, verbose=False, use_cache=True, refresh_cache=False, incremental=True, spider_cache=True, modulefile_format="tcl", jobs=4, root=None, applications=None, dry_run=False, applications_dir=None, generations=None, manifest=True):
+        # Optionally manage a tree other than the one alongside this script, i.e. for testing / benchmarking.
+        if root is not None:
+            root = pathlib.Path(root).resolve()
+            self.SYMLINKS_DIR = pathlib.Path(root, "symlinks")
+            self.AVAILABLE_MODULES_DIR = pathlib.Path(root, "available")
+            self.DEPLOYED_MODULES_DIR = pathlib.Path(root, "deployed")
+            self.DEPLOYED_GENERATIONS_DIR = pathlib.Path(root, ".deployed-generations")
+            self.DEPLOY_LOCK_FILE = pathlib.Path(root, ".deploy.lock")
+            self.SCAN_CACHE_FILE = pathlib.Path(root, ".cache", "scan-cache.json")
+            self.PROBE_CACHE_FILE = pathlib.Path(root, ".cache", "probe-cache.json")
+            self.REGISTRY_CACHE_FILE = pathlib.Path(root, ".cache", "registry.json")
+            self.DEPLOY_POLICY_FILE = pathlib.Path(root, ".cache", "deploy-policy.json")
+            self.SEARCH_INDEX_FILE = pathlib.Path(root, ".cache", "search-index.json")
+            self.MANIFEST_FILE = pathlib.Path(root, ".cache", "manifest.sqlite")
+            self.SPIDER_CACHE_DIR = pathlib.Path(root, ".cache", "lmod")
+        # The deployed directory as it appears on MODULEPATH, even while changes are staged elsewhere.
+        self.modulepath = self.DEPLOYED_MODULES_DIR
+        # Applications to generate modules for, defaulting to those in the applications directory
+        self.applications = applications
+        if applications_dir is not None:
+            self.APPLICATIONS_DIR = pathlib.Path(applications_dir).resolve()
+        # Views of the available and deployed trees, loaded on first use and then kept in step with this instance's own changes.
+        self._available = None
+        self._deployed = None
+        # Record of both trees, read rather than walking them unless disabled. Dry runs walk the trees, so as not to write to it.
+        self.use_manifest = manifest
+        self._manifest = None
+        # Whether this instance holds the deployment lock.
+        self._locked = False
         self.verbose = verbose
+        self.use_cache = use_cache
+        self.refresh_cache = refresh_cache
+        self.incremental = incremental
+        self.spider_cache = spider_cache
+        self.modulefile_format = modulefile_format
+        self.jobs = jobs
+        self.dry_run = dry_run
+        # If set, changes to deployed are staged and published as a new generation, keeping this many previous generations.
+        self.generations = generations
+        # Within generation(), the store changes are published to, and the staged copy of deployed once anything changes.
+        self._generation_store = None
+        self._staging = None
+        self._deployed_changes = 0
+        # Deployed modules changed by this invocation, to be refreshed in the spider cache.
+        self._spider_changed = set()
+        self._spider_removed = set()
+        self._spider_rebuild = False
 
         
+    @property
+    def available(self):
+        if self._available is None:
+            self.find_available()
+        return self._available
+
+    @property
+    def deployed(self):
+        if self._deployed is None:
+            self.find_deployed()
+        return self._deployed
+
+    @property
+    def manifest(self):
+        # Dry runs refuse any change to the trees, so there is nothing for them to record.
+        if self._manifest is None and self.use_manifest and not self.dry_run:
+            # SQLite's own locking can't be relied on over NFS, so the manifest is only opened, read and written under the deployment lock.
+            with self.lock():
+                self._manifest = Manifest(self.MANIFEST_FILE)
+        return self._manifest
+
+    @contextlib.contextmanager
+    def manifest_transaction(self):
+        if self.manifest is None:
+            yield
+            return
+        with self.lock(), self.manifest.transaction():
+            yield
+
+    def manifest_record(self, tree, root, filename, origin, digest=None, target=None):
+        if self.manifest is not None:
+            self.manifest.record(tree, root, filename, origin, digest, target)
+
+    def manifest_forget(self, tree, root, modulename):
+        if self.manifest is not None:
+            self.manifest.forget(tree, root, modulename)
+
+    def load_tree(self, tree, root):
+        # From the manifest, once directories changed since they were recorded have been rescanned, otherwise by walking the tree.
+        if self.manifest is None:
+            return ModulefileDirectory(root)
+        with self.lock():
+            self.manifest.verify(tree, root)
+            return ModulefileDirectory.from_names(root, self.manifest.names(tree))
+
     def find_available(self):
-        self.available = ModulefileDirectory(self.AVAILABLE_MODULES_DIR)
-        return self.available
+        with PROFILER.phase("load available"):
+            self._available = self.load_tree("available", self.AVAILABLE_MODULES_DIR)
+        return self._available
 
     def find_deployed(self):
-        self.deployed = ModulefileDirectory(self.DEPLOYED_MODULES_DIR)
-        return self.deployed
+        with PROFILER.phase("load deployed"):
+            self._deployed = self.load_tree("deployed", self.DEPLOYED_MODULES_DIR)
+        return self._deployed
+
+    def verify(self):
+        # Reconcile the manifest with both trees, reporting any changes made other than by this script.
+        if self.manifest is None:
+            print("Error: The manifest is disabled, there is nothing to verify")
+            return
+        for tree, root in (("available", self.AVAILABLE_MODULES_DIR), ("deployed", self.DEPLOYED_MODULES_DIR)):
+            with self.lock():
+                changes = self.manifest.verify(tree, root)
+            OUTPUT.count(f"verify {tree}", f"Manifest of {tree}: {changes['rescanned']} directories rescanned, {len(changes['added'])} modulefiles added, {len(changes['removed'])} removed", rescanned=changes["rescanned"], added=len(changes["added"]), removed=len(changes["removed"]))
+            if OUTPUT.quiet:
+                continue
+            for filename in changes["added"]:
+                OUTPUT.entry(tree, modulefile_name(filename), pathlib.Path(root, filename), f"\tadded   {filename}", action="add")
+            for filename in changes["removed"]:
+                OUTPUT.entry(tree, modulefile_name(filename), pathlib.Path(root, filename), f"\tremoved {filename}", action="remove")
+        # The views may predate the changes found.
+        self.reload()
+
+    def reload(self):
+        # Discard the views of both trees, i.e. if they may have been changed by something else. They are walked again when next used.
+        self._available = None
+        self._deployed = None
 
     def not_deployed_modulefiles(self):
-        self.find_available()
-        self.find_deployed()
-
         not_deployed = self.available - self.deployed
         return not_deployed.modulefiles()
 
@@ -580,36 +3246,40 @@ class ModulefileManager:
         deployed_count = str(len(self.deployed))
         str_width = max(len(available_count), len(deployed_count))
 
-        print(f"Modules Available: {available_count: >{str_width}}")
-        print(f"Modules Deployed : {deployed_count: >{str_width}}")
+        OUTPUT.count("available", f"Modules Available: {available_count: >{str_width}}", count=len(self.available))
+        OUTPUT.count("deployed", f"Modules Deployed : {deployed_count: >{str_width}}", count=len(self.deployed))
+
+    def list_modules(self, state, modules, root):
+        # Modules are already in sorted order in the index, so are streamed as they are visited.
+        OUTPUT.count(state, f"{len(modules)} modules {state}", count=len(modules))
+        if OUTPUT.quiet:
+            return
+        for name in modules:
+            OUTPUT.entry(state, name, pathlib.Path(root, modules.filename(name)), f"  {name}")
 
     def list_available(self):
-        print(f"{len(self.available)} modules available")
-        for name in sorted(self.available):
-            print(f"  {name}")
+        self.list_modules("available", self.available, self.AVAILABLE_MODULES_DIR)
 
     def list_deployed(self):
-        print(f"{len(self.deployed)} modules deployed")
-        for name in sorted(self.deployed):
-            print(f"  {name}")
+        self.list_modules("deployed", self.deployed, self.DEPLOYED_MODULES_DIR)
 
     def modulename_from_path(self, modulepath):
         # If the path includes the available path, return the module name
         modulepath = pathlib.Path(modulepath).resolve()
         if self.AVAILABLE_MODULES_DIR in modulepath.parents:
-            return modulepath.relative_to(self.AVAILABLE_MODULES_DIR)
+            return modulefile_name(modulepath.relative_to(self.AVAILABLE_MODULES_DIR))
         # elif the path includes the deployed path, return the modulename
         elif self.DEPLOYED_MODULES_DIR in modulepath.parents:
-            return modulepath.relative_to(self.DEPLOYED_MODULES_DIR)
+            return modulefile_name(modulepath.relative_to(self.DEPLOYED_MODULES_DIR))
         # else raise an error.
         else:
             raise Exception(f"{modulepath} is neither available or deployed")
 
     def avaiable_path(self, modulename):
-        return pathlib.Path(self.AVAILABLE_MODULES_DIR, modulename)
+        return pathlib.Path(self.AVAILABLE_MODULES_DIR, self.available.filename(modulename))
 
     def deployed_path(self, modulename):
-        return pathlib.Path(self.DEPLOYED_MODULES_DIR, modulename)
+        return pathlib.Path(self.DEPLOYED_MODULES_DIR, self.deployed.filename(modulename))
 
     def is_available(self, modulename):
         modulename = pathlib.Path(modulename)
@@ -641,141 +3311,594 @@ class ModulefileManager:
         return self.is_available(modulename) or self.is_deployed(modulename)
 
 
+    def link_executor(self):
+        return LinkExecutor(self.jobs)
+
+    def refuse_dry_run(self, action):
+        # Dry runs take neither the lock nor the manifest, so must not change anything.
+        if self.dry_run:
+            raise Exception(f"Cannot {action} during a dry run")
+
+    @profile_phase("deploy", by_module=True)
+    @in_manifest_transaction
     def deploy(self, modulepath):
         # @todo add some kind of dependency checking.
         modulepath = pathlib.Path(modulepath)
         # A module is deployed by creating a symlink in the deployed directory, if the module is not already deplyed.
         if self.is_available(modulepath):
             # Get the list of modules to acutally deploy, incase it is a group.
-            modulefiles = self.available.modulefiles(modulepath)
-            for modulename in modulefiles:
-                if not self.is_deployed(modulename):
-                    # Create the symlink.a
-                    link_target = pathlib.Path(self.DEPLOYED_MODULES_DIR, modulename)
-                    link_source = pathlib.Path(self.AVAILABLE_MODULES_DIR, modulename)
-
-                    # Ensure the parent directory for the symlink.
-                    deployment_directory = link_target.parent
-                    deployment_directory.mkdir(parents=True, exist_ok=True)
-
-                    link_target.symlink_to(link_source)
-
-                    self.deployed.append(modulename)
-                    if self.verbose:
-                        print(f"{modulename} deployed")
-
+            return self.deploy_modulefiles(self.available.modulefiles(modulepath))
         else:
             print(f"Error: Unknown modulefile {modulepath}")
-
-    def remove_empty(self, path_in_deployed, recurse=False):
-        path = pathlib.Path(path_in_deployed).resolve()
-        # If th path is the deployed directory, return.
-        if path == self.DEPLOYED_MODULES_DIR.resolve() or path == self.AVAILABLE_MODULES_DIR.resolve():
-            return
-
-        # If the path is in the deployment folder.
-        if self.DEPLOYED_MODULES_DIR in path.parents or self.AVAILABLE_MODULES_DIR in path.parents:
-            # If the path is empty
-            if not any(path.parent.iterdir()):
-                # Delete the directory
-                path.parent.rmdir()
-
-                # Recurse up a level.
-                self.remove_empty(path.parent, recurse=True)
-
+            return {}
+
+    @in_manifest_transaction
+    def deploy_modulefiles(self, modulefiles):
+        # Deploy available modulefiles as one batch, returning errors by module name for any which could not be.
+        self.refuse_dry_run("deploy modules")
+        modulefiles = [modulename for modulename in modulefiles if not self.is_deployed(modulename)]
+        if len(modulefiles):
+            self.stage_generation()
+        links = []
+        filenames = {}
+        for modulename in modulefiles:
+            # Lua modulefiles keep their suffix when deployed, so Lmod can tell them apart
+            filename = self.available.filename(modulename)
+            filenames[modulename] = filename
+            links.append((modulename, pathlib.Path(self.DEPLOYED_MODULES_DIR, filename), pathlib.Path(self.AVAILABLE_MODULES_DIR, filename)))
+        # Directories already holding deployed modules exist, so needn't be created.
+        parents = {filename.parent for filename in filenames.values()}
+        directories = [pathlib.Path(self.DEPLOYED_MODULES_DIR, parent) for parent in parents if not self.deployed.is_group(parent)]
+        linked, errors = self.link_executor().link(links, directories, self.DEPLOYED_MODULES_DIR)
+
+        for modulename, link, source in linked:
+            filename = filenames[modulename]
+            self.deployed.append(filename)
+            self.manifest_record("deployed", self.DEPLOYED_MODULES_DIR, filename, "deployed", target=str(source))
+            self._deployed_changes += 1
+            self._spider_changed.add(modulename)
+            self._spider_removed.discard(modulename)
+            if self.verbose:
+                print(f"{modulename} deployed")
+        self.deploy_markers({modulename.parent for modulename, link, source in linked})
+        for modulename, error in errors.items():
+            print(f"Error: Could not deploy {modulename}: {error}")
+        return errors
+
+    def deploy_markers(self, groups):
+        # Name the default version of each group in deployed: available's default if it is deployed, otherwise the newest deployed version. Written rather than linked to available's marker, which may name a version that isn't deployed, i.e. one withdrawn for missing dependencies.
+        self.refuse_dry_run("write deployed version markers")
+        for group in groups:
+            group = pathlib.Path(group)
+            if not len(group.parts):
+                continue
+            marker = pathlib.Path(self.DEPLOYED_MODULES_DIR, group, VERSION_MARKER)
+            preferred = read_version_marker(pathlib.Path(self.AVAILABLE_MODULES_DIR, group, VERSION_MARKER))
+            versions = [m.name for m in self.deployed.iter_modulefiles(group) if m.parent == group] if self.deployed.is_group(group) else []
+            if preferred is None or not len(versions):
+                if os.path.lexists(marker):
+                    self.stage_generation()
+                    os.unlink(pathlib.Path(self.DEPLOYED_MODULES_DIR, group, VERSION_MARKER))
+                    self.deployed_marker_changed(group)
+                continue
+            default = preferred if preferred in versions else max(versions, key=lmod_parse_version)
+            # Markers from before were symlinks to available's.
+            if not os.path.islink(marker) and read_version_marker(marker) == default:
+                continue
+            self.stage_generation()
+            marker = pathlib.Path(self.DEPLOYED_MODULES_DIR, group, VERSION_MARKER)
+            if os.path.islink(marker):
+                os.unlink(marker)
+            if write_file_if_changed(marker, version_marker_string(default)):
+                self.deployed_marker_changed(group)
+
+    def deployed_marker_changed(self, group):
+        # Markers aren't modulefiles, but changing one changes its directory, and needs publishing if using generations.
+        self._deployed_changes += 1
+        if self.manifest is not None:
+            self.manifest.touch("deployed", self.DEPLOYED_MODULES_DIR, group.as_posix())
+
+    @profile_phase("withdraw", by_module=True)
+    @in_manifest_transaction
     def withdraw(self, modulepath):
         modulepath = pathlib.Path(modulepath)
         # Only withdraw deployed as symlink modules.
         if self.is_deployed(modulepath):
             # Get the list of modules to acutally deploy, incase it is a group.
-            modulefiles = self.deployed.modulefiles(modulepath)
-            for modulename in modulefiles:
-                if self.is_deployed(modulename):
-                    if self.is_deplyed_as_symlink(modulename):
-                        deployed_path = self.deployed_path(modulename)
-                        try:
-                            deployed_path.unlink()
-
-                            self.deployed.remove(modulename)
-                            if self.verbose:
-                                print(f"{modulename} withdrawn")
-
-                            # If the parent directory is now empty, the directory (and subsequently empty parents) are no longer required?
-                            self.remove_empty(deployed_path, recurse=True)
-
-
-                        except FileNotFoundError as e:
-                            print(e)
-                    else:
-                        raise Exception("Cannot withdraw non-symlink modulefile.")
+            return self.withdraw_modulefiles(self.deployed.modulefiles(modulepath))
         else:
             # @todo raise an issue.
-            pass
-
+            return {}
+
+    @in_manifest_transaction
+    def withdraw_modulefiles(self, modulefiles):
+        # Withdraw deployed modulefiles as one batch, returning errors by module name for any which could not be, i.e. as they are not symlinks.
+        self.refuse_dry_run("withdraw modules")
+        modulefiles = [modulename for modulename in modulefiles if self.is_deployed(modulename)]
+        if len(modulefiles):
+            self.stage_generation()
+        paths = [(modulename, self.deployed_path(modulename)) for modulename in modulefiles]
+        executor = self.link_executor()
+        unlinked, errors = executor.unlink(paths)
+        for modulename, deployed_path in unlinked:
+            self.deployed.remove(modulename)
+            self.manifest_forget("deployed", self.DEPLOYED_MODULES_DIR, modulename)
+            self._deployed_changes += 1
+            self._spider_removed.add(modulename)
+            self._spider_changed.discard(modulename)
+            if self.verbose:
+                print(f"{modulename} withdrawn")
+        self.deploy_markers({modulename.parent for modulename, deployed_path in unlinked})
+        # Directories now empty (and subsequently empty parents) are no longer required, so are removed together.
+        with PROFILER.phase("cleanup empty dirs"):
+            executor.prune({deployed_path.parent for modulename, deployed_path in unlinked}, self.DEPLOYED_MODULES_DIR)
+        for modulename, error in errors.items():
+            print(f"Error: Could not withdraw {modulename}: {error}")
+        return errors
+
+    @profile_phase("withdraw all")
+    @in_manifest_transaction
     def withdraw_all(self):
         # Withdraw all modules
-        self.find_deployed()
-        count = 0
-        for modulename in self.deployed.modulefiles():
-            self.withdraw(modulename)
-            count += 1
+        modulefiles = self.deployed.modulefiles()
+        errors = self.withdraw_modulefiles(modulefiles)
 
         if self.verbose:
-            print(f"{count} modules were withdrawn")
+            print(f"{len(modulefiles) - len(errors)} modules were withdrawn")
 
+    @profile_phase("delete available")
+    @in_manifest_transaction
     def delete_available(self):
         # Withdraw available modules and remove them from available.
-        self.find_available()
-        count = 0
-        for modulename in self.available.modulefiles():
-            if self.is_deployed(modulename):
-                self.withdraw(modulename)
+        deleted = self.delete_modulefiles(self.available.modulefiles())
+        # Nothing remains available to search.
+        SearchIndex(self.SEARCH_INDEX_FILE).rebuild([])
 
-            available_path = self.avaiable_path(modulename)
+        if self.verbose:
+            print(f"{len(deleted)} modules were withdrawn")
+
+    @in_manifest_transaction
+    def delete_modulefiles(self, modulefiles):
+        # Withdraw and delete available modulefiles as one batch, returning those deleted. Directories left empty are removed together afterwards, rather than after each file.
+        self.refuse_dry_run("delete modules")
+        modulefiles = [modulename for modulename in modulefiles if self.is_available(modulename)]
+        self.withdraw_modulefiles([modulename for modulename in modulefiles if self.is_deployed(modulename)])
+        executor = self.link_executor()
+        paths = [(modulename, self.avaiable_path(modulename)) for modulename in modulefiles]
+        deleted = []
+        for (modulename, available_path), error in executor.map(lambda item: item[1].unlink(), paths):
+            if error is not None and not isinstance(error, FileNotFoundError):
+                print(f"Error: Could not delete {modulename}: {error}")
+                continue
+            deleted.append((modulename, available_path))
+            self.available.remove(modulename)
+            self.manifest_forget("available", self.AVAILABLE_MODULES_DIR, modulename)
+        with PROFILER.phase("cleanup empty dirs"):
+            executor.prune({available_path.parent for modulename, available_path in deleted}, self.AVAILABLE_MODULES_DIR)
+        return [modulename for modulename, available_path in deleted]
+
+    def stale_modulefiles(self, applications):
+        # Generated modulefiles for versions of the given resolved applications which are no longer found, i.e. as the install was removed, along with any from applications no longer defined.
+        current = {pathlib.PurePath(app, version).as_posix() for app, obj in applications.items() for version in obj["versions"]}
+        # Dry runs only read the manifest, without bringing it up to date, so only modules still available are stale.
+        if not self.dry_run:
+            manifest = self.manifest
+        else:
+            manifest = Manifest.open_readonly(self.MANIFEST_FILE) if self.use_manifest else None
+        if manifest is None:
+            # Without the manifest, generated modulefiles can only be told from others within the directories of applications still defined.
+            return [modulename for app in applications if self.available.is_group(app) for modulename in self.available.iter_modulefiles(app) if modulename.parent.as_posix() == app and modulename.as_posix() not in current]
+        with self.lock():
+            # Loading available first brings the manifest up to date with the tree.
+            self.available
+            stale = [pathlib.Path(module["name"]) for module in manifest.modules("available") if module["origin"] == "generated" and module["name"] not in current]
+        if manifest is not self.manifest:
+            manifest.close()
+        return [modulename for modulename in stale if self.is_available(modulename)]
+
+    @profile_phase("prune")
+    @in_manifest_transaction
+    def prune(self):
+        # Remove generated modulefiles and symlinks whose installs are no longer found, withdrawing any deployed, without rewriting anything current. Only the stale entries and their directories are touched.
+        scan_cache = ScanCache(self.SCAN_CACHE_FILE, refresh=self.refresh_cache) if self.use_cache else None
+        # Only the versions generate would find are needed, not the modulefiles it would render or the links it would plan.
+        with PROFILER.phase("versions"):
+            applications = resolve_applications(self.application_definitions(), scan_cache)
+
+        stale = self.stale_modulefiles(applications)
+        # Links of versions no longer found. Those of versions still found are left to generate.
+        links = set()
+        for modulename in stale:
+            found, directories = scan_symlinks(pathlib.Path(self.SYMLINKS_DIR, modulename))
+            links.update(found)
+        print_pruned([self.avaiable_path(modulename) for modulename in stale], links, self.dry_run, self.AVAILABLE_MODULES_DIR)
+        if self.dry_run:
+            return
+        if scan_cache is not None:
+            scan_cache.save()
+
+        # Applications which lost versions may have lost their default, and their deploy policy no longer lists them.
+        for app in sorted({modulename.parent.as_posix() for modulename in stale}):
+            app_path = pathlib.Path(self.AVAILABLE_MODULES_DIR, app)
+            if app in applications and app_path.is_dir():
+                write_version_marker(app_path, applications[app], self.incremental)
+            elif pathlib.Path(app_path, VERSION_MARKER).is_file():
+                # Applications no longer defined have no default.
+                pathlib.Path(app_path, VERSION_MARKER).unlink()
+        self.save_deploy_policy(applications, complete=True)
+
+        deleted = self.delete_modulefiles(stale)
+        # Including those in which nothing was withdrawn, whose available default may have changed.
+        self.deploy_markers({group for group in {modulename.parent for modulename in stale} if self.deployed.is_group(group)})
+        executor = self.link_executor()
+        unlinked, errors = executor.unlink([(link, link) for link in sorted(links)])
+        for link, error in errors.items():
+            print(f"Error: Could not remove {link}: {error}")
+        with PROFILER.phase("cleanup empty dirs"):
+            executor.prune({link.parent for link, path in unlinked}, self.SYMLINKS_DIR)
+        self.update_search_index(removed=deleted)
+
+
+    @contextlib.contextmanager
+    def lock(self):
+        # Serialise with other invocations modifying the tree or its manifest. Dry runs refuse any change, so don't wait. Reentrant, as releasing a nested lockf would release the outer one too.
+        if self.dry_run or self._locked:
+            yield
+            return
+        with DeploymentLock(self.DEPLOY_LOCK_FILE):
+            self._locked = True
             try:
-                available_path.unlink()
-                self.available.remove(modulename)
-
-                # If the parent directory is now empty, the directory (and subsequently empty parents) are no longer required?
-                self.remove_empty(available_path, recurse=True)
-                count += 1
-            except FileNotFoundError as e:
-                print(e)
-
+                yield
+            finally:
+                self._locked = False
+
+    def generation_store(self):
+        return GenerationStore(self.DEPLOYED_MODULES_DIR, self.DEPLOYED_GENERATIONS_DIR, self.generations if self.generations is not None else 0)
+
+    @contextlib.contextmanager
+    def generation(self):
+        # Apply changes to deployed within the block to a staged copy, published as a new generation on success and discarded on failure.
+        if self.generations is None or self.dry_run or self._generation_store is not None:
+            yield
+            return
+        store = self._generation_store = self.generation_store()
+        published_dir = self.DEPLOYED_MODULES_DIR
+        changes = self._deployed_changes
+        try:
+            yield
+        except BaseException:
+            if self._staging is not None:
+                store.discard(self._staging)
+                # The view may include changes which were never published.
+                self._deployed = None
+            raise
+        finally:
+            self.DEPLOYED_MODULES_DIR = published_dir
+            staging, self._staging = self._staging, None
+            self._generation_store = None
+        # Nothing was about to change, so nothing was staged.
+        if staging is None:
+            return
+        if self._deployed_changes == changes:
+            store.discard(staging)
+            return
+        with PROFILER.phase("publish generation"):
+            generation = store.publish(staging)
+            # Directories copied from the previous generation are new to the manifest, so are recorded now rather than by the next reader.
+            if self.manifest is not None:
+                with self.lock():
+                    self.manifest.verify("deployed", self.DEPLOYED_MODULES_DIR)
         if self.verbose:
-            print(f"{count} modules were withdrawn")
+            print(f"Published generation {generation} of {self.DEPLOYED_MODULES_DIR}")
 
+    def stage_generation(self):
+        # Within generation(), deployed is only copied once something in it is about to change, so runs changing nothing never copy the tree.
+        if self._generation_store is None or self._staging is not None:
+            return
+        with PROFILER.phase("stage generation"):
+            self._staging = self._generation_store.stage()
+        self.DEPLOYED_MODULES_DIR = self._staging
+
+    @profile_phase("rollback")
+    def rollback(self):
+        self.refuse_dry_run("roll back")
+        generation = self.generation_store().rollback()
+        print(f"Rolled back {self.DEPLOYED_MODULES_DIR} to generation {generation}")
+        # Everything deployed may have changed.
+        self._deployed = None
+        self._spider_rebuild = True
 
     def install(self):
         # @todo guard to only add to path if that dir exits, incase these files are moved.
-        s = f"If using LMOD, modify .bashrc to include:\n\n"
+        s = "If using LMOD, modify .bashrc to include:\n\n"
         s += f"export MODULEPATH=\"{self.DEPLOYED_MODULES_DIR}:$MODULEPATH\"\n"
+        if self.spider_cache:
+            s += "\nTo use the generated spider cache for faster module avail / spider, also include:\n\n"
+            s += f"export LMOD_RC=\"{pathlib.Path(self.SPIDER_CACHE_DIR, 'lmodrc.lua')}\"\n"
         
         print(s)
 
-    def autodeploy(self):
-        print("@todo - autodeployment based on dependencies.")
-        modulefiles = self.not_deployed_modulefiles()
+    def load_deploy_policy(self):
+        # The versions to deploy of applications with a deploy policy, as selected when they were last generated.
+        try:
+            with open(self.DEPLOY_POLICY_FILE, "r") as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return {}
+
+    def save_deploy_policy(self, applications, complete=False):
+        # If complete, applications are every application, so policies of any others are dropped.
+        policy = self.load_deploy_policy()
+        if complete:
+            policy = {app: value for app, value in policy.items() if app in applications}
+        for app, obj in applications.items():
+            if "deploy" in obj:
+                selected, default = select_versions(obj)
+                policy[app] = {"versions": selected, "default": default}
+            else:
+                policy.pop(app, None)
+        self.DEPLOY_POLICY_FILE.parent.mkdir(parents=True, exist_ok=True)
+        write_file_if_changed(self.DEPLOY_POLICY_FILE, json.dumps(policy, indent=1, sort_keys=True))
+
+    def permitted(self, modulename, policy):
+        # Whether the deploy policy of a generated module's application allows it to be deployed. Policies are by the directory of the application's modules.
+        app = modulename.parent.as_posix()
+        if app not in policy:
+            return True
+        return modulename.name in policy[app]["versions"]
 
-        for modulename in sorted(modulefiles):
-            self.deploy(modulename)
+    @profile_phase("check dependencies")
+    def check_dependencies(self, modulefiles):
+        # Check the dependencies of modulefiles, given as {modulename: path}. Returns {modulename: [unmet requirements]} for those with any unmet.
+        requirements = {}
+        for modulename, path in modulefiles.items():
+            try:
+                requirements[modulename] = modulefile_requirements(path, self.SYMLINKS_DIR)
+            except (OSError, UnicodeDecodeError):
+                requirements[modulename] = None
+        results = check_paths([check for groups in requirements.values() if groups is not None for group in groups for check in group], self.jobs)
+
+        unmet = {}
+        for modulename, groups in requirements.items():
+            if groups is None:
+                unmet[modulename] = ["a readable modulefile"]
+                continue
+            missing = [" or ".join(path if kind == "exists" else f"binaries in {path}" for kind, path in group) for group in groups if not any(results[check] for check in group)]
+            if len(missing):
+                unmet[modulename] = missing
+        return unmet
+
+    def generated_modulefiles(self):
+        # The names of the modules generated from the applications registry: those the manifest records as generated, or without a manifest, those within the modules directory of a defined application.
+        if self.manifest is not None:
+            return {module["name"] for module in self.manifest.modules("available") if module["origin"] == "generated"}
+        applications = self.application_definitions()
+        return {modulefile_name(m).as_posix() for m in self.available.modulefiles() if module_application(m) in applications}
+
+    def autodeploy(self, names=None):
+        # Deploy available modules whose dependencies exist, and withdraw deployed modules whose dependencies have gone.
+        self.refuse_dry_run("autodeploy")
+        # Only generated modules are checked and withdrawn, hand written and external modules are left as they are.
+        generated = self.generated_modulefiles()
+        candidates = self.not_deployed_modulefiles()
+        deployed = [m for m in self.deployed.modulefiles() if self.is_deplyed_as_symlink(m) and modulefile_name(m).as_posix() in generated]
+        # Optionally only consider modules of the named applications.
+        if names is not None:
+            candidates = [m for m in candidates if module_application(m) in names]
+            deployed = [m for m in deployed if module_application(m) in names]
+
+        # Versions outside of their application's deploy policy are not deployed, and are withdrawn if they were.
+        policy = self.load_deploy_policy()
+        retired = [m for m in deployed if not self.permitted(m, policy)]
+        candidates = [m for m in candidates if self.permitted(m, policy)]
+        deployed = [m for m in deployed if self.permitted(m, policy)]
+
+        modulefiles = {m: self.avaiable_path(m) for m in candidates if modulefile_name(m).as_posix() in generated}
+        modulefiles.update({m: self.deployed_path(m) for m in deployed})
+        unmet = self.check_dependencies(modulefiles)
+
+        # Deployed and withdrawn as batches.
+        deployable = []
+        for modulename in sorted(candidates):
+            if modulename in unmet:
+                print(f"{modulename} is missing {', '.join(unmet[modulename])}, not deploying")
+            else:
+                deployable.append(modulename)
+        withdrawable = []
+        for modulename in sorted(retired):
+            if self.verbose:
+                print(f"{modulename} is outside the deploy policy of {modulename.parts[0]}, withdrawing")
+            withdrawable.append(modulename)
+        for modulename in sorted(deployed):
+            if modulename in unmet:
+                print(f"{modulename} is missing {', '.join(unmet[modulename])}, withdrawing")
+                withdrawable.append(modulename)
+        deployed_count = len(deployable) - len(self.deploy_modulefiles(deployable))
+        withdrawn_count = len(withdrawable) - len(self.withdraw_modulefiles(withdrawable))
 
-    def generate(self):
-        generate_modules()
-        # Re-find avaialable modules 
-        self.find_available()
+        if self.verbose:
+            print(f"{deployed_count} modules were deployed, {withdrawn_count} withdrawn, {len(candidates) - deployed_count} not deployed")
 
+    def application_definitions(self, names=None):
+        # A fresh copy of the applications definitions, as they are mutated during generation. Optionally only those named.
+        if self.applications is not None:
+            applications = copy.deepcopy(self.applications)
+        else:
+            with PROFILER.phase("load applications"):
+                applications = load_applications(self.APPLICATIONS_DIR, self.REGISTRY_CACHE_FILE, self.use_cache)
+        if names is not None:
+            # Applications built with compilers need their compilers' versions.
+            names = set(names)
+            for app in list(names):
+                if app in applications and "compilers" in applications[app]:
+                    names |= set(applications[app]["compilers"])
+            applications = {app: obj for app, obj in applications.items() if app in names}
+        return applications
+
+    def watched_directories(self, applications):
+        # The search directories of each application, mapped to the names of the applications they are for. Applications built with compilers are watched in the directories of each version of their compilers, as they are generated.
+        dependent = {app: obj for app, obj in applications.items() if "compilers" in obj and len(obj["compilers"])}
+        core = {app: obj for app, obj in applications.items() if app not in dependent}
+        instances = [(app, obj) for app, obj in core.items()]
+        if len(dependent):
+            compilers = {compiler for obj in dependent.values() for compiler in obj["compilers"] if compiler in core}
+            found = find_applications(copy.deepcopy({app: core[app] for app in compilers}))
+            for obj in expand_compiler_applications(dependent, found).values():
+                instances.append((obj["name"], obj))
+        watched = {}
+        for app, obj in instances:
+            for dependency in obj["dependencies"]:
+                search_path, pattern = DirectoryScanner.key(dependency["search_dir"], dependency["pattern"])
+                watched.setdefault(search_path, set()).add(app)
+        return watched
+
+    def watch(self, interval=5.0, debounce=2.0, polling=False):
+        # Regenerate and deploy applications whenever their search directories change, until interrupted.
+        applications = self.application_definitions()
+        # Applications built with each compiler, which need generating for any new version of it.
+        dependents = {}
+        for app, obj in applications.items():
+            for compiler in (obj["compilers"] if "compilers" in obj else []):
+                dependents.setdefault(compiler, set()).add(app)
+        watched = self.watched_directories(applications)
+
+        watcher = create_watcher(watched, interval, polling)
+        print(f"Watching {len(watched)} directories for {len(applications)} applications using {type(watcher).__name__}")
+        try:
+            while True:
+                changed = watcher.wait()
+                # Debounce: keep collecting changes until the directories have been quiet for a while.
+                while True:
+                    more = watcher.wait(debounce)
+                    if not len(more):
+                        break
+                    changed |= more
+
+                names = set()
+                for path in changed:
+                    names |= watched[path]
+                for app in list(names):
+                    if app in dependents:
+                        names |= dependents[app]
+                print(f"Changes in {', '.join(sorted(str(p) for p in changed))}, updating {', '.join(sorted(names))}")
+                with self.lock():
+                    # The trees may have been changed by other invocations while waiting.
+                    self.reload()
+                    with self.generation():
+                        self.generate(names)
+                        self.autodeploy(names)
+                    if self.spider_cache:
+                        self.update_spider_cache()
+                # Compiler versions may have come or gone, changing the directories of applications built with them.
+                if len(names & set(dependents)):
+                    rewatched = self.watched_directories(applications)
+                    if set(rewatched) != set(watched):
+                        watcher.close()
+                        watcher = create_watcher(rewatched, interval, polling)
+                        print(f"Watching {len(rewatched)} directories for {len(applications)} applications")
+                    watched = rewatched
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+
+    @profile_phase("generate")
+    @in_manifest_transaction
+    def generate(self, names=None):
+        scan_cache = ScanCache(self.SCAN_CACHE_FILE, refresh=self.refresh_cache) if self.use_cache else None
+        probe_cache = ProbeCache(self.PROBE_CACHE_FILE, refresh=self.refresh_cache) if self.use_cache else None
+        applications = self.application_definitions(names)
+        report = generate_modules(scan_cache, self.incremental, self.modulefile_format, self.jobs, applications, self.SYMLINKS_DIR, self.AVAILABLE_MODULES_DIR, self.dry_run, probe_cache, self.modulepath)
+        # A dry run changes nothing, so there is nothing further to update.
+        if self.dry_run:
+            return
+        if scan_cache is not None:
+            scan_cache.save()
+        if probe_cache is not None:
+            probe_cache.save()
+        self.save_deploy_policy(applications)
+        self.update_search_index(report["modules"])
+        for module in report["modules"]:
+            self.manifest_record("available", self.AVAILABLE_MODULES_DIR, module["filename"], "generated", module["hash"])
+        # Deployed modules whose content changed need refreshing in the spider cache.
+        for path in report["written"]:
+            modulename = self.modulename_from_path(path)
+            # Record new modulefiles, rather than walking available again. If it hasn't been loaded yet there is nothing to update.
+            if self._available is not None:
+                self._available.append(path.relative_to(self.AVAILABLE_MODULES_DIR))
+            if self.is_deployed(modulename):
+                # If the modulefile changed format, the deployed symlink must be replaced too.
+                if self.deployed.filename(modulename) != self.available.filename(modulename):
+                    self.withdraw(modulename)
+                    self.deploy(modulename)
+                self._spider_changed.add(modulename)
+        # The default in available may have changed.
+        self.deploy_markers({group for group in {pathlib.Path(module["name"]).parent for module in report["modules"]} if self.deployed.is_group(group)})
+
+    def index_available(self):
+        # Search index entries for every available modulefile, including those not generated here, parsed from the files themselves.
+        modules = []
+        for modulename in self.available:
+            filename = self.available.filename(modulename)
+            info = parse_modulefile(pathlib.Path(self.AVAILABLE_MODULES_DIR, filename))
+            version = info["version"] if info["version"] is not None else modulename.name
+            modules.append(search_index_module(modulename, filename, module_application(modulename), version, info["family"], " ".join(info["whatis"])))
+        return modules
+
+    @profile_phase("search index")
+    def update_search_index(self, modules=(), removed=()):
+        # Update the entries of the given modules, indexing the whole available tree if there is no index yet.
+        index = SearchIndex(self.SEARCH_INDEX_FILE)
+        if index.entries is None:
+            index.rebuild(self.index_available())
+        else:
+            index.update(modules, removed)
+
+    def search(self, query):
+        index = SearchIndex(self.SEARCH_INDEX_FILE)
+        # The index is only rebuilt from the available tree if missing or asked to.
+        if index.entries is None or self.refresh_cache:
+            index.rebuild(self.index_available())
+        results = index.search(query)
+        OUTPUT.count("search", f"{len(results)} modules matching {query}", count=len(results), query=query)
+        if OUTPUT.quiet or not len(results):
+            return
+        width = max(len(name) for name, entry in results)
+        for name, entry in results:
+            # One lstat per result, rather than loading the deployed tree.
+            deployed = os.path.lexists(pathlib.Path(self.DEPLOYED_MODULES_DIR, entry["filename"]))
+            state = "deployed" if deployed else "available"
+            whatis = entry["whatis"] if entry["whatis"] else ""
+            OUTPUT.entry(state, name, pathlib.Path(self.AVAILABLE_MODULES_DIR, entry["filename"]), f"  {name: <{width}}  {state: <9}  {whatis}".rstrip(), application=entry["application"], version=entry["version"], family=entry["family"], whatis=entry["whatis"])
+
+    @profile_phase("clean generated")
     def clean_generated(self):
-        clean_symlinks()
+        self.refuse_dry_run("clean generated modules")
+        clean_symlinks(self.SYMLINKS_DIR)
         self.delete_available()
 
     def auto(self):
         self.generate()
+        if self.dry_run:
+            print("Dry run, skipping autodeploy")
+            return
         self.autodeploy()
 
-    def cli(self, args):
-        # Process cli arguments, performing the appropriate action.
-
+    @profile_phase("spider cache")
+    def update_spider_cache(self, rebuild=False):
+        # Refresh the spider cache for deployed modules changed by this invocation, or rebuild it if requested / missing.
+        self.refuse_dry_run("update the spider cache")
+        spider = SpiderCache(self.SPIDER_CACHE_DIR, self.DEPLOYED_MODULES_DIR)
+        if rebuild or self._spider_rebuild or spider.entries is None:
+            spider.rebuild([self.deployed.filename(m) for m in self.deployed.modulefiles()])
+        elif len(self._spider_changed) or len(self._spider_removed):
+            changed = [self.deployed.filename(m) for m in self._spider_changed if self.is_deployed(m)]
+            spider.update(changed=changed, removed=self._spider_removed)
+        self._spider_changed = set()
+        self._spider_removed = set()
+        self._spider_rebuild = False
+
+    def cli_changes(self, args):
         # Clean first if provided
         if args.clean:
             self.withdraw_all()
@@ -784,6 +3907,10 @@ class ModulefileManager:
         if args.clean_deployed:
             self.withdraw_all()
 
+        # Remove only what is no longer installed
+        if args.prune:
+            self.prune()
+
         # Clean generated files
         if args.clean_generated:
             self.clean_generated()
@@ -808,7 +3935,35 @@ class ModulefileManager:
         if args.withdraw is not None and len(args.withdraw):
             for modulename in args.withdraw:
                 self.withdraw(modulename)
+
+    def cli(self, args):
+        # Process cli arguments, performing the appropriate action.
+
+        # Only generating and pruning can be planned without applying changes, anything else would change the trees without the lock.
+        if self.dry_run:
+            refused = {"--rollback": args.rollback, "--clean": args.clean, "--clean-deployed": args.clean_deployed, "--clean-generated": args.clean_generated, "--autodeploy": args.autodeploy, "--deploy": args.deploy, "--withdraw": args.withdraw, "--spider-cache": args.spider_cache}
+            refused = [option for option, value in refused.items() if value]
+            if len(refused):
+                raise Exception(f"--dry-run cannot be combined with {', '.join(refused)}")
+
+        modifies = args.rollback or args.clean or args.clean_deployed or args.prune or args.clean_generated or args.generate or args.auto or args.autodeploy or args.deploy or args.withdraw or args.spider_cache
+        # Changes are made under the lock, and if using generations are published together once complete.
+        with self.lock() if modifies else contextlib.nullcontext():
+            # Rollback before anything else, so other changes apply to the restored generation
+            if args.rollback:
+                self.rollback()
+
+            with self.generation():
+                self.cli_changes(args)
+
+            # Keep the spider cache in line with the deployed tree
+            if self.spider_cache and (args.spider_cache or self._spider_rebuild or len(self._spider_changed) or len(self._spider_removed)):
+                self.update_spider_cache(rebuild=args.spider_cache)
         
+        # Long running watch mode, regenerating applications as they change.
+        if args.watch:
+            self.watch(args.watch_interval, args.watch_debounce, args.watch_poll)
+
         # Finally list-like arguments        
         if args.install:
             self.install()
@@ -819,6 +3974,12 @@ class ModulefileManager:
         if args.list or args.list_deployed:
             self.list_deployed()
 
+        if args.search is not None:
+            self.search(args.search)
+
+        if args.verify:
+            self.verify()
+
         # Finally provide a summary of the new state
         if args.summary:
             self.summary()
@@ -854,6 +4015,25 @@ def parse_cli():
         help="List deployed modules"
     )
 
+    parser.add_argument(
+        "--search",
+        type=str,
+        metavar="QUERY",
+        help="Search available modules by name, version, family and whatis, using the index built when generating. Matches substrings of every word, or failing that similar text"
+    )
+
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Reconcile the manifest of available and deployed modules with the filesystem, reporting modulefiles added or removed other than by this script"
+    )
+
+    parser.add_argument(
+        "--no-manifest",
+        action="store_true",
+        help="Walk the available and deployed trees, rather than reading and updating the manifest"
+    )
+
     parser.add_argument(
         "--install",
         action="store_true",
@@ -895,6 +4075,104 @@ def parse_cli():
         help="Generate modules and symlinks based on avaialble applications"
     )
 
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Watch application search directories, regenerating and deploying affected applications when they change"
+    )
+
+    parser.add_argument(
+        "--watch-interval",
+        type=float,
+        default=5.0,
+        help="Seconds between polls of directories which cannot be watched with inotify"
+    )
+
+    parser.add_argument(
+        "--watch-debounce",
+        type=float,
+        default=2.0,
+        help="Seconds without further changes before regenerating"
+    )
+
+    parser.add_argument(
+        "--watch-poll",
+        action="store_true",
+        help="Poll directories rather than using inotify"
+    )
+
+    parser.add_argument(
+        "-n",
+        "--dry-run",
+        action="store_true",
+        help="When generating or pruning, print the planned symlink and modulefile changes without applying them. Cannot be combined with options which deploy, withdraw or clean modules"
+    )
+
+    parser.add_argument(
+        "--applications",
+        type=str,
+        metavar="DIR",
+        help=f"Directory of TOML/JSON application definitions to generate modules for (default {APPLICATIONS_DIR})"
+    )
+
+    parser.add_argument(
+        "--generations",
+        type=int,
+        metavar="N",
+        help="Stage changes to deployed modules and publish them as a new generation with an atomic symlink swap, keeping N previous generations for --rollback"
+    )
+
+    parser.add_argument(
+        "--rollback",
+        action="store_true",
+        help="Switch deployed modules back to the previous generation"
+    )
+
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Do not read or write the application registry, directory scan and version probe caches when generating"
+    )
+
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Ignore cached directory scans and version probes, rescanning and rewriting the caches. With --search, rebuild the search index from the available modulefiles"
+    )
+
+    parser.add_argument(
+        "--no-incremental",
+        action="store_true",
+        help="Rewrite every generated modulefile, even if its content is unchanged"
+    )
+
+    parser.add_argument(
+        "--spider-cache",
+        action="store_true",
+        help="Rebuild the Lmod spider cache for deployed modules"
+    )
+
+    parser.add_argument(
+        "--no-spider-cache",
+        action="store_true",
+        help="Do not maintain the Lmod spider cache when deploying or withdrawing"
+    )
+
+    parser.add_argument(
+        "--modulefile-format",
+        choices=sorted(MODULEFILE_FORMATS),
+        default="tcl",
+        help="Format of generated modulefiles, for applications which do not specify one"
+    )
+
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=4,
+        help="Number of concurrent filesystem tasks when generating, deploying and withdrawing"
+    )
+
     parser.add_argument(
         "--clean-generated",
         action="store_true",
@@ -907,12 +4185,52 @@ def parse_cli():
         help="clean deployed modules / autowithdraw all"
     )
 
+    parser.add_argument(
+        "--prune",
+        action="store_true",
+        help="Remove generated module files and symlinks whose installs are no longer found, withdrawing any deployed"
+    )
+
     parser.add_argument(
         "--clean",
         action="store_true",
         help="Withdraw all modules, delete generated modules, delete symlinks"
     )
 
+    parser.add_argument(
+        "--format",
+        choices=OutputStream.FORMATS,
+        default="text",
+        help="Format of listings, summaries and generate reports. json and ndjson records are streamed to stdout, with other messages going to stderr"
+    )
+
+    parser.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        help="Only output counts for listings and generate reports, rather than every module, modulefile and symlink"
+    )
+
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Report wall time per phase and filesystem operation counts per application, to stderr"
+    )
+
+    parser.add_argument(
+        "--profile-format",
+        choices=["text", "json"],
+        default="text",
+        help="Format of the --profile report"
+    )
+
+    parser.add_argument(
+        "--profile-cprofile",
+        type=str,
+        metavar="FILE",
+        help="With --profile, also run cProfile, dumping stats to FILE and reporting the hottest functions"
+    )
+
     parser.add_argument(
         "-v",
         "--verbose",
@@ -926,11 +4244,25 @@ def parse_cli():
 def main():
     args = parse_cli()
 
-    # Construct the manager object
-    manager = ModulefileManager(args.verbose)
-
-    # Apply command line arguments.
-    manager.cli(args)
+    if args.profile:
+        PROFILER.start(cprofile=args.profile_cprofile is not None)
+
+    # Records go to stdout, so anything else printed goes to stderr rather than breaking them up.
+    OUTPUT.configure(args.format, args.quiet, sys.stdout)
+    messages = contextlib.redirect_stdout(sys.stderr) if args.format != "text" else contextlib.nullcontext()
+
+    try:
+        with messages:
+            # Construct the manager object
+            manager = ModulefileManager(args.verbose, use_cache=not args.no_cache, refresh_cache=args.refresh, incremental=not args.no_incremental, spider_cache=not args.no_spider_cache, modulefile_format=args.modulefile_format, jobs=args.jobs, dry_run=args.dry_run, applications_dir=args.applications, generations=args.generations, manifest=not args.no_manifest)
+
+            # Apply command line arguments.
+            manager.cli(args)
+    finally:
+        OUTPUT.close()
+        if args.profile:
+            PROFILER.stop()
+            print(PROFILER.report(args.profile_format, args.profile_cprofile), file=sys.stderr)
 
 
 if __name__ == "__main__":